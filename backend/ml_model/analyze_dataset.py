@@ -1,74 +1,76 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from pathlib import Path
+import argparse
+import json
+from dataset_profile import DEFAULT_CHUNK_SIZE, plot_profile, profile_dataset
 
-def analyze_dataset(file_path):
-    # Read the Excel file
+def analyze_dataset(file_path, output_path='dataset_profile.json', plot=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                    workers=1, processed_output=None):
+    """Profile the dataset in one streaming pass and print a summary"""
     print(f"Reading dataset from {file_path}...")
-    df = pd.read_excel(file_path)
+    report = profile_dataset(file_path, chunk_size, workers).to_dict()
     
     # Basic information
     print("\nDataset Information:")
-    print(f"Number of samples: {len(df)}")
-    print(f"Number of features: {len(df.columns)}")
+    print(f"Number of samples: {report['rows']}")
+    print(f"Number of features: {len(report['columns'])}")
     print("\nColumns in the dataset:")
-    for col in df.columns:
-        print(f"- {col}")
-    
-    # Data types and missing values
-    print("\nData Types and Missing Values:")
-    print(df.info())
+    for name, column in report['columns'].items():
+        print(f"- {name} ({column['kind']})")
     
     # Basic statistics
     print("\nBasic Statistics:")
-    print(df.describe())
+    for name, column in report['columns'].items():
+        if column['kind'] == 'numeric':
+            print(f"{name}: count={column['count']} mean={column['mean']:.4g} std={column['std'] or 0:.4g} "
+                  f"min={column['min']:.4g} max={column['max']:.4g}")
+        else:
+            print(f"{name}: count={column['count']} distinct={column['distinct']}")
     
     # Check for missing values
-    missing_values = df.isnull().sum()
-    if missing_values.any():
+    missing_values = {name: column['missing'] for name, column in report['columns'].items() if column['missing']}
+    if missing_values:
         print("\nMissing Values:")
-        print(missing_values[missing_values > 0])
+        for name, count in missing_values.items():
+            print(f"{name}: {count}")
     else:
         print("\nNo missing values found in the dataset.")
     
-    # Create visualizations directory if it doesn't exist
-    vis_dir = Path("visualizations")
-    vis_dir.mkdir(exist_ok=True)
+    if report.get('label_distribution'):
+        print(f"\nDistribution of {report['label']}:")
+        for value, count in report['label_distribution'].items():
+            print(f"{value}: {count}")
     
-    # Create correlation heatmap
-    plt.figure(figsize=(12, 8))
-    numeric_cols = df.select_dtypes(include=['float64', 'int64']).columns
-    correlation_matrix = df[numeric_cols].corr()
-    sns.heatmap(correlation_matrix, annot=True, cmap='coolwarm', center=0)
-    plt.title('Feature Correlation Heatmap')
-    plt.tight_layout()
-    plt.savefig(vis_dir / 'correlation_heatmap.png')
-    plt.close()
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nProfile saved to {output_path}")
     
-    # Distribution of target variable (if it exists)
-    if 'label' in df.columns:
-        plt.figure(figsize=(10, 6))
-        df['label'].value_counts().plot(kind='bar')
-        plt.title('Distribution of Crop Types')
-        plt.xlabel('Crop Type')
-        plt.ylabel('Count')
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-        plt.savefig(vis_dir / 'crop_distribution.png')
-        plt.close()
+    # Plotting libraries are only imported when plots are asked for
+    if plot:
+        for path in plot_profile(report, 'visualizations'):
+            print(f"Plot saved to {path}")
     
-    # Save processed data to CSV
-    output_path = 'processed_crop_data.csv'
-    df.to_csv(output_path, index=False)
-    print(f"\nProcessed data saved to {output_path}")
+    # Copy the rows out as CSV, one chunk at a time
+    if processed_output:
+        from dataset_cache import iter_chunks
+        
+        for index, chunk in enumerate(iter_chunks(file_path, chunk_size)):
+            chunk.to_csv(processed_output, mode='w' if index == 0 else 'a', header=index == 0, index=False)
+        print(f"\nProcessed data saved to {processed_output}")
     
-    return df
+    return report
 
 if __name__ == "__main__":
-    dataset_path = "farmer_guide_crop_dataset.xlsx"
+    parser = argparse.ArgumentParser(description='Summarize a dataset')
+    parser.add_argument('dataset', nargs='?', default='farmer_guide_crop_dataset.xlsx', help='Workbook or CSV file')
+    parser.add_argument('--output', type=str, default='dataset_profile.json', help='JSON report path')
+    parser.add_argument('--plot', action='store_true', help='Draw the correlation heatmap and label distribution')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Rows read per chunk')
+    parser.add_argument('--workers', type=int, default=1, help='Profile shards in this many processes')
+    parser.add_argument('--processed-output', type=str,
+                        help='Also copy the rows to this CSV file (e.g. processed_crop_data.csv)')
+    args = parser.parse_args()
     try:
-        df = analyze_dataset(dataset_path)
+        analyze_dataset(args.dataset, args.output, args.plot, args.chunk_size, args.workers, args.processed_output)
         print("\nDataset analysis completed successfully!")
     except Exception as e:
-        print(f"Error analyzing dataset: {str(e)}") 
\ No newline at end of file
+        print(f"Error analyzing dataset: {str(e)}")
@@ -0,0 +1,323 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import numpy as np
+from instrumentation import configure_logging, logger, report_progress
+
+# Day each stage starts, per crop, for the synthetic stage dataset
+STAGE_CALENDAR = {
+    'paddy': [(0, 'Sowing'), (10, 'Nursery Phase'), (25, 'Transplantation'), (35, 'Vegetative'),
+              (60, 'Flowering'), (95, 'Maturity')],
+    'maize': [(0, 'Sowing'), (8, 'Germination'), (15, 'Vegetative'), (50, 'Tasseling'),
+              (60, 'Silking'), (90, 'Maturity')],
+    'cotton': [(0, 'Sowing'), (10, 'Seedling'), (30, 'Squaring'), (60, 'Flowering'),
+               (90, 'Boll Formation'), (140, 'Maturity')],
+    'groundnut': [(0, 'Sowing'), (10, 'Germination'), (25, 'Vegetative'), (40, 'Flowering'),
+                  (50, 'Pegging'), (70, 'Pod Formation'), (100, 'Maturity')],
+}
+STAGE_TASKS = {
+    'Sowing': 'Prepare nursery bed',
+    'Nursery Phase': 'Water nursery regularly',
+    'Transplantation': 'Transplant seedlings',
+    'Germination': 'Ensure soil moisture',
+    'Seedling': 'Thin seedlings',
+    'Vegetative': 'Apply fertilizer and irrigation',
+    'Squaring': 'Scout for bollworm',
+    'Tasseling': 'Irrigate at tasseling',
+    'Silking': 'Protect silks from pests',
+    'Flowering': 'Monitor for pests and diseases',
+    'Pegging': 'Earth up around plants',
+    'Pod Formation': 'Apply gypsum',
+    'Boll Formation': 'Apply potash',
+    'Maturity': 'Prepare for harvest',
+}
+
+# Mean N, P, K, temperature, humidity, ph, rainfall per crop for the synthetic soil dataset
+SOIL_PROFILES = {
+    'rice': [80, 48, 40, 23.5, 82.0, 6.4, 236.0],
+    'maize': [78, 48, 20, 22.4, 65.0, 6.2, 84.0],
+    'cotton': [118, 46, 20, 24.0, 80.0, 6.9, 80.0],
+    'groundnut': [21, 67, 20, 27.0, 48.0, 6.3, 150.0],
+    'chickpea': [40, 68, 80, 18.9, 17.0, 7.3, 80.0],
+    'banana': [100, 82, 50, 27.4, 80.0, 6.0, 105.0],
+}
+SOIL_COLUMNS = ['N', 'P', 'K', 'temperature', 'humidity', 'ph', 'rainfall']
+
+DEFAULT_SCALES = [1000, 10000, 100000]
+LATENCY_SAMPLES = 200
+BATCH_ROWS = 10000
+
+# Metrics where a larger value is better; every other metric is a cost
+HIGHER_IS_BETTER = {'batch_throughput_rows_per_s'}
+
+# Each benchmark runs this many times and reports the median of every metric
+DEFAULT_REPEATS = 3
+# Smallest change, by metric unit suffix, that can count as a regression, so
+# that large relative swings in tiny timings are not reported as slowdowns;
+# checked in order, as '_rows_per_s' also ends in '_s'
+MIN_ABSOLUTE_CHANGE = (
+    ('_rows_per_s', 5000.0),
+    ('_bytes', 4096),
+    ('_mb', 10.0),
+    ('_ms', 0.1),
+    ('_s', 0.05),
+)
+
+def generate_stage_data(rows, path, seed=42, noise=0.02):
+    """Write a synthetic dataset shaped like processed_crop_data.csv"""
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    crops = np.array(list(STAGE_CALENDAR))
+    crop_index = rng.integers(0, len(crops), rows)
+    days = rng.integers(0, 150, rows)
+
+    stages = np.empty(rows, dtype=object)
+    for index, crop in enumerate(crops):
+        starts, names = zip(*STAGE_CALENDAR[crop])
+        mask = crop_index == index
+        stages[mask] = np.array(names, dtype=object)[np.searchsorted(starts, days[mask], side='right') - 1]
+
+    # Mislabel a few rows so the forest has something to average over
+    flipped = rng.random(rows) < noise
+    all_stages = np.array(list(STAGE_TASKS), dtype=object)
+    stages[flipped] = all_stages[rng.integers(0, len(all_stages), flipped.sum())]
+
+    pd.DataFrame({
+        'crop': crops[crop_index],
+        'days_since_planting': days,
+        'stage': stages,
+        'suggested_task': [STAGE_TASKS[stage] for stage in stages]
+    }).to_csv(path, index=False)
+
+def generate_soil_data(rows, path, seed=42):
+    """Write a synthetic dataset shaped like sample_data.csv"""
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    labels = np.array(list(SOIL_PROFILES))
+    label_index = rng.integers(0, len(labels), rows)
+    means = np.array([SOIL_PROFILES[label] for label in labels])[label_index]
+    values = rng.normal(means, np.abs(means) * 0.1)
+
+    df = pd.DataFrame(values.round(2), columns=SOIL_COLUMNS)
+    df['label'] = labels[label_index]
+    df.to_csv(path, index=False)
+
+def _timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def _latency_percentiles(function, samples=LATENCY_SAMPLES):
+    latencies = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {'latency_p50_ms': p50, 'latency_p95_ms': p95, 'latency_p99_ms': p99}
+
+def _peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def bench_stage(rows, workdir, model_params=None):
+    """Benchmark CropStagePredictor end to end on a synthetic dataset"""
+    from crop_stage_predictor import CropStagePredictor
+
+    data_path = os.path.join(workdir, f'stage_{rows}.csv')
+    model_path = os.path.join(workdir, f'stage_{rows}.joblib')
+    generate_stage_data(rows, data_path)
+    metrics = {}
+
+    trainer = CropStagePredictor()
+    _, metrics['load_data_cold_s'] = _timed(trainer.load_data, data_path)
+    _, metrics['load_data_warm_s'] = _timed(trainer.load_data, data_path)
+    _, metrics['fit_s'] = _timed(trainer.train_model, model_params)
+    _, metrics['save_s'] = _timed(trainer.save_model, model_path)
+
+    predictor = CropStagePredictor()
+    _, metrics['model_load_s'] = _timed(predictor.load_model, model_path)
+    metrics['model_size_bytes'] = os.path.getsize(model_path)
+
+    record = {'crop': 'paddy', 'days_since_planting': 42}
+    metrics.update(_latency_percentiles(lambda: predictor.predict_stage(record)))
+
+    crops = list(STAGE_CALENDAR)
+    records = [{'crop': crops[i % len(crops)], 'days_since_planting': i % 150} for i in range(BATCH_ROWS)]
+    _, batch_time = _timed(predictor.predict_batch, records)
+    metrics['batch_throughput_rows_per_s'] = BATCH_ROWS / batch_time
+    metrics['peak_rss_mb'] = _peak_rss_mb()
+    return metrics
+
+def bench_recommender(rows, workdir, model_params=None):
+    """Benchmark CropRecommender end to end on a synthetic dataset"""
+    from crop_recommender import CropRecommender
+
+    data_path = os.path.join(workdir, f'soil_{rows}.csv')
+    model_path = os.path.join(workdir, f'soil_{rows}.joblib')
+    generate_soil_data(rows, data_path)
+    metrics = {}
+
+    # The prediction cache would hide the model's cost
+    trainer = CropRecommender(model_params, cache_size=0)
+    _, metrics['prepare_data_cold_s'] = _timed(trainer.prepare_data, data_path)
+    (X_train, X_test, y_train, y_test), metrics['prepare_data_warm_s'] = _timed(trainer.prepare_data, data_path)
+    _, metrics['fit_s'] = _timed(trainer.train, X_train, y_train)
+    _, metrics['save_s'] = _timed(trainer.save_model, model_path)
+
+    recommender = CropRecommender(cache_size=0)
+    _, metrics['model_load_s'] = _timed(recommender.load_model, model_path)
+    metrics['model_size_bytes'] = os.path.getsize(model_path)
+
+    row = np.array([SOIL_PROFILES['rice']])
+    metrics.update(_latency_percentiles(lambda: recommender.predict_proba(row)))
+
+    batch = np.array(list(SOIL_PROFILES.values()))[np.arange(BATCH_ROWS) % len(SOIL_PROFILES)]
+    _, batch_time = _timed(recommender.predict_proba, batch)
+    metrics['batch_throughput_rows_per_s'] = BATCH_ROWS / batch_time
+    metrics['peak_rss_mb'] = _peak_rss_mb()
+    return metrics
+
+BENCHMARKS = {
+    'stage': bench_stage,
+    'recommender': bench_recommender,
+}
+
+def _run_one(target, rows, workdir, model_params):
+    # Runs in a fresh process so peak RSS belongs to this benchmark alone
+    import warnings
+    import dataset_cache
+    warnings.filterwarnings('ignore')
+    # Keep converted synthetic datasets out of the real cache directory
+    dataset_cache.CACHE_DIR = os.path.join(workdir, 'dataset_cache')
+    return BENCHMARKS[target](rows, workdir, model_params)
+
+def run_benchmarks(targets, scales, model_params=None, repeats=DEFAULT_REPEATS):
+    """Run every target at every scale repeats times, each run in its own spawned process
+
+    Each result holds the median of every metric over the runs.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    total = len(targets) * len(scales)
+    with tempfile.TemporaryDirectory(prefix='ml_benchmark_') as workdir:
+        for target in targets:
+            for rows in scales:
+                logger.info("Benchmarking %s at %d rows", target, rows)
+                report_progress('benchmarking', len(results) / total)
+                runs = []
+                for _ in range(repeats):
+                    with context.Pool(1) as pool:
+                        runs.append(pool.apply(_run_one, (target, rows, workdir, model_params)))
+                metrics = {name: float(np.median([run[name] for run in runs])) for name in runs[0]}
+                results.append({'target': target, 'rows': rows, 'repeats': repeats, 'metrics': metrics})
+    report_progress('benchmarking', 1.0)
+    return results
+
+def min_absolute_change(name):
+    for suffix, change in MIN_ABSOLUTE_CHANGE:
+        if name.endswith(suffix):
+            return change
+    return 0
+
+def compare(results, baseline, threshold):
+    """List metrics that got worse than the baseline by more than threshold
+
+    A metric must also have moved by at least its MIN_ABSOLUTE_CHANGE.
+    """
+    previous = {(entry['target'], entry['rows']): entry['metrics'] for entry in baseline['results']}
+    regressions = []
+    for entry in results:
+        old_metrics = previous.get((entry['target'], entry['rows']))
+        if not old_metrics:
+            continue
+        for name, value in entry['metrics'].items():
+            old = old_metrics.get(name)
+            if not old:
+                continue
+            change = (value - old) / old
+            if name in HIGHER_IS_BETTER:
+                change = -change
+            if change > threshold and abs(value - old) >= min_absolute_change(name):
+                regressions.append({
+                    'target': entry['target'],
+                    'rows': entry['rows'],
+                    'metric': name,
+                    'baseline': old,
+                    'current': value,
+                    'change': change
+                })
+    return regressions
+
+def environment():
+    import sklearn
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'sklearn': sklearn.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Training, cold-start and inference benchmarks')
+    parser.add_argument('--targets', type=str, default='stage,recommender',
+                        help='Comma-separated benchmarks to run (stage, recommender)')
+    parser.add_argument('--scales', type=str, default=','.join(str(rows) for rows in DEFAULT_SCALES),
+                        help='Comma-separated synthetic dataset sizes in rows')
+    parser.add_argument('--model-params', type=str,
+                        help='Model parameters as a JSON object, JSON file or model_search report')
+    parser.add_argument('--output', type=str, help='Write results to this JSON file')
+    parser.add_argument('--baseline', type=str, help='Compare against a previous results file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative slowdown that counts as a regression')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS,
+                        help='Runs per benchmark; metrics are their medians')
+    parser.add_argument('--log-level', type=str, help='Logging level for stderr diagnostics')
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    targets = args.targets.split(',')
+    unknown = [target for target in targets if target not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmark targets: {', '.join(unknown)}")
+    scales = [int(rows) for rows in args.scales.split(',')]
+
+    model_params = None
+    if args.model_params:
+        from model_search import load_params
+        model_params = load_params(args.model_params)
+
+    report = environment()
+    report['results'] = run_benchmarks(targets, scales, model_params, max(1, args.repeats))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report['results'], json.load(f), args.threshold)
+        report['regressions'] = regressions
+        for regression in regressions:
+            logger.warning("Regression in %s@%d %s: %.4g -> %.4g (%+.0f%%)", regression['target'],
+                           regression['rows'], regression['metric'], regression['baseline'],
+                           regression['current'], regression['change'] * 100)
+
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import argparse
+import io
+import json
+import os
+import time
+from collections import deque
+import numpy as np
+from crop_recommender import MODEL_NAME, CropRecommender
+from instrumentation import configure_logging, logger, metrics
+from model_registry import ModelRegistry, write_atomic
+from predict import current_model_path
+
+# Input is read in blocks of about this many bytes, cut at line ends; each
+# block is parsed, scored and formatted by one pool worker
+DEFAULT_CHUNK_BYTES = 8 << 20
+DEFAULT_TOP_K = 3
+# Blocks in flight per worker; with the block size this bounds memory
+PENDING_PER_WORKER = 2
+PROBABILITY_DECIMALS = 4
+
+# Set in each pool worker by init_worker
+_worker = {}
+
+def is_jsonl(path):
+    return os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson')
+
+def progress_path(output_path):
+    return f"{output_path}.progress.json"
+
+def output_columns(top_k, id_column=None):
+    columns = [id_column] if id_column else []
+    for rank in range(1, top_k + 1):
+        columns += [f"crop_{rank}", f"probability_{rank}"]
+    return columns
+
+def init_worker(model_path, names, features, top_k, id_column, jsonl):
+    """Load the model once per pool worker"""
+    recommender = CropRecommender(cache_size=0, runtime='compiled')
+    if not recommender.load_model(model_path):
+        raise RuntimeError(f"Failed to load the model from {model_path}")
+    _worker.update(recommender=recommender, names=names, features=features, top_k=top_k,
+                   id_column=id_column, jsonl=jsonl,
+                   classes=csv_fields([str(label) for label in recommender.model.classes_]),
+                   # Formatting floats dominates a block's time; probabilities
+                   # are rounded and looked up as text instead
+                   probability_text=np.array([f"{step / 10 ** PROBABILITY_DECIMALS:.{PROBABILITY_DECIMALS}f}"
+                                              for step in range(10 ** PROBABILITY_DECIMALS + 1)] + [''],
+                                             dtype=object))
+
+def csv_fields(values):
+    """Values as CSV field text, quoted where they contain a separator or quote"""
+    import pandas as pd
+
+    text = pd.Series(values, dtype=object).fillna('').astype(str)
+    quoted = text.str.contains('[,"\r\n]', regex=True)
+    if quoted.any():
+        text[quoted] = '"' + text[quoted].str.replace('"', '""') + '"'
+    return text.to_numpy(dtype=object)
+
+def parse_block(block):
+    import pandas as pd
+
+    if _worker['jsonl']:
+        return pd.read_json(io.BytesIO(block), lines=True, dtype=False)
+    usecols = _worker['features'] + ([_worker['id_column']] if _worker['id_column'] else [])
+    return pd.read_csv(io.BytesIO(block), header=None, names=_worker['names'], usecols=usecols,
+                       dtype={_worker['id_column']: str} if _worker['id_column'] else None)
+
+def score_block(block):
+    """Score one block of input lines; returns (rows, invalid rows, CSV bytes)"""
+    import pandas as pd
+
+    frame = parse_block(block)
+    X = np.column_stack([pd.to_numeric(frame[name], errors='coerce').to_numpy(dtype=np.float64)
+                         if name in frame else np.full(len(frame), np.nan)
+                         for name in _worker['features']]).reshape(len(frame), len(_worker['features']))
+    # Rows with a missing or non-numeric feature get empty predictions
+    valid = ~np.isnan(X).any(axis=1)
+    classes = _worker['classes']
+    probabilities = np.zeros((len(X), len(classes)))
+    if valid.any():
+        scored = _worker['recommender'].predict_proba(X[valid])
+        if scored is None:
+            raise RuntimeError("Failed to make predictions")
+        probabilities[valid] = scored
+
+    top_k = min(_worker['top_k'], len(classes))
+    ranked = np.argsort(-probabilities, axis=1, kind='stable')[:, :top_k]
+    steps = np.rint(np.take_along_axis(probabilities, ranked, axis=1) * 10 ** PROBABILITY_DECIMALS).astype(np.int64)
+    # Invalid rows point at the table's trailing empty string
+    steps[~valid] = len(_worker['probability_text']) - 1
+    columns = []
+    if _worker['id_column']:
+        id_column = _worker['id_column']
+        columns.append(csv_fields(frame[id_column].to_numpy() if id_column in frame else [None] * len(frame)))
+    for rank in range(top_k):
+        columns.append(np.where(valid, classes[ranked[:, rank]], ''))
+        columns.append(_worker['probability_text'][steps[:, rank]])
+    text = ''.join(','.join(row) + '\n' for row in zip(*columns))
+    return len(frame), int((~valid).sum()), text.encode('utf-8')
+
+def read_blocks(source, chunk_bytes):
+    """Yield (end offset, block) pairs of whole lines from a binary file"""
+    while True:
+        block = source.read(chunk_bytes)
+        if not block:
+            return
+        if not block.endswith(b'\n'):
+            block += source.readline()
+        yield source.tell(), block
+
+def input_columns(input_path):
+    """Column names of the input: the CSV header, or the keys of the first JSON line"""
+    with open(input_path, 'rb') as source:
+        first = source.readline()
+    if is_jsonl(input_path):
+        return list(json.loads(first or b'{}')), 0
+    return [name.strip().strip('"') for name in first.decode('utf-8-sig').rstrip('\r\n').split(',')], len(first)
+
+def bulk_score(input_path, output_path, model_path=None, workers=None, chunk_bytes=DEFAULT_CHUNK_BYTES,
+               top_k=DEFAULT_TOP_K, id_column=None, restart=False):
+    """Score every row of a CSV or JSONL file into a CSV file of top-k crops, in input order
+
+    Progress is recorded next to the output after each block is written, so
+    a run that is interrupted continues from its last written block when
+    started again with the same input, model and settings.  Returns a
+    result dict.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    start = time.perf_counter()
+    stat = os.stat(input_path)
+    settings = {
+        "input": os.path.abspath(input_path),
+        "input_size": stat.st_size,
+        "input_mtime": stat.st_mtime,
+        "top_k": top_k,
+        "id_column": id_column
+    }
+
+    progress = None
+    if not restart and os.path.exists(progress_path(output_path)):
+        with open(progress_path(output_path)) as f:
+            progress = json.load(f)
+        if model_path is None:
+            model_path = progress['model']
+        if progress['settings'] != settings or progress['model'] != os.path.abspath(model_path):
+            return {"status": "error", "message": "Input, model or settings differ from the recorded run "
+                                                  "into this output; pass --restart to score from the start"}
+        if progress['complete']:
+            return {"status": "success", "message": "Already complete", "rows": progress['rows'],
+                    "invalid_rows": progress['invalid_rows'], "output": output_path, "skipped": True}
+    if model_path is None:
+        model_path = current_model_path(ModelRegistry().current(MODEL_NAME))
+
+    recommender = CropRecommender(cache_size=0, runtime='compiled')
+    if not recommender.load_model(model_path):
+        return {"status": "error", "message": f"Failed to load the model from {model_path}"}
+    features = list(recommender.feature_names)
+    names, header_bytes = input_columns(input_path)
+    missing = [name for name in features + ([id_column] if id_column else []) if name not in names]
+    if missing and not is_jsonl(input_path):
+        return {"status": "error", "message": f"Input lacks columns: {missing}"}
+
+    if progress is None:
+        progress = {"settings": settings, "model": os.path.abspath(model_path), "offset": header_bytes,
+                    "output_bytes": 0, "rows": 0, "invalid_rows": 0, "complete": False}
+        with open(output_path, 'w') as output:
+            output.write(','.join(output_columns(min(top_k, len(recommender.model.classes_)), id_column)) + '\n')
+        progress['output_bytes'] = os.path.getsize(output_path)
+        write_atomic(progress_path(output_path), json.dumps(progress))
+    else:
+        logger.info("Resuming at row %d of %s", progress['rows'], input_path)
+    resumed_rows = progress['rows']
+
+    workers = workers or os.cpu_count() or 1
+    with open(input_path, 'rb') as source, open(output_path, 'r+b') as output, \
+            ProcessPoolExecutor(workers, initializer=init_worker, initargs=(
+                model_path, names, features, top_k, id_column, is_jsonl(input_path))) as pool:
+        # Anything after the last recorded block is from an interrupted write
+        output.truncate(progress['output_bytes'])
+        output.seek(progress['output_bytes'])
+        source.seek(progress['offset'])
+
+        def write(end, future):
+            rows, invalid, text = future.result()
+            output.write(text)
+            output.flush()
+            os.fsync(output.fileno())
+            progress.update(offset=end, output_bytes=output.tell(), rows=progress['rows'] + rows,
+                            invalid_rows=progress['invalid_rows'] + invalid)
+            write_atomic(progress_path(output_path), json.dumps(progress))
+            metrics.incr('bulk_rows_scored_total', rows)
+            logger.info("Scored %d rows", progress['rows'])
+
+        # Blocks are written in submission order, so output rows keep the
+        # input order however the workers finish
+        pending = deque()
+        for end, block in read_blocks(source, chunk_bytes):
+            pending.append((end, pool.submit(score_block, block)))
+            if len(pending) >= workers * PENDING_PER_WORKER:
+                write(*pending.popleft())
+        while pending:
+            write(*pending.popleft())
+
+    progress['complete'] = True
+    write_atomic(progress_path(output_path), json.dumps(progress))
+    elapsed = time.perf_counter() - start
+    scored = progress['rows'] - resumed_rows
+    return {
+        "status": "success",
+        "rows": progress['rows'],
+        "invalid_rows": progress['invalid_rows'],
+        "resumed_from_row": resumed_rows,
+        "output": output_path,
+        "seconds": elapsed,
+        "rows_per_s": scored / elapsed if elapsed > 0 else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Score a large CSV or JSONL file of soil profiles with the crop recommender')
+    parser.add_argument('input', type=str, help='CSV with a header row, or JSONL; one record per line')
+    parser.add_argument('output', type=str, help='CSV file of the top crops and their probabilities per row')
+    parser.add_argument('--model', type=str,
+                        help='Model file; defaults to the current registry version, or the resumed run\'s model')
+    parser.add_argument('--workers', type=int, help='Scoring processes; defaults to the CPU count')
+    parser.add_argument('--chunk-bytes', type=int, default=DEFAULT_CHUNK_BYTES, help='Input bytes per block')
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K, help='Crops written per row')
+    parser.add_argument('--id-column', type=str, help='Input column copied to the output to identify rows')
+    parser.add_argument('--restart', action='store_true', help='Ignore an interrupted run and start over')
+    parser.add_argument('--log-level', type=str, help='Logging level for stderr diagnostics')
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    try:
+        result = bulk_score(args.input, args.output, args.model, args.workers, args.chunk_bytes,
+                            max(1, args.top_k), args.id_column, args.restart)
+    except KeyboardInterrupt:
+        result = {"status": "error", "message": "Interrupted; run the same command again to resume"}
+    except Exception as e:
+        result = {"status": "error", "message": str(e)}
+    print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
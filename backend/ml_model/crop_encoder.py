@@ -0,0 +1,141 @@
+import json
+import os
+import re
+import numpy as np
+
+# Alternative crop names, mapped to the names used in the training data
+ALIASES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'crop_aliases.json')
+
+NGRAM_SIZE = 2
+# Smallest n-gram Jaccard similarity accepted by the fuzzy fallback
+DEFAULT_FUZZY_THRESHOLD = 0.5
+# Distinct unknown spellings remembered between calls
+MAX_REMEMBERED = 10000
+
+def normalize_name(name):
+    """Lowercase a crop name and collapse whitespace, hyphens and underscores"""
+    return re.sub(r'[\s_\-]+', ' ', str(name).lower()).strip()
+
+def ngrams(name, size=NGRAM_SIZE):
+    padded = f" {name} "
+    return {padded[i:i + size] for i in range(max(len(padded) - size + 1, 1))}
+
+def load_aliases(path=ALIASES_FILE):
+    """Read the alias table, or an empty one if the file does not exist"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+class CropEncoder:
+    """Crop name to code encoder backed by a dict, with aliases and fuzzy matching
+
+    A drop-in for the LabelEncoder used before: ``classes_`` holds the crop
+    names by code, ``fit``/``transform`` behave the same for known names.
+    Names are normalized before lookup and aliases resolve to their target's
+    code.  Names that still miss are matched against every known name and
+    alias through an n-gram index when ``fuzzy`` is set.  ``encode`` returns
+    -1 instead of raising for names it cannot resolve.
+    """
+
+    def __init__(self, classes=(), aliases=None, fuzzy=True, fuzzy_threshold=DEFAULT_FUZZY_THRESHOLD):
+        self.classes_ = np.asarray(list(classes), dtype=object)
+        self.aliases = {normalize_name(alias): normalize_name(target) for alias, target in (aliases or {}).items()}
+        self.fuzzy = fuzzy
+        self.fuzzy_threshold = fuzzy_threshold
+        self._build()
+
+    def _build(self):
+        self.index = {name: code for code, name in enumerate(self.classes_.tolist())}
+        for alias, target in self.aliases.items():
+            if target in self.index and alias not in self.index:
+                self.index[alias] = self.index[target]
+        # n-gram -> names (known and aliases) containing it
+        self.ngram_index = {}
+        self.name_ngrams = {}
+        for name in self.index:
+            grams = ngrams(name)
+            self.name_ngrams[name] = len(grams)
+            for gram in grams:
+                self.ngram_index.setdefault(gram, []).append(name)
+        self._resolved = {}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build()
+
+    def __getstate__(self):
+        # The lookup structures are rebuilt on load
+        return {key: value for key, value in self.__dict__.items()
+                if key not in ('index', 'ngram_index', 'name_ngrams', '_resolved')}
+
+    def fit(self, names):
+        self.classes_ = np.asarray(sorted({normalize_name(name) for name in names}), dtype=object)
+        self._build()
+        return self
+
+    def extend(self, names):
+        """Append unseen names after the existing classes so existing codes stay valid"""
+        known = set(self.classes_.tolist())
+        new = []
+        for name in map(normalize_name, names):
+            if name not in known:
+                known.add(name)
+                new.append(name)
+        if new:
+            self.classes_ = np.concatenate([self.classes_, np.asarray(new, dtype=object)])
+            self._build()
+        return self
+
+    def match(self, name):
+        """Code of the known name or alias most similar to name, or -1"""
+        grams = ngrams(name)
+        overlap = {}
+        for gram in grams:
+            for candidate in self.ngram_index.get(gram, ()):
+                overlap[candidate] = overlap.get(candidate, 0) + 1
+        best, best_score = -1, self.fuzzy_threshold
+        for candidate, shared in overlap.items():
+            score = shared / (len(grams) + self.name_ngrams[candidate] - shared)
+            if score >= best_score:
+                best, best_score = self.index[candidate], score
+        return best
+
+    def code(self, name):
+        """Code of a single raw name, or -1"""
+        normalized = normalize_name(name)
+        code = self.index.get(normalized)
+        if code is not None:
+            return code
+        code = self._resolved.get(normalized)
+        if code is None:
+            code = self.match(normalized) if self.fuzzy else -1
+            if len(self._resolved) >= MAX_REMEMBERED:
+                self._resolved.clear()
+            self._resolved[normalized] = code
+        return code
+
+    def encode(self, names):
+        """Codes for an array of raw names, -1 where a name cannot be resolved"""
+        seen = {}
+        codes = np.empty(len(names), dtype=np.int64)
+        for i, name in enumerate(names):
+            code = seen.get(name)
+            if code is None:
+                code = seen[name] = self.code(name)
+            codes[i] = code
+        return codes
+
+    def transform(self, names):
+        codes = self.encode(names)
+        if (codes < 0).any():
+            unknown = sorted({str(name) for name, code in zip(names, codes) if code < 0})
+            raise ValueError(f"y contains previously unseen labels: {unknown}")
+        return codes
+
+    def fit_transform(self, names):
+        return self.fit(names).transform(names)
+
+    def inverse_transform(self, codes):
+        return self.classes_[np.asarray(codes)]
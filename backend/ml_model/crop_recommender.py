@@ -1,31 +1,68 @@
+import os
 import numpy as np
-import pandas as pd
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
-import joblib
-import matplotlib.pyplot as plt
-import seaborn as sns
+from instrumentation import logger, metrics, report_progress
+from prediction_cache import PredictionCache
+
+# pandas, matplotlib, seaborn, joblib and sklearn are imported inside the
+# methods that use them so that loading a model and predicting does not pay
+# for them; with runtime='compiled' sklearn is never imported at all.
+
+# See model_search.build_model for the parameters a model can be built from
+DEFAULT_MODEL_PARAMS = {
+    'family': 'random_forest',
+    'n_estimators': 100,
+    'random_state': 42,
+    'n_jobs': -1,
+    'class_weight': 'balanced'
+}
+
+# Repeated soil profiles are answered from an in-process LRU cache; pass
+# cache_size=0 to disable it
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 600.0
+
+# Name and file of published versions in the model registry
+MODEL_NAME = 'crop_recommender'
+ARTIFACT_FILE = 'model.joblib'
+
+def compiled_path(model_path):
+    """Directory of the compiled (sklearn-free) export stored next to a model file"""
+    return os.path.splitext(model_path)[0] + '.compiled'
 
 class CropRecommender:
-    def __init__(self):
-        self.model = RandomForestClassifier(
-            n_estimators=100,
-            random_state=42,
-            n_jobs=-1,
-            class_weight='balanced'
-        )
-        self.scaler = StandardScaler()
+    def __init__(self, model_params=None, cache_size=DEFAULT_CACHE_SIZE, cache_ttl=DEFAULT_CACHE_TTL,
+                 quantization=None, runtime='sklearn'):
+        self.params = dict(DEFAULT_MODEL_PARAMS, **(model_params or {}))
+        # 'compiled' loads the NumPy export in load_model; such a recommender
+        # can predict but not train
+        self.runtime = runtime
+        self.model = None
+        self.scaler = None
+        if runtime == 'sklearn':
+            from sklearn.preprocessing import StandardScaler
+            from model_search import build_model
+            
+            self.model = build_model(self.params)
+            self.scaler = StandardScaler()
         self.feature_names = None
+        self.dataset_hash = None
+        # Inputs of the training run that produced the model; see
+        # model_registry.training_fingerprint
+        self.fingerprint = None
+        # quantization maps feature names to step sizes, e.g. {'ph': 0.1, 'rainfall': 5}
+        self.cache = PredictionCache(cache_size, cache_ttl, quantization) if cache_size else None
         
     def prepare_data(self, data_path):
         """
-        Prepare and preprocess the data from Excel file
+        Prepare and preprocess the data from an Excel or CSV file
         """
+        from sklearn.model_selection import train_test_split
+        from dataset_cache import dataset_hash, load_dataset
+        
         try:
-            # Read Excel file
-            df = pd.read_excel(data_path)
+            # Read the Excel or CSV file through the columnar dataset cache
+            df = load_dataset(data_path)
+            self.dataset_hash = dataset_hash(data_path)
             
             # Store feature names
             self.feature_names = [col for col in df.columns if col != 'label']
@@ -39,39 +76,195 @@ class CropRecommender:
             
             return train_test_split(X_scaled, y, test_size=0.2, random_state=42)
         except Exception as e:
-            print(f"Error preparing data: {str(e)}")
+            logger.error("Error preparing data: %s", e)
             return None, None, None, None
 
-    def train(self, X_train, y_train):
-        """Train the model"""
+    def train_streaming(self, data_path, chunk_size=100000, test_size=0.2, random_state=42, bins=None):
+        """Train on a dataset larger than memory, one chunk at a time
+
+        The scaler is fitted with partial_fit, one small forest is grown per
+        chunk and the forests are merged, so only one chunk of rows is held at
+        a time.  The merged forest has n_estimators trees however many chunks
+        there are: they are spread evenly over the chunks, and with more
+        chunks than trees only an evenly spaced subset of chunks grows one
+        tree each.  Rows are assigned to the held-out test split per chunk with a
+        seeded generator, so every pass sees the same split.  Returns the
+        accuracy on the held-out rows.  Training rows are binned and
+        collapsed as in ``train``.
+        """
+        from dataset_cache import iter_chunks
+        from model_search import build_model
+        from weighted_samples import bin_features, bin_steps, fit_weighted
+
+        if self.params.get('family', 'random_forest') == 'decision_tree':
+            logger.error("Streaming training needs a forest model family")
+            return None
+
+        def split_chunks():
+            for index, chunk in enumerate(iter_chunks(data_path, chunk_size)):
+                test_mask = np.random.default_rng([random_state, index]).random(len(chunk)) < test_size
+                feature_names = [col for col in chunk.columns if col != 'label']
+                X = chunk[feature_names].to_numpy(dtype=np.float64)
+                y = chunk['label'].astype(str).to_numpy()
+                yield feature_names, X, y, test_mask
+
+        try:
+            # Pass 1: scaler statistics and the full label set
+            classes = set()
+            n_chunks = 0
+            self.scaler = self.scaler.__class__()
+            for feature_names, X, y, test_mask in split_chunks():
+                self.feature_names = feature_names
+                if (~test_mask).any():
+                    self.scaler.partial_fit(X[~test_mask])
+                classes.update(y[~test_mask].tolist())
+                n_chunks += 1
+            classes = np.array(sorted(classes), dtype=object)
+            steps = bin_steps(bins, self.feature_names)
+
+            # Pass 2: one forest per chunk.  Labels a chunk lacks are added as
+            # zero-weight rows so every shard shares the same class layout.
+            n_estimators = self.params.get('n_estimators', 100)
+            # Chunk i grows the trees numbered from its share of the total up to the next chunk's
+            shard_starts = np.arange(n_chunks + 1) * n_estimators // max(n_chunks, 1)
+            merged = None
+            for index, (_, X, y, test_mask) in enumerate(split_chunks()):
+                trees_per_shard = int(shard_starts[index + 1] - shard_starts[index])
+                if trees_per_shard == 0:
+                    continue
+                X_train, y_train = self.scaler.transform(bin_features(X[~test_mask], steps)), y[~test_mask]
+                if len(y_train) == 0:
+                    continue
+                missing = np.setdiff1d(classes, y_train)
+                sample_weight = np.concatenate([np.ones(len(y_train)), np.zeros(len(missing))])
+                X_train = np.vstack([X_train, np.repeat(X_train[:1], len(missing), axis=0)])
+                y_train = np.concatenate([y_train, missing])
+
+                shard = build_model(dict(self.params, n_estimators=trees_per_shard,
+                                         random_state=random_state + index))
+                fit_weighted(shard, X_train, y_train, sample_weight)
+                if merged is None:
+                    merged = shard
+                else:
+                    merged.estimators_ += shard.estimators_
+            merged.n_estimators = len(merged.estimators_)
+            self.model = merged
+            self.fingerprint = None
+            if self.cache is not None:
+                self.cache.clear()
+
+            # Pass 3: score the held-out rows
+            correct = total = 0
+            for _, X, y, test_mask in split_chunks():
+                if test_mask.any():
+                    predicted = self.model.predict(self.scaler.transform(X[test_mask]))
+                    correct += int((predicted == y[test_mask]).sum())
+                    total += int(test_mask.sum())
+            return correct / total if total else None
+        except Exception as e:
+            logger.error("Error in streaming training: %s", e)
+            return None
+
+    def train(self, X_train, y_train, bins=None):
+        """Train the model, on the distinct training rows weighted by their counts where that is exact
+
+        bins maps feature names to step sizes, e.g. {'rainfall': 5}; readings
+        are snapped to those steps first so that near-identical rows
+        collapse as well.  See weighted_samples.fit_weighted.
+        """
+        from weighted_samples import bin_features, bin_steps, fit_weighted
+        
         try:
-            self.model.fit(X_train, y_train)
+            if bins:
+                raw = self.scaler.inverse_transform(X_train)
+                X_train = self.scaler.transform(bin_features(raw, bin_steps(bins, self.feature_names)))
+            fit_weighted(self.model, X_train, y_train)
+            self.fingerprint = None
+            if self.cache is not None:
+                self.cache.clear()
             return True
         except Exception as e:
-            print(f"Error training model: {str(e)}")
+            logger.error("Error training model: %s", e)
             return False
 
+    def compress(self, X_fit, X_val, y_val, max_accuracy_loss=None, max_depth=None):
+        """Shrink the trained forest within an accuracy budget and report the change
+
+        Takes scaled rows as returned by prepare_data: trees are selected to
+        reproduce the forest on X_fit, the budget is checked on one half of
+        (X_val, y_val) and accuracy is reported on the other.  The
+        compressed model predicts like any other but cannot be trained
+        further.
+        """
+        from forest_compression import DEFAULT_MAX_ACCURACY_LOSS, compress_forest, model_summary, split_holdout
+        
+        try:
+            if max_accuracy_loss is None:
+                max_accuracy_loss = DEFAULT_MAX_ACCURACY_LOSS
+            X_select, y_select, X_report, y_report = split_holdout(X_val, y_val)
+            before = model_summary(self.model, X_report, y_report)
+            self.model = compress_forest(self.model, X_fit, X_select, y_select, max_accuracy_loss, max_depth)
+            self.fingerprint = None
+            if self.cache is not None:
+                self.cache.clear()
+            return {
+                "max_accuracy_loss": max_accuracy_loss,
+                "before": before,
+                "after": model_summary(self.model, X_report, y_report)
+            }
+        except Exception as e:
+            logger.error("Error compressing model: %s", e)
+            return None
+
     def predict(self, features):
         """Make predictions for new data"""
         try:
-            # Scale the input features
-            scaled_features = self.scaler.transform(features)
-            return self.model.predict(scaled_features)
+            # The predicted class is the most probable one, so share the
+            # (cached) probability path instead of running the model twice
+            probabilities = self._probabilities(features)
+            return self.model.classes_[probabilities.argmax(axis=1)]
         except Exception as e:
-            print(f"Error making predictions: {str(e)}")
+            logger.error("Error making predictions: %s", e)
             return None
 
     def predict_proba(self, features):
         """Get probability estimates for each class"""
         try:
-            scaled_features = self.scaler.transform(features)
-            return self.model.predict_proba(scaled_features)
+            return self._probabilities(features)
         except Exception as e:
-            print(f"Error getting probability estimates: {str(e)}")
+            logger.error("Error getting probability estimates: %s", e)
             return None
 
+    def _probabilities(self, features):
+        """Probability rows for raw features, computing only the rows not in the cache"""
+        features = np.asarray(features, dtype=np.float64)
+        if self.cache is None:
+            return self._model_probabilities(features)
+
+        keys = self.cache.keys(features)
+        rows = [self.cache.get(key) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        metrics.incr('recommender_cache_hits_total', len(rows) - len(missing))
+        metrics.incr('recommender_cache_misses_total', len(missing))
+        if missing:
+            computed = self._model_probabilities(features[missing])
+            for i, row in zip(missing, computed):
+                self.cache.put(keys[i], row)
+                rows[i] = row
+        return np.vstack(rows)
+
+    def _model_probabilities(self, features):
+        with metrics.span('recommender_scale'):
+            scaled_features = self.scaler.transform(features)
+        with metrics.span('recommender_predict_proba'):
+            return self.model.predict_proba(scaled_features)
+
     def evaluate(self, X_test, y_test):
         """Evaluate model performance"""
+        from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+        
         try:
             y_pred = self.predict(X_test)
             accuracy = accuracy_score(y_test, y_pred)
@@ -89,11 +282,13 @@ class CropRecommender:
             
             return accuracy, report
         except Exception as e:
-            print(f"Error evaluating model: {str(e)}")
+            logger.error("Error evaluating model: %s", e)
             return None, None
 
     def feature_importance(self):
         """Get and plot feature importance"""
+        import matplotlib.pyplot as plt
+        
         try:
             importance = self.model.feature_importances_
             indices = np.argsort(importance)[::-1]
@@ -108,32 +303,91 @@ class CropRecommender:
             
             return dict(zip(self.feature_names, importance))
         except Exception as e:
-            print(f"Error getting feature importance: {str(e)}")
+            logger.error("Error getting feature importance: %s", e)
             return None
 
     def save_model(self, model_path='crop_model.joblib'):
-        """Save the trained model"""
+        """Save the trained model and its compiled export"""
+        import joblib
+        
         try:
             joblib.dump({
                 'model': self.model,
                 'scaler': self.scaler,
-                'feature_names': self.feature_names
+                'feature_names': self.feature_names,
+                'fingerprint': self.fingerprint
             }, model_path)
+            self.export_compiled(model_path)
             return True
         except Exception as e:
-            print(f"Error saving model: {str(e)}")
+            logger.error("Error saving model: %s", e)
             return False
 
+    def export_compiled(self, model_path='crop_model.joblib'):
+        """Write the forest and scaler as NumPy arrays that load without sklearn"""
+        from forest_runtime import export_compiled
+        
+        extra_arrays = {}
+        if getattr(self.scaler, 'mean_', None) is not None:
+            extra_arrays['scaler_mean'] = self.scaler.mean_
+        if getattr(self.scaler, 'scale_', None) is not None:
+            extra_arrays['scaler_scale'] = self.scaler.scale_
+        return export_compiled(self.model, compiled_path(model_path), extra_arrays=extra_arrays, meta={
+            'feature_names': list(self.feature_names) if self.feature_names is not None else None,
+            'params': self.params,
+            'fingerprint': self.fingerprint
+        })
+
+    def publish(self, registry, activate=True, **metadata):
+        """Save the model as a new registry version and return its id, or None"""
+        import shutil
+        from forest_runtime import tree_count
+        
+        report_progress('publishing', 0.9)
+        staging = registry.stage(MODEL_NAME)
+        if not self.save_model(os.path.join(staging, ARTIFACT_FILE)):
+            shutil.rmtree(staging, ignore_errors=True)
+            return None
+        return registry.publish(MODEL_NAME, staging, dict(
+            metadata,
+            dataset_hash=self.dataset_hash,
+            params=self.params,
+            feature_names=list(self.feature_names) if self.feature_names is not None else None,
+            fingerprint=self.fingerprint,
+            n_trees=tree_count(self.model)
+        ), activate=activate)
+
     def load_model(self, model_path='crop_model.joblib'):
-        """Load a trained model"""
+        """Load a trained model, from its compiled export when runtime='compiled'"""
         try:
-            saved_model = joblib.load(model_path)
-            self.model = saved_model['model']
-            self.scaler = saved_model['scaler']
-            self.feature_names = saved_model['feature_names']
+            if self.runtime == 'compiled' and os.path.isdir(compiled_path(model_path)):
+                from forest_runtime import CompiledForest, FittedScaler
+                
+                with metrics.span('recommender_model_load'):
+                    self.model = CompiledForest.load(compiled_path(model_path))
+                self.scaler = FittedScaler(self.model.arrays.get('scaler_mean'),
+                                           self.model.arrays.get('scaler_scale'))
+                self.feature_names = self.model.meta.get('feature_names')
+                self.params = self.model.meta.get('params', self.params)
+                self.fingerprint = self.model.meta.get('fingerprint')
+            else:
+                import joblib
+                
+                if self.runtime == 'compiled':
+                    logger.warning("No compiled export next to %s; loading the joblib model", model_path)
+                with metrics.span('recommender_model_load'):
+                    saved_model = joblib.load(model_path)
+                self.model = saved_model['model']
+                self.scaler = saved_model['scaler']
+                self.feature_names = saved_model['feature_names']
+                self.fingerprint = saved_model.get('fingerprint')
+            # Cached results belong to the previous model
+            if self.cache is not None:
+                self.cache.clear()
+                self.cache.configure(self.feature_names)
             return True
         except Exception as e:
-            print(f"Error loading model: {str(e)}")
+            logger.error("Error loading model: %s", e)
             return False
 
 if __name__ == "__main__":
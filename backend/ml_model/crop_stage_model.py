@@ -1,53 +1,146 @@
+import argparse
+import os
 import numpy as np
-from sklearn.ensemble import RandomForestClassifier
-import joblib
 import json
-import sys
+from instrumentation import logger
+
+# Default file of the model trained by sensor_pipeline.py
+MODEL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sensor_stage_model.joblib')
+
+STAGES = ['Germination', 'Vegetative', 'Flowering', 'Fruiting', 'Maturity']
+
+# Model inputs; sensor_pipeline.py computes the sensor readings as rolling
+# means and the last two as running totals per field
+FEATURES = ['temperature', 'humidity', 'soil_moisture', 'days_planted', 'light_intensity',
+            'growing_degree_days', 'moisture_deficit']
+
+# See model_search.build_model for the parameters a model can be built from
+DEFAULT_MODEL_PARAMS = {
+    'family': 'random_forest',
+    'n_estimators': 100,
+    'random_state': 42,
+    'n_jobs': -1
+}
 
 class CropStagePredictor:
-    def __init__(self):
-        self.model = RandomForestClassifier(n_estimators=100, random_state=42)
-        self.stages = ['Germination', 'Vegetative', 'Flowering', 'Fruiting', 'Maturity']
+    def __init__(self, model_params=None):
+        self.params = dict(DEFAULT_MODEL_PARAMS, **(model_params or {}))
+        self.model = None
+        self.stages = list(STAGES)
+        self.features = list(FEATURES)
+        # Stand-ins for missing sensor values, the training means
+        self.fill_values = None
         
     def preprocess_features(self, features):
         # Convert input features to numpy array
-        # Features should include: temperature, humidity, soil_moisture, days_planted, etc.
-        return np.array([[
-            features['temperature'],
-            features['humidity'],
-            features['soil_moisture'],
-            features['days_planted'],
-            features['light_intensity']
-        ]])
+        # Accepts one dict, a list of dicts or an array of FEATURES rows
+        if isinstance(features, dict):
+            features = [features]
+        if len(features) and isinstance(features[0], dict):
+            missing = sorted({name for row in features for name in self.features if name not in row})
+            if missing:
+                raise ValueError(f"Missing features: {missing}")
+            features = [[row[name] for name in self.features] for row in features]
+        X = np.array(features, dtype=np.float64).reshape(-1, len(self.features))
+        if self.fill_values is not None:
+            X = np.where(np.isnan(X), self.fill_values, X)
+        return X
     
-    def predict_stage(self, features):
-        # Preprocess features
-        X = self.preprocess_features(features)
+    def train(self, X, y):
+        """Fit the model on FEATURES rows and stage names"""
+        from model_search import build_model
         
+        X = np.asarray(X, dtype=np.float64)
+        unknown = sorted(set(np.asarray(y).tolist()) - set(self.stages))
+        if unknown:
+            raise ValueError(f"Unknown stages: {unknown}")
+        codes = np.array([self.stages.index(stage) for stage in np.asarray(y).tolist()])
+        
+        # Columns no training row has a value for are filled with 0
+        known = ~np.isnan(X)
+        self.fill_values = np.divide(np.where(known, X, 0.0).sum(axis=0), known.sum(axis=0),
+                                     out=np.zeros(X.shape[1]), where=known.any(axis=0))
+        self.model = build_model(self.params)
+        self.model.fit(self.preprocess_features(X), codes)
+        logger.info("Trained the sensor stage model on %d rows", len(X))
+        return self
+    
+    def predict_batch(self, features):
+        """(stage names, probabilities over self.stages) for many rows"""
+        X = self.preprocess_features(features)
+        probabilities = np.zeros((len(X), len(self.stages)))
+        if len(X):
+            probabilities[:, self.model.classes_] = self.model.predict_proba(X)
+        stages = np.asarray(self.stages, dtype=object)[probabilities.argmax(axis=1)]
+        return stages, probabilities
+    
+    def predict_stage(self, features):
         # Make prediction
-        prediction = self.model.predict(X)[0]
-        probability = self.model.predict_proba(X)[0]
+        stages, probabilities = self.predict_batch(features)
+        probability = probabilities[0]
         
         return {
-            'stage': self.stages[prediction],
+            'stage': stages[0],
             'confidence': float(max(probability)),
             'all_probabilities': {
                 stage: float(prob) for stage, prob in zip(self.stages, probability)
             }
         }
+    
+    def save_model(self, model_path=MODEL_FILE):
+        import joblib
+        
+        try:
+            joblib.dump({
+                'model': self.model,
+                'stages': self.stages,
+                'features': self.features,
+                'fill_values': self.fill_values,
+                'params': self.params
+            }, model_path)
+            return True
+        except Exception as e:
+            logger.error("Error saving model: %s", e)
+            return False
+    
+    def load_model(self, model_path=MODEL_FILE):
+        import joblib
+        
+        try:
+            saved_model = joblib.load(model_path)
+            self.model = saved_model['model']
+            self.stages = saved_model['stages']
+            self.features = saved_model['features']
+            self.fill_values = saved_model['fill_values']
+            self.params = saved_model.get('params', self.params)
+            return True
+        except Exception as e:
+            logger.error("Error loading model: %s", e)
+            return False
 
 def main():
+    parser = argparse.ArgumentParser(description='Predict a crop stage from sensor features')
+    parser.add_argument('features', type=str, help='JSON object of the model features')
+    parser.add_argument('--model', type=str, default=MODEL_FILE, help='Model trained by sensor_pipeline.py')
+    args = parser.parse_args()
+    
     # Read input features from command line
-    features = json.loads(sys.argv[1])
+    features = json.loads(args.features)
     
     # Initialize predictor
     predictor = CropStagePredictor()
+    if not predictor.load_model(args.model):
+        print(json.dumps({'error': 'No trained model; train one with sensor_pipeline.py train'}))
+        return
     
     # Make prediction
-    result = predictor.predict_stage(features)
+    try:
+        result = predictor.predict_stage(features)
+    except ValueError as e:
+        result = {'error': str(e)}
     
     # Output result as JSON
     print(json.dumps(result))
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -1,216 +1,1333 @@
-import pandas as pd
+import time
+_import_start = time.perf_counter()
+
 import numpy as np
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
-from sklearn.ensemble import RandomForestClassifier
-import joblib
 import os
 import json
 import argparse
+import logging
+import signal
 import sys
+from instrumentation import configure_logging, logger, metrics, report_progress
+from model_registry import DEFAULT_KEEP_VERSIONS, ModelRegistry, ModelWatcher, training_fingerprint
+
+metrics.observe('import', time.perf_counter() - _import_start)
+
+# Largest days_since_planting covered by the compiled stage lookup table
+DEFAULT_TABLE_MAX_DAY = 365
+
+FEATURE_COLUMNS = ['crop', 'days_since_planting']
+# Training data column whose values are ranked per (crop, stage) and
+# returned with predictions
+TASK_COLUMN = 'suggested_task'
+DEFAULT_N_ESTIMATORS = 100
+# See model_search.build_model for the parameters a model can be built from
+DEFAULT_MODEL_PARAMS = {'family': 'random_forest', 'n_estimators': DEFAULT_N_ESTIMATORS, 'random_state': 42}
+
+# Incremental updates add this many trees per delta; past MAX_TREES the
+# forest is compacted by a full retrain on the base data plus every
+# observation received so far.  Deltas with crops or stages the model has
+# not seen are refitted the same way, since the existing trees would
+# outvote the few new ones for them.
+DEFAULT_EXTRA_TREES = 10
+DEFAULT_MAX_TREES = 200
+OBSERVATIONS_FILE = 'stage_observations.jsonl'
+# Observed records count this many times in a full retrain, so bootstrap
+# samples almost always include them and they outweigh base rows for the
+# same crop and day
+OBSERVATION_WEIGHT = 5
+
+# Per-crop models (see train_crop_models) are single trees on
+# days_since_planting; crops with fewer training rows than
+# DEFAULT_MIN_CROP_SAMPLES are left to the global model
+DEFAULT_CROP_MODEL_PARAMS = {'family': 'decision_tree', 'random_state': 42}
+DEFAULT_MIN_CROP_SAMPLES = 20
+
+# Trained models are published to the model registry under this name; the
+# fixed model file is only read when nothing has been published yet
+MODEL_NAME = 'crop_stage'
+ARTIFACT_FILE = 'model.joblib'
+LEGACY_MODEL_FILE = 'crop_stage_model.joblib'
+
+def table_paths(model_file_path):
+    """Paths of the stage lookup table arrays stored next to a model file"""
+    base = os.path.splitext(model_file_path)[0]
+    return base + '.table_stages.npy', base + '.table_proba.npy'
+
+def task_path(model_file_path):
+    """Path of the (crop, stage) task index stored next to a model file"""
+    return os.path.splitext(model_file_path)[0] + '.tasks.json'
+
+def compiled_path(model_file_path):
+    """Directory of the compiled (sklearn-free) export stored next to a model file"""
+    return os.path.splitext(model_file_path)[0] + '.compiled'
+
+def resolve_model_path(registry):
+    """Model file of the registry's current version, or the legacy model file"""
+    directory = registry.current_dir(MODEL_NAME)
+    if directory is None:
+        return LEGACY_MODEL_FILE
+    return os.path.join(directory, ARTIFACT_FILE)
 
 class CropStagePredictor:
     def __init__(self):
         self.model = None
-        self.label_encoder = LabelEncoder()
-        self.crop_encoder = LabelEncoder()
+        # Encoders are fitted in load_data or restored by load_model
+        self.label_encoder = None
+        self.crop_encoder = None
         self.features = None
         self.target = None
+        # Training weight per row of features; see load_data
+        self.sample_weight = None
+        self.params = dict(DEFAULT_MODEL_PARAMS)
+        self.table_max_day = DEFAULT_TABLE_MAX_DAY
+        self.table_stages = None
+        self.table_proba = None
+        self.use_table = True
+        # {'params': ..., 'min_samples': ...} when a model per crop is
+        # trained next to the global one
+        self.per_crop = None
+        # crop -> stage -> [{"task", "count"}, ...], most frequent first
+        self.task_index = {}
+        # Provenance recorded with published versions
+        self.version = None
+        self.dataset_hash = None
+        self.accuracy = None
+        # Set only for models trained from scratch; see training_fingerprint
+        self.fingerprint = None
+        
+    def training_fingerprint(self, file_path, **settings):
+        """Fingerprint of a full training run on a dataset with the current parameters"""
+        from dataset_cache import dataset_hash, file_hash
+        from crop_encoder import ALIASES_FILE
+        
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        if os.path.exists(ALIASES_FILE):
+            settings['crop_aliases'] = file_hash(ALIASES_FILE)
+        return training_fingerprint(dataset_hash(os.path.join(current_dir, file_path)), self.params,
+                                    FEATURE_COLUMNS, table_max_day=self.table_max_day, **settings)
+    
+    def load_data(self, file_path, extra_records=None, keep_encoders=False):
+        """Load and preprocess the dataset, plus any extra labelled records
+
+        Extra records are weighted OBSERVATION_WEIGHT in train_model.
+        keep_encoders encodes the data with the loaded model's encoders
+        instead of fitting new ones, so it lines up with that model.
+        """
+        # Training-only dependencies are imported here to keep the predict path light
+        import pandas as pd
+        from sklearn.preprocessing import LabelEncoder
+        from crop_encoder import CropEncoder, load_aliases
+        from dataset_cache import dataset_hash, load_dataset
         
-    def load_data(self, file_path):
-        """Load and preprocess the dataset"""
         try:
             # Get the absolute path to the dataset
             current_dir = os.path.dirname(os.path.abspath(__file__))
-            dataset_path = os.path.join(current_dir, 'farmer_guide_crop_dataset.xlsx')
-            print(f"Loading dataset from: {dataset_path}", file=sys.stderr)
+            dataset_path = os.path.join(current_dir, file_path)
+            logger.info("Loading dataset from: %s", dataset_path)
+            report_progress('loading_data', 0.1)
+            
+            df = load_dataset(dataset_path)
+            self.dataset_hash = dataset_hash(dataset_path)
+            self.sample_weight = np.ones(len(df))
+            if extra_records:
+                columns = FEATURE_COLUMNS + ['stage'] + ([TASK_COLUMN] if TASK_COLUMN in df.columns else [])
+                extra = pd.DataFrame(extra_records, columns=columns)
+                df = pd.concat([df[columns].astype(object), extra], ignore_index=True)
+                self.sample_weight = np.concatenate([self.sample_weight,
+                                                     np.full(len(extra), float(OBSERVATION_WEIGHT))])
+            
+            # Rebuilt from scratch on every full retrain
+            self.task_index = {}
+            if TASK_COLUMN in df.columns:
+                labelled = df[df[TASK_COLUMN].notna()]
+                # Keyed like the crop encoder's classes, which predictions look tasks up by
+                self.task_index = add_task_counts({}, zip(
+                    labelled['crop'].astype(str),
+                    labelled['stage'].astype(str),
+                    labelled[TASK_COLUMN].astype(str).str.strip()
+                ))
             
-            df = pd.read_excel(dataset_path)
             # Use only 'crop' and 'days_since_planting' as features
-            self.features = df[['crop', 'days_since_planting']].copy()
-            self.target = df['stage']
+            self.features = df[FEATURE_COLUMNS].copy()
+            self.target = df['stage'].astype(str)
+            if not keep_encoders or self.crop_encoder is None:
+                self.label_encoder = LabelEncoder()
+                self.crop_encoder = CropEncoder(aliases=load_aliases())
+                self.label_encoder.fit(self.target)
+                self.crop_encoder.fit(self.features['crop'].astype(str))
 
             # Encode 'crop' as categorical
             self.features['crop'] = self.features['crop'].astype(str)
-            self.crop_encoder.fit(self.features['crop'])
+            self.features['days_since_planting'] = self.features['days_since_planting'].astype(int)
             self.features['crop'] = self.crop_encoder.transform(self.features['crop'])
 
             # Encode the target variable
-            self.target = self.label_encoder.fit_transform(self.target)
+            self.target = self.label_encoder.transform(self.target)
             return True
         except Exception as e:
-            print(f"Error loading data: {str(e)}", file=sys.stderr)
+            logger.error("Error loading data: %s", e)
             return False
     
-    def train_model(self):
-        """Train the Random Forest model"""
+    def train_model(self, params=None, workers=None):
+        """Train the model, a Random Forest unless params name another family
+
+        With per_crop set, a model per crop is trained as well, in up to
+        ``workers`` processes, and predictions are routed to it.
+        """
         if self.features is None or self.target is None:
             return False
         
+        from sklearn.model_selection import train_test_split
+        from model_search import build_model
+        from weighted_samples import fit_weighted
+        
+        if params is not None:
+            self.params = dict(DEFAULT_MODEL_PARAMS, **params)
+        
         # Split the data
-        X_train, X_test, y_train, y_test = train_test_split(
-            self.features, self.target, test_size=0.2, random_state=42
+        sample_weight = self.sample_weight if self.sample_weight is not None else np.ones(len(self.target))
+        X_train, X_test, y_train, y_test, weight_train, _ = train_test_split(
+            self.features, self.target, sample_weight, test_size=0.2, random_state=42
         )
         
-        # Initialize and train the model
-        self.model = RandomForestClassifier(n_estimators=100, random_state=42)
-        self.model.fit(X_train, y_train)
+        report_progress('training', 0.2)
+        # Initialize and train the model; repeated observations are fitted
+        # once, weighted by how often they occur, where that grows the same
+        # trees (see weighted_samples.fit_weighted)
+        self.model = build_model(self.params)
+        fit_weighted(self.model, X_train, y_train, weight_train)
+        
+        if self.per_crop is not None:
+            from forest_runtime import CropRouter
+            
+            self.model = CropRouter(self.model, self.train_crop_models(X_train.to_numpy(), np.asarray(y_train),
+                                                                       self.model.classes_, workers=workers))
         
         # Calculate and print accuracy
-        accuracy = self.model.score(X_test, y_test)
-        print(f"Model accuracy: {accuracy:.2f}", file=sys.stderr)
+        self.accuracy = float((self.model.predict(X_test.to_numpy()) == np.asarray(y_test)).mean())
+        self.fingerprint = None
+        logger.info("Model accuracy: %.2f", self.accuracy)
         return True
     
+    def train_crop_models(self, X, y, classes, crop_codes=None, workers=None):
+        """Fit one small model per crop with enough rows, in a process pool
+
+        Returns {crop code: model}.  Each model sees only its crop's rows and
+        keeps the global model's classes, with absent stages added as
+        zero-weight rows.  crop_codes limits training to those crops.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        
+        settings = self.per_crop or {}
+        params = dict(DEFAULT_CROP_MODEL_PARAMS, **settings.get('params', {}))
+        min_samples = settings.get('min_samples', DEFAULT_MIN_CROP_SAMPLES)
+        codes, counts = np.unique(X[:, 0].astype(np.int64), return_counts=True)
+        eligible = [code for code, count in zip(codes.tolist(), counts.tolist()) if count >= min_samples]
+        if crop_codes is not None:
+            wanted = set(crop_codes)
+            eligible = [code for code in eligible if code in wanted]
+        
+        report_progress('training_crop_models', 0.6)
+        models = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {code: pool.submit(fit_crop_model, params, X[X[:, 0] == code], y[X[:, 0] == code], classes)
+                       for code in eligible}
+            for code, future in futures.items():
+                models[code] = future.result()
+        logger.info("Trained %d crop models; %d crops fall back to the global model",
+                    len(models), len(codes) - len(models))
+        return models
+    
+    def retrain_crops(self, crop_names, workers=None):
+        """Refit the models of the given crops only, on the data from load_data
+
+        Names must be known crops or aliases; fuzzy matches are not accepted
+        here.  Returns the canonical names of the crops whose model was
+        replaced.
+        """
+        from sklearn.model_selection import train_test_split
+        from crop_encoder import normalize_name
+        
+        if not hasattr(self.model, 'specialists') or self.model.arrays is not None:
+            raise ValueError("Retraining single crops needs a model trained with --per-crop")
+        codes = [self.crop_encoder.index.get(normalize_name(name)) for name in crop_names]
+        unknown = [name for name, code in zip(crop_names, codes) if code is None]
+        if unknown:
+            raise ValueError(f"Unknown crops: {', '.join(unknown)}")
+        # The same split train_model fitted and scored on
+        X_train, X_test, y_train, y_test = train_test_split(self.features, self.target, test_size=0.2,
+                                                            random_state=42)
+        models = self.train_crop_models(X_train.to_numpy(), np.asarray(y_train), self.model.classes_, codes, workers)
+        self.model.specialists.update(models)
+        self.accuracy = float((self.model.predict(X_test.to_numpy()) == np.asarray(y_test)).mean())
+        self.fingerprint = None
+        logger.info("Model accuracy after retraining: %.2f", self.accuracy)
+        return [str(self.crop_encoder.classes_[code]) for code in sorted(models)]
+    
+    def compress(self, max_accuracy_loss=None, max_depth=None, distill=False):
+        """Shrink the trained model within an accuracy budget and report the change
+
+        Trees are selected to reproduce the forest over every known crop and
+        day up to table_max_day; the budget is checked on one half of the
+        held-out split train_model scores on, and accuracy is reported on the
+        other half.  With distill, a single tree of per-crop day
+        intervals replaces the forest if it also stays within the budget.
+        The compressed model predicts like any other but cannot be updated.
+        """
+        if self.model is None or self.features is None or self.target is None:
+            return None
+        if hasattr(self.model, 'specialists'):
+            logger.error("Per-crop models are compressed by training them smaller, not by --compress")
+            return None
+        
+        from sklearn.model_selection import train_test_split
+        from forest_compression import (DEFAULT_MAX_ACCURACY_LOSS, accuracy, compress_forest, interval_tree,
+                                        model_summary, split_holdout)
+        from forest_runtime import CompiledForest
+        
+        if max_accuracy_loss is None:
+            max_accuracy_loss = DEFAULT_MAX_ACCURACY_LOSS
+        _, X_test, _, y_test = train_test_split(self.features, self.target, test_size=0.2, random_state=42)
+        X_select, y_select, X_report, y_report = split_holdout(X_test, y_test)
+        
+        report_progress('compressing', 0.7)
+        before = model_summary(self.model, X_report, y_report)
+        min_accuracy = accuracy(self.model, X_select, y_select) - max_accuracy_loss
+        grid = self.day_grid()
+        grid_stages = self.model.predict(grid)
+        compressed = compress_forest(self.model, grid, X_select, y_select, max_accuracy_loss, max_depth)
+        report = {"max_accuracy_loss": max_accuracy_loss, "before": before}
+        
+        if distill:
+            probabilities = self.model.predict_proba(grid).reshape(len(self.crop_encoder.classes_), -1,
+                                                                   len(self.model.classes_))
+            distilled = CompiledForest(interval_tree(probabilities, self.model.classes_),
+                                       {'n_features': len(FEATURE_COLUMNS)})
+            accepted = accuracy(distilled, X_select, y_select) >= min_accuracy
+            report['distilled'] = {"accuracy": accuracy(distilled, X_report, y_report), "accepted": accepted}
+            if accepted:
+                compressed = distilled
+        
+        self.model = compressed
+        report['after'] = model_summary(self.model, X_report, y_report)
+        # Share of the (crop, day) grid where the best stage did not change
+        report['grid_agreement'] = float((self.model.predict(grid) == grid_stages).mean())
+        self.accuracy = report['after']['accuracy']
+        self.fingerprint = None
+        logger.info("Compressed the model from %d to %d nodes; accuracy %.3f -> %.3f", before['nodes'],
+                    report['after']['nodes'], before['accuracy'], self.accuracy)
+        return report
+    
+    def supports_update(self):
+        """Whether the loaded model can grow extra trees; compressed and per-crop models cannot"""
+        return self.model is not None and hasattr(self.model, 'estimators_')
+    
+    def unseen_classes(self, records):
+        """Crops and stages of cleaned records that the loaded model has not learned
+
+        A stage counts as unseen when the model does not know it or gives it
+        no probability at the record's crop and day.
+        """
+        stage_codes = {stage: code for code, stage in enumerate(self.label_encoder.classes_.tolist())}
+        crops = sorted({record['crop'] for record in records if record['crop'] not in self.crop_encoder.index})
+        stages = {record['stage'] for record in records if record['stage'] not in stage_codes}
+        known = [record for record in records
+                 if record['crop'] in self.crop_encoder.index and record['stage'] in stage_codes]
+        if known:
+            X = np.column_stack([self.encode_crops([record['crop'] for record in known]),
+                                 [record['days_since_planting'] for record in known]])
+            columns = {code: column for column, code in enumerate(np.asarray(self.model.classes_).tolist())}
+            probabilities = self.model.predict_proba(X)
+            for row, record in zip(probabilities, known):
+                column = columns.get(stage_codes[record['stage']])
+                if column is None or row[column] == 0:
+                    stages.add(record['stage'])
+        return crops, sorted(stages)
+    
+    def update_model(self, records, extra_trees=DEFAULT_EXTRA_TREES):
+        """Grow the loaded forest with extra trees fitted only on new labelled records
+
+        The records' crops and stages must all be known to the model (see
+        unseen_classes); a handful of new trees cannot outvote the existing
+        ones for a class those never predict, so such records need a full
+        retrain instead.  Returns the number of records used.
+        """
+        from weighted_samples import fit_weighted
+        
+        if not self.supports_update():
+            raise ValueError("The current model is compressed or per-crop and cannot be updated "
+                             "incrementally; use --compact to retrain it with the new records")
+        
+        records = clean_observations(records)
+        if not records:
+            return 0
+        crops, stages = self.unseen_classes(records)
+        if crops or stages:
+            raise ValueError(f"Records with unseen crops {crops} or stages {stages} need a full retrain")
+        
+        crops = np.array([record['crop'] for record in records], dtype=object)
+        stages = np.array([record['stage'] for record in records], dtype=object)
+        days = np.array([record['days_since_planting'] for record in records])
+        n_classes = len(self.label_encoder.classes_)
+        
+        X = np.column_stack([self.encode_crops(crops), days])
+        y = self.label_encoder.transform(stages)
+        sample_weight = np.ones(len(y))
+        
+        # Every stage must appear in the fit so the new trees share the old
+        # trees' class layout; stages absent from the delta get zero-weight rows
+        missing = np.setdiff1d(np.arange(n_classes), y)
+        if len(missing):
+            X = np.vstack([X, np.repeat(X[:1], len(missing), axis=0)])
+            y = np.concatenate([y, missing])
+            sample_weight = np.concatenate([sample_weight, np.zeros(len(missing))])
+        
+        self.task_index = add_task_counts(self.task_index, (
+            (record['crop'], record['stage'], record[TASK_COLUMN]) for record in records if TASK_COLUMN in record
+        ))
+        
+        report_progress('updating', 0.3)
+        self.model.set_params(warm_start=True, n_estimators=len(self.model.estimators_) + extra_trees)
+        fit_weighted(self.model, X, y, sample_weight)
+        self.model.set_params(warm_start=False)
+        self.fingerprint = None
+        logger.info("Added %d trees for %d new records; forest now has %d",
+                    extra_trees, len(records), len(self.model.estimators_))
+        return len(records)
+    
     def predict_stage(self, features):
         """Predict crop stage for new data"""
         if self.model is None:
-            print("Model is not loaded", file=sys.stderr)
+            logger.error("Model is not loaded")
             return None
         
         try:
-            # Convert crop name to lowercase and trim
-            crop_name = features['crop'].lower().strip()
-            days = int(features['days_since_planting'])
-            
-            # Transform crop name using the saved encoder
-            try:
-                crop_encoded = self.crop_encoder.transform([crop_name])[0]
-            except ValueError:
-                print(f"Unknown crop: {crop_name}", file=sys.stderr)
+            result = self.predict_batch([features])[0]
+            if 'error' in result:
+                logger.warning(result['error'])
                 return None
             
-            # Create feature array
-            feature_array = np.array([[crop_encoded, days]])
-            print(f"Feature array: {feature_array}", file=sys.stderr)
-            
-            # Make prediction
-            prediction = self.model.predict(feature_array)
-            # Get prediction probabilities
-            probabilities = self.model.predict_proba(feature_array)[0]
-            
-            # Convert prediction back to original label
-            stage = self.label_encoder.inverse_transform(prediction)[0]
-            
-            # Create probability dictionary
-            all_probabilities = {}
-            for i, label in enumerate(self.label_encoder.classes_):
-                all_probabilities[label] = float(probabilities[i])
-            
-            result = {
-                "stage": stage,
-                "confidence": float(probabilities[prediction[0]]),
-                "all_probabilities": all_probabilities
-            }
-            
-            print(f"Prediction result: {json.dumps(result)}", file=sys.stderr)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Prediction result: %s", json.dumps(result))
             return result
             
         except Exception as e:
-            print(f"Error during prediction: {str(e)}", file=sys.stderr)
+            logger.error("Error during prediction: %s", e)
             return None
     
+    def encode_crops(self, crop_names):
+        """Encode raw crop names in one pass, using -1 for unknown crops"""
+        return self.crop_encoder.encode(crop_names)
+    
+    def _stage_probabilities(self, crop_codes, days):
+        """Best class index and probability rows, from the lookup table where it covers the day"""
+        if self.use_table and self.table_proba is not None:
+            in_table = (days >= 0) & (days <= self.table_max_day)
+        else:
+            in_table = np.zeros(len(days), dtype=bool)
+        
+        n_classes = len(self.model.classes_)
+        best = np.empty(len(days), dtype=np.int64)
+        probabilities = np.empty((len(days), n_classes), dtype=np.float64)
+        metrics.incr('table_rows_total', int(in_table.sum()))
+        metrics.incr('forest_rows_total', int(len(days) - in_table.sum()))
+        if in_table.any():
+            best[in_table] = self.table_stages[crop_codes[in_table], days[in_table]]
+            probabilities[in_table] = self.table_proba[crop_codes[in_table], days[in_table]]
+        
+        outside = ~in_table
+        if outside.any():
+            # Days the table does not cover fall back to the forest
+            feature_array = np.column_stack([crop_codes[outside], days[outside]])
+            forest_probabilities = self.model.predict_proba(feature_array)
+            probabilities[outside] = forest_probabilities
+            best[outside] = forest_probabilities.argmax(axis=1)
+        return best, probabilities
+    
+    def day_grid(self):
+        """(crop code, day) rows for every known crop and day up to table_max_day, crop-major"""
+        n_crops = len(self.crop_encoder.classes_)
+        n_days = self.table_max_day + 1
+        return np.column_stack([
+            np.repeat(np.arange(n_crops), n_days),
+            np.tile(np.arange(n_days), n_crops)
+        ])
+    
+    def compile_table(self, max_day=None):
+        """Evaluate the model once over every known crop and day up to max_day"""
+        if self.model is None:
+            return False
+        if max_day is not None:
+            self.table_max_day = max_day
+        
+        probabilities = self.model.predict_proba(self.day_grid())
+        self.table_proba = probabilities.reshape(len(self.crop_encoder.classes_), self.table_max_day + 1, -1)
+        self.table_stages = self.table_proba.argmax(axis=2).astype(np.int16)
+        return True
+    
+    def predict_batch(self, records):
+        """Predict crop stages for many records with one model evaluation
+
+        Returns one entry per record, in order: the same prediction dict that
+        ``predict_stage`` returns, or ``{"error": ...}`` for a record that
+        could not be scored.
+        """
+        if self.model is None:
+            return [{"error": "Model is not loaded"} for _ in records]
+        
+        results = [None] * len(records)
+        rows, crop_names, days = [], [], []
+        for i, record in enumerate(records):
+            try:
+                crop_name = str(record['crop'])
+                day = int(record['days_since_planting'])
+            except (KeyError, TypeError, ValueError) as e:
+                results[i] = {"error": f"Invalid record: {str(e)}"}
+                continue
+            rows.append(i)
+            crop_names.append(crop_name)
+            days.append(day)
+        
+        with metrics.span('encode'):
+            crop_codes = self.encode_crops(crop_names)
+        known = crop_codes >= 0
+        for position in np.flatnonzero(~known):
+            results[rows[position]] = {"error": f"Unknown crop: {crop_names[position]}"}
+        
+        if known.any():
+            with metrics.span('predict_proba'):
+                best, probabilities = self._stage_probabilities(crop_codes[known], np.asarray(days)[known])
+            stage_names = self.label_encoder.classes_[self.model.classes_].tolist()
+            crop_classes = self.crop_encoder.classes_.tolist()
+            
+            known_positions = np.flatnonzero(known).tolist()
+            known_codes = crop_codes[known].tolist()
+            for position, code, best_index, row_probabilities in zip(known_positions, known_codes, best.tolist(),
+                                                                     probabilities.tolist()):
+                crop = crop_classes[code]
+                stage = stage_names[best_index]
+                results[rows[position]] = {
+                    "crop": crop,
+                    "stage": stage,
+                    "confidence": row_probabilities[best_index],
+                    "all_probabilities": dict(zip(stage_names, row_probabilities)),
+                    "suggested_tasks": self.task_index.get(crop, {}).get(stage, [])
+                }
+        
+        errors = sum(1 for result in results if 'error' in result)
+        metrics.incr('predictions_total', len(results) - errors)
+        metrics.incr('prediction_errors_total', errors)
+        return results
+    
     def save_model(self, model_path):
-        """Save the trained model"""
+        """Save the trained model, its compiled export and its stage lookup table"""
+        import joblib
+        
         if self.model is None:
             return False
         
         try:
             # Get the absolute path for saving the model
             current_dir = os.path.dirname(os.path.abspath(__file__))
-            model_file_path = os.path.join(current_dir, 'crop_stage_model.joblib')
-            print(f"Saving model to: {model_file_path}", file=sys.stderr)
+            model_file_path = os.path.join(current_dir, model_path)
+            logger.info("Saving model to: %s", model_file_path)
+            
+            self.compile_table()
+            stages_path, proba_path = table_paths(model_file_path)
+            np.save(stages_path, self.table_stages)
+            np.save(proba_path, self.table_proba)
+            with open(task_path(model_file_path), 'w') as f:
+                json.dump(self.task_index, f)
             
             joblib.dump({
                 'model': self.model,
                 'label_encoder': self.label_encoder,
                 'crop_encoder': self.crop_encoder,
-                'features': self.features.columns.tolist()
+                'features': FEATURE_COLUMNS,
+                'params': self.params,
+                'table_max_day': self.table_max_day,
+                'dataset_hash': self.dataset_hash,
+                'accuracy': self.accuracy,
+                'fingerprint': self.fingerprint,
+                'per_crop': self.per_crop
             }, model_file_path)
+            self.export_compiled(model_file_path)
             return True
         except Exception as e:
-            print(f"Error saving model: {str(e)}", file=sys.stderr)
+            logger.error("Error saving model: %s", e)
             return False
     
-    def load_model(self, model_path):
-        """Load a saved model"""
+    def export_compiled(self, model_file_path):
+        """Write the forest and encoders as NumPy arrays that load without sklearn"""
+        from forest_runtime import export_compiled
+        
+        return export_compiled(self.model, compiled_path(model_file_path), extra_arrays={
+            'crop_classes': self.crop_encoder.classes_,
+            'stage_classes': self.label_encoder.classes_
+        }, meta={
+            'features': FEATURE_COLUMNS,
+            'params': self.params,
+            'table_max_day': self.table_max_day,
+            'dataset_hash': self.dataset_hash,
+            'accuracy': self.accuracy,
+            'fingerprint': self.fingerprint,
+            'per_crop': self.per_crop,
+            'crop_aliases': getattr(self.crop_encoder, 'aliases', {})
+        })
+    
+    def load_model(self, model_path, runtime='sklearn'):
+        """Load a saved model
+        
+        runtime='compiled' loads the NumPy export instead of the joblib
+        pickle; such a model can predict but not be updated or retrained.
+        """
         try:
             # Get the absolute path for loading the model
             current_dir = os.path.dirname(os.path.abspath(__file__))
-            model_file_path = os.path.join(current_dir, 'crop_stage_model.joblib')
-            print(f"Loading model from: {model_file_path}", file=sys.stderr)
+            model_file_path = os.path.join(current_dir, model_path)
+            
+            if runtime == 'compiled':
+                if os.path.isdir(compiled_path(model_file_path)):
+                    return self.load_compiled(model_file_path)
+                logger.warning("No compiled export next to %s; loading the joblib model", model_file_path)
+            
+            import joblib
             
-            saved_data = joblib.load(model_file_path)
+            logger.info("Loading model from: %s", model_file_path)
+            with metrics.span('model_load'):
+                saved_data = joblib.load(model_file_path)
             self.model = saved_data['model']
             self.label_encoder = saved_data['label_encoder']
             
             # Handle the case where crop_encoder might not exist in older models
             if 'crop_encoder' in saved_data:
                 self.crop_encoder = saved_data['crop_encoder']
+                if not hasattr(self.crop_encoder, 'encode'):
+                    # Models saved with a LabelEncoder keep their codes
+                    from crop_encoder import CropEncoder, load_aliases
+                    self.crop_encoder = CropEncoder(self.crop_encoder.classes_, load_aliases())
             else:
                 # If crop_encoder doesn't exist, we need to retrain the model
-                print("Crop encoder not found in saved model. Please retrain the model.", file=sys.stderr)
+                logger.error("Crop encoder not found in saved model. Please retrain the model.")
                 return False
                 
             self.features = saved_data['features']
+            self.params = saved_data.get('params', dict(DEFAULT_MODEL_PARAMS))
+            self.dataset_hash = saved_data.get('dataset_hash')
+            self.accuracy = saved_data.get('accuracy')
+            self.fingerprint = saved_data.get('fingerprint')
+            self.per_crop = saved_data.get('per_crop')
+            self.load_table(model_file_path, saved_data.get('table_max_day'))
+            self.load_tasks(model_file_path)
             return True
         except Exception as e:
-            print(f"Error loading model: {str(e)}", file=sys.stderr)
+            logger.error("Error loading model: %s", e)
             return False
+    
+    def load_compiled(self, model_file_path):
+        """Load the compiled export of a model file and its lookup table"""
+        from crop_encoder import CropEncoder
+        from forest_runtime import CompiledForest, FittedLabels
+        
+        directory = compiled_path(model_file_path)
+        logger.info("Loading compiled model from: %s", directory)
+        with metrics.span('model_load'):
+            self.model = CompiledForest.load(directory)
+        self.crop_encoder = CropEncoder(self.model.arrays['crop_classes'], self.model.meta.get('crop_aliases'))
+        self.label_encoder = FittedLabels(self.model.arrays['stage_classes'])
+        self.features = self.model.meta.get('features', FEATURE_COLUMNS)
+        self.params = self.model.meta.get('params', dict(DEFAULT_MODEL_PARAMS))
+        self.dataset_hash = self.model.meta.get('dataset_hash')
+        self.accuracy = self.model.meta.get('accuracy')
+        self.fingerprint = self.model.meta.get('fingerprint')
+        self.per_crop = self.model.meta.get('per_crop')
+        self.load_table(model_file_path, self.model.meta.get('table_max_day'))
+        self.load_tasks(model_file_path)
+        return True
+    
+    def publish(self, registry, activate=True, **metadata):
+        """Save the model as a new registry version and return its id, or None"""
+        import shutil
+        from forest_runtime import tree_count
+        
+        report_progress('publishing', 0.9)
+        staging = registry.stage(MODEL_NAME)
+        if not self.save_model(os.path.join(staging, ARTIFACT_FILE)):
+            shutil.rmtree(staging, ignore_errors=True)
+            return None
+        self.version = registry.publish(MODEL_NAME, staging, dict(
+            metadata,
+            dataset_hash=self.dataset_hash,
+            params=self.params,
+            accuracy=self.accuracy,
+            fingerprint=self.fingerprint,
+            n_trees=tree_count(self.model),
+            table_max_day=self.table_max_day
+        ), activate=activate)
+        return self.version
+    
+    def load_tasks(self, model_file_path):
+        """Read the task index saved with the model; older models have none"""
+        try:
+            with open(task_path(model_file_path)) as f:
+                # Re-keyed in case the file predates normalize_name keys
+                self.task_index = add_task_counts(json.load(f), ())
+        except FileNotFoundError:
+            self.task_index = {}
+    
+    def load_table(self, model_file_path, max_day):
+        """Memory-map the lookup table saved with the model, if it matches it"""
+        self.table_stages = None
+        self.table_proba = None
+        stages_path, proba_path = table_paths(model_file_path)
+        if max_day is None or not (os.path.exists(stages_path) and os.path.exists(proba_path)):
+            return False
+        
+        table_stages = np.load(stages_path, mmap_mode='r')
+        table_proba = np.load(proba_path, mmap_mode='r')
+        expected = (len(self.crop_encoder.classes_), max_day + 1, len(self.model.classes_))
+        if table_proba.shape != expected or table_stages.shape != expected[:2]:
+            logger.warning("Stage lookup table does not match the model; using the forest")
+            return False
+        
+        self.table_max_day = max_day
+        self.table_stages = table_stages
+        self.table_proba = table_proba
+        return True
 
-def main():
-    parser = argparse.ArgumentParser(description='Crop Stage Predictor')
-    parser.add_argument('--train', action='store_true', help='Train the model')
-    parser.add_argument('--predict', type=str, help='Make a prediction with the given features')
-    args = parser.parse_args()
+def clean_observations(records):
+    """Normalize labelled records, dropping any without a crop, day and stage"""
+    from crop_encoder import normalize_name
+    
+    cleaned = []
+    for record in records:
+        try:
+            crop = normalize_name(record['crop'])
+            stage = str(record['stage']).strip()
+            day = int(record['days_since_planting'])
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Skipping invalid observation: %s", record)
+            continue
+        if crop and stage:
+            entry = {'crop': crop, 'days_since_planting': day, 'stage': stage}
+            task = str(record.get(TASK_COLUMN) or '').strip()
+            if task:
+                entry[TASK_COLUMN] = task
+            cleaned.append(entry)
+    return cleaned
+
+def add_task_counts(index, rows):
+    """Fold (crop, stage, task) rows into a task index, keeping each list ranked
+
+    Crop keys are normalized with crop_encoder.normalize_name, as the
+    encoder's class names are.
+    """
+    from crop_encoder import normalize_name
+    
+    counts = {}
+    for crop, stages in index.items():
+        for stage, tasks in stages.items():
+            for entry in tasks:
+                key = (normalize_name(crop), stage, entry['task'])
+                counts[key] = counts.get(key, 0) + entry['count']
+    for crop, stage, task in rows:
+        key = (normalize_name(crop), stage, task)
+        counts[key] = counts.get(key, 0) + 1
+    
+    ranked = {}
+    for (crop, stage, task), count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+        ranked.setdefault(crop, {}).setdefault(stage, []).append({"task": task, "count": count})
+    return ranked
+
+def fit_crop_model(params, X, y, classes):
+    """Fit one crop's model on its rows, over the global model's classes"""
+    from model_search import build_model
+    from weighted_samples import fit_weighted
+    
+    missing = np.setdiff1d(classes, y)
+    X = np.vstack([X, np.repeat(X[:1], len(missing), axis=0)])
+    y = np.concatenate([y, missing])
+    sample_weight = np.concatenate([np.ones(len(y) - len(missing)), np.zeros(len(missing))])
+    return fit_weighted(build_model(params), X, y, sample_weight)
+
+def read_observations(path):
+    """Read labelled records from a JSONL file"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.warning("Skipping invalid JSON line: %s", line)
+    return records
+
+def append_observations(path, records):
+    """Keep accepted records so later compactions retrain on them"""
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+def handle_request(predictor, message):
+    """Answer a single serve-mode request"""
+    if not isinstance(message, dict):
+        return {"id": None, "success": False, "error": "Request must be a JSON object"}
+
+    request_id = message.get('id')
+    request_type = message.get('type', 'predict')
+    metrics.incr(f'{request_type}_requests_total')
+
+    if request_type == 'ping':
+        return {
+            "id": request_id,
+            "success": True,
+            "type": "pong",
+            "model_loaded": predictor.model is not None,
+            "model_version": predictor.version
+        }
+
+    if request_type == 'predict':
+        if predictor.model is None:
+            return {"id": request_id, "success": False, "error": "Failed to load model"}
+        try:
+            prediction = predictor.predict_stage(message.get('features') or {})
+        except Exception as e:
+            return {"id": request_id, "success": False, "error": str(e)}
+        if prediction:
+            return {"id": request_id, "success": True, "prediction": prediction}
+        return {"id": request_id, "success": False, "error": "Failed to make prediction"}
+
+    if request_type == 'metrics':
+        if message.get('format') == 'prometheus':
+            return {"id": request_id, "success": True, "metrics": metrics.prometheus()}
+        return {"id": request_id, "success": True, "metrics": metrics.snapshot()}
+
+    if request_type == 'predict_batch':
+        if predictor.model is None:
+            return {"id": request_id, "success": False, "error": "Failed to load model"}
+        records = message.get('records')
+        if not isinstance(records, list):
+            return {"id": request_id, "success": False, "error": "predict_batch requires a list of records"}
+        return {
+            "id": request_id,
+            "success": True,
+            "predictions": batch_entries(predictor.predict_batch(records))
+        }
+
+    return {"id": request_id, "success": False, "error": f"Unknown request type: {request_type}"}
 
+def batch_entries(results, start=0):
+    """Turn predict_batch results into indexed success/error entries"""
+    entries = []
+    for index, result in enumerate(results, start):
+        if 'error' in result:
+            entries.append({"index": index, "success": False, "error": result['error']})
+        else:
+            entries.append({"index": index, "success": True, "prediction": result})
+    return entries
+
+def predict_batch_stream(predictor, input_stream, output_stream, batch_size=10000):
+    """Score a JSON array or a JSONL stream of records
+
+    A JSON array is answered with a single JSON object; a JSONL stream is read
+    and answered ``batch_size`` lines at a time, one JSON line per record.
+    """
+    first = input_stream.read(1)
+    while first and first.isspace():
+        first = input_stream.read(1)
+
+    if first == '[':
+        records = json.loads(first + input_stream.read())
+        output_stream.write(json.dumps({
+            "success": True,
+            "predictions": batch_entries(predictor.predict_batch(records))
+        }) + "\n")
+        return
+
+    def score(lines, start):
+        records, entries = [], {}
+        for offset, line in enumerate(lines):
+            try:
+                records.append((offset, json.loads(line)))
+            except ValueError as e:
+                entries[offset] = {"index": start + offset, "success": False, "error": f"Invalid JSON: {str(e)}"}
+        results = predictor.predict_batch([record for _, record in records])
+        for (offset, _), result in zip(records, results):
+            entries[offset] = batch_entries([result], start + offset)[0]
+        for offset in range(len(lines)):
+            output_stream.write(json.dumps(entries[offset]) + "\n")
+
+    lines, start = [], 0
+    for line in _prepend(first, input_stream):
+        if not line.strip():
+            continue
+        lines.append(line)
+        if len(lines) >= batch_size:
+            score(lines, start)
+            start += len(lines)
+            lines = []
+    if lines:
+        score(lines, start)
+
+def _prepend(first, input_stream):
+    """Yield the lines of a stream whose first character was already consumed"""
+    if not first:
+        return
+    yield first + input_stream.readline()
+    yield from iter(input_stream.readline, '')
+
+def load_version(directory, runtime='sklearn', use_table=True):
+    """A predictor for one registry version directory, or None if it fails to load"""
     predictor = CropStagePredictor()
-    model_path = "crop_stage_model.joblib"
-
-    if args.train:
-        # Train the model
-        if predictor.load_data("farmer_guide_crop_dataset.xlsx"):
-            if predictor.train_model():
-                predictor.save_model(model_path)
-                print(json.dumps({"status": "success", "message": "Model trained successfully"}))
+    predictor.use_table = use_table
+    if not predictor.load_model(os.path.join(directory, ARTIFACT_FILE), runtime):
+        return None
+    predictor.version = os.path.basename(directory)
+    return predictor
+
+def serve(predictor, input_stream=None, output_stream=None, watcher=None):
+    """Answer newline-delimited JSON requests until shutdown or end of input
+
+    Each request is a JSON object with an optional ``id`` that is echoed back in
+    the response, and a ``type`` of ``predict`` (the default), ``ping`` or
+    ``shutdown``, or ``metrics`` (with ``"format": "prometheus"`` for the
+    text exposition format); ``predict_batch`` requests carry a ``records`` list instead
+    of ``features``.  One JSON response is written per line.
+
+    With a ``watcher`` (a model_registry.ModelWatcher) each request is
+    answered by the newest loaded version, falling back to ``predictor``.
+    """
+    input_stream = input_stream or sys.stdin
+    output_stream = output_stream or sys.stdout
+
+    def respond(response):
+        with metrics.span('serialize'):
+            line = json.dumps(response)
+        output_stream.write(line + "\n")
+        output_stream.flush()
+
+    for line in iter(input_stream.readline, ''):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            message = json.loads(line)
+        except ValueError as e:
+            respond({"id": None, "success": False, "error": f"Invalid JSON: {str(e)}"})
+            continue
+
+        if isinstance(message, dict) and message.get('type') == 'shutdown':
+            respond({"id": message.get('id'), "success": True, "type": "shutdown"})
+            break
+
+        current = watcher.model if watcher is not None and watcher.model is not None else predictor
+        respond(handle_request(current, message))
+
+def profile_startup_command(args, predictor, registry, model_path):
+    """Report where the --predict path spends its startup time"""
+    from startup_profile import profile_command
+    features = args.predict or json.dumps({"crop": "paddy", "days_since_planting": 30})
+    # The profiled run loads the same model the same way this one would
+    command = [os.path.abspath(__file__), '--predict', features, '--runtime', args.runtime,
+               '--engine', args.engine, '--table-max-day', str(args.table_max_day)]
+    if args.registry:
+        command += ['--registry', os.path.abspath(args.registry)]
+    if args.log_level:
+        command += ['--log-level', args.log_level]
+    print(json.dumps(profile_command(command)))
+
+def train_command(args, predictor, registry, model_path):
+    """Train, optionally compress, and publish a new version unless one from the same inputs exists"""
+    from model_search import load_params
+    params = load_params(args.model_params) if args.model_params else None
+    if params is not None:
+        predictor.params = dict(DEFAULT_MODEL_PARAMS, **params)
+    settings = {}
+    if args.per_crop:
+        predictor.per_crop = {
+            "params": load_params(args.crop_model_params) if args.crop_model_params else {},
+            "min_samples": args.min_crop_samples
+        }
+        settings['per_crop'] = predictor.per_crop
+    if args.compress:
+        settings['compress'] = {"max_accuracy_loss": args.max_accuracy_loss, "max_depth": args.max_depth,
+                                "distill": args.distill}
+    try:
+        fingerprint = predictor.training_fingerprint("farmer_guide_crop_dataset.xlsx", **settings)
+    except Exception as e:
+        logger.warning("Could not fingerprint the training inputs: %s", e)
+        fingerprint = None
+    existing = None
+    if fingerprint and not args.force:
+        existing = registry.find_fingerprint(MODEL_NAME, fingerprint)
+    
+    if existing:
+        # Same data, settings and libraries: the published model is what
+        # training would produce, so serve it instead of refitting
+        if existing != registry.current(MODEL_NAME):
+            registry.activate(MODEL_NAME, existing)
+        print(json.dumps({
+            "status": "success",
+            "message": "Model is up to date; use --force to retrain",
+            "version": existing,
+            "skipped": True
+        }))
+    # Train the model
+    elif predictor.load_data("farmer_guide_crop_dataset.xlsx"):
+        if predictor.train_model(params, args.train_workers):
+            report = None
+            if args.compress:
+                report = predictor.compress(args.max_accuracy_loss, args.max_depth, args.distill)
+            # An uncompressed model is not what the fingerprint describes
+            predictor.fingerprint = fingerprint if report or not args.compress else None
+            version = predictor.publish(registry, source='train', compressed=args.compress)
+            if version:
+                registry.prune(MODEL_NAME, args.keep_versions)
+                result = {"status": "success", "message": "Model trained successfully", "version": version}
+                if report:
+                    result['compression'] = report
+                print(json.dumps(result))
             else:
-                print(json.dumps({"status": "error", "message": "Failed to train model"}))
+                print(json.dumps({"status": "error", "message": "Failed to save model"}))
         else:
+            print(json.dumps({"status": "error", "message": "Failed to train model"}))
+    else:
+        print(json.dumps({"status": "error", "message": "Failed to load data"}))
+
+def versions_command(args, predictor, registry, model_path):
+    """List the published versions"""
+    current = registry.current(MODEL_NAME)
+    print(json.dumps({
+        "current": current,
+        "versions": [dict(entry, current=entry['version'] == current)
+                     for entry in registry.versions(MODEL_NAME)]
+    }))
+
+def rollback_command(args, predictor, registry, model_path):
+    """Activate an earlier version"""
+    try:
+        version = registry.rollback(MODEL_NAME, args.rollback or None)
+        print(json.dumps({"status": "success", "version": version}))
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": str(e)}))
+
+def compress_command(args, predictor, registry, model_path):
+    """Compress the current model and publish it"""
+    try:
+        # The held-out split is encoded with the saved model's encoders
+        if not predictor.load_model(model_path):
+            print(json.dumps({"status": "error", "message": "Failed to load model"}))
+            return
+        if not predictor.load_data("farmer_guide_crop_dataset.xlsx", keep_encoders=True):
             print(json.dumps({"status": "error", "message": "Failed to load data"}))
+            return
+        report = predictor.compress(args.max_accuracy_loss, args.max_depth, args.distill)
+        if report is None:
+            print(json.dumps({"status": "error", "message": "Failed to compress model"}))
+            return
+        version = predictor.publish(registry, source='compress', compressed=True)
+        if version:
+            registry.prune(MODEL_NAME, args.keep_versions)
+            print(json.dumps({"status": "success", "message": "Model compressed", "version": version,
+                              "compression": report}))
+        else:
+            print(json.dumps({"status": "error", "message": "Failed to save model"}))
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": str(e)}))
+
+def retrain_crops_command(args, predictor, registry, model_path):
+    """Refit some crops of a per-crop model and publish it"""
+    try:
+        crops = [crop.strip() for crop in args.retrain_crops.split(',') if crop.strip()]
+        if not predictor.load_model(model_path):
+            print(json.dumps({"status": "error", "message": "Failed to load model"}))
+            return
+        if not predictor.load_data("farmer_guide_crop_dataset.xlsx", keep_encoders=True):
+            print(json.dumps({"status": "error", "message": "Failed to load data"}))
+            return
+        retrained = predictor.retrain_crops(crops, args.train_workers)
+        version = predictor.publish(registry, source='retrain_crops', crops=retrained)
+        if version:
+            registry.prune(MODEL_NAME, args.keep_versions)
+            print(json.dumps({"status": "success", "message": "Crop models retrained", "crops": retrained,
+                              "version": version}))
+        else:
+            print(json.dumps({"status": "error", "message": "Failed to save model"}))
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": str(e)}))
+
+def export_compiled_command(args, predictor, registry, model_path):
+    """Write the NumPy export of the current model"""
+    try:
+        if not predictor.load_model(model_path):
+            print(json.dumps({"status": "error", "message": "Failed to load model"}))
+            return
+        model_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), model_path)
+        meta = predictor.export_compiled(model_file_path)
+        print(json.dumps({
+            "status": "success",
+            "path": compiled_path(model_file_path),
+            "trees": meta['n_trees'],
+            "nodes": meta['n_nodes']
+        }))
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": str(e)}))
+
+def update_command(args, predictor, registry, model_path):
+    """Apply new labelled records, or compact, and publish the result"""
+    from forest_runtime import tree_count
     
-    elif args.predict:
-        # Make a prediction
-        try:
-            features = json.loads(args.predict)
-            print(f"Received features: {features}", file=sys.stderr)
-            
-            if predictor.load_model(model_path):
-                prediction = predictor.predict_stage(features)
-                if prediction:
-                    print(json.dumps({
-                        "success": True,
-                        "prediction": prediction
-                    }))
-                else:
-                    print(json.dumps({
-                        "success": False,
-                        "error": "Failed to make prediction"
-                    }))
+    observations_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), OBSERVATIONS_FILE)
+    try:
+        records = []
+        compact = args.compact
+        if args.compact and not args.update:
+            # Keep the saved model's parameters when rebuilding it
+            predictor.load_model(model_path)
+        if args.update:
+            if not predictor.load_model(model_path):
+                print(json.dumps({"status": "error", "message": "Failed to load model"}))
+                return
+            records = clean_observations(read_observations(args.update))
+            if not records:
+                print(json.dumps({"status": "error", "message": "No valid records to train on"}))
+                return
+            if not compact and not predictor.supports_update():
+                print(json.dumps({"status": "error", "message": "The current model is compressed or "
+                                  "per-crop and cannot be updated incrementally; add --compact to "
+                                  "retrain it with the new records"}))
+                return
+            unseen_crops, unseen_stages = predictor.unseen_classes(records)
+            if unseen_crops or unseen_stages:
+                logger.info("Retraining for unseen crops %s and stages %s", unseen_crops, unseen_stages)
+                compact = True
+            if not compact:
+                predictor.update_model(records, args.extra_trees)
+                compact = tree_count(predictor.model) > args.max_trees
+        
+        if compact:
+            observations = []
+            if os.path.exists(observations_path):
+                observations = clean_observations(read_observations(observations_path))
+            # Records of this update join the log only once their model is published
+            observations += records
+            logger.info("Compacting with %d observations", len(observations))
+            if not predictor.load_data("farmer_guide_crop_dataset.xlsx", observations):
+                print(json.dumps({"status": "error", "message": "Failed to load data"}))
+                return
+            n_estimators = predictor.params.get('n_estimators', DEFAULT_N_ESTIMATORS)
+            predictor.train_model(dict(predictor.params, n_estimators=min(n_estimators, args.max_trees)))
+        
+        version = predictor.publish(registry, source='compact' if compact else 'update', records=len(records))
+        if version:
+            if records:
+                append_observations(observations_path, records)
+            registry.prune(MODEL_NAME, args.keep_versions)
+            print(json.dumps({
+                "status": "success",
+                "message": "Model compacted" if compact else "Model updated",
+                "records": len(records),
+                "trees": tree_count(predictor.model),
+                "version": version
+            }))
+        else:
+            print(json.dumps({"status": "error", "message": "Failed to save model"}))
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": str(e)}))
+
+def predict_command(args, predictor, registry, model_path):
+    """Predict the stage of one record"""
+    # Make a prediction
+    try:
+        features = json.loads(args.predict)
+        logger.debug("Received features: %s", features)
+        
+        if predictor.load_model(model_path, args.runtime):
+            prediction = predictor.predict_stage(features)
+            if prediction:
+                print(json.dumps({
+                    "success": True,
+                    "prediction": prediction
+                }))
             else:
                 print(json.dumps({
                     "success": False,
-                    "error": "Failed to load model"
+                    "error": "Failed to make prediction"
                 }))
-        except Exception as e:
+        else:
             print(json.dumps({
                 "success": False,
-                "error": str(e)
+                "error": "Failed to load model"
             }))
+    except Exception as e:
+        print(json.dumps({
+            "success": False,
+            "error": str(e)
+        }))
+
+def predict_batch_command(args, predictor, registry, model_path):
+    """Score a file or stdin of records"""
+    if not predictor.load_model(model_path, args.runtime):
+        print(json.dumps({
+            "success": False,
+            "error": "Failed to load model"
+        }))
+        return
+    try:
+        if args.predict_batch == '-':
+            predict_batch_stream(predictor, sys.stdin, sys.stdout, args.batch_size)
+        else:
+            with open(args.predict_batch) as input_stream:
+                predict_batch_stream(predictor, input_stream, sys.stdout, args.batch_size)
+    except Exception as e:
+        print(json.dumps({
+            "success": False,
+            "error": str(e)
+        }))
+
+def serve_command(args, predictor, registry, model_path):
+    """Answer requests from stdin until shutdown"""
+    # Exit the request loop cleanly when the parent process stops us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Versions published while serving are loaded in the background and
+    # swapped in between requests
+    watcher = ModelWatcher(registry, MODEL_NAME,
+                           lambda directory: load_version(directory, args.runtime, predictor.use_table))
+    watcher.poll()
+    if watcher.model is None and not predictor.load_model(model_path, args.runtime):
+        logger.warning("Serving without a model; predictions will fail until one is published")
+        predictor.model = None
+    if args.workers > 1:
+        from worker_pool import PreforkPool
+        
+        # Workers are forked from the loaded model; the supervisor polls
+        # the registry itself and rolls the workers over to new versions
+        pool = PreforkPool(lambda model, input_stream, output_stream: serve(model, input_stream, output_stream),
+                           watcher.model or predictor, args.workers, watcher)
+        try:
+            pool.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        watcher.start()
+        try:
+            serve(predictor, watcher=watcher)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Crop Stage Predictor')
+    parser.add_argument('--train', action='store_true', help='Train the model')
+    parser.add_argument('--predict', type=str, help='Make a prediction with the given features')
+    parser.add_argument('--predict-batch', type=str, metavar='PATH',
+                        help="Score a JSON array or JSONL file of records ('-' reads stdin)")
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='Records scored per model call when reading JSONL')
+    parser.add_argument('--table-max-day', type=int, default=DEFAULT_TABLE_MAX_DAY,
+                        help='Largest day compiled into the stage lookup table when training')
+    parser.add_argument('--engine', choices=['table', 'forest'], default='table',
+                        help='Answer from the lookup table (falling back to the forest) or always the forest')
+    parser.add_argument('--runtime', choices=['sklearn', 'compiled'], default='sklearn',
+                        help='Predict with the joblib model or its sklearn-free NumPy export')
+    parser.add_argument('--export-compiled', action='store_true',
+                        help='Write the NumPy export of the saved model without retraining')
+    parser.add_argument('--registry', type=str,
+                        help='Model registry directory (default: model_registry next to this script)')
+    parser.add_argument('--versions', action='store_true',
+                        help='List the published model versions')
+    parser.add_argument('--rollback', nargs='?', const='', metavar='VERSION',
+                        help='Activate the given version, or the one active before the current one')
+    parser.add_argument('--keep-versions', type=int, default=DEFAULT_KEEP_VERSIONS,
+                        help='Published versions kept after training; older ones are deleted')
+    parser.add_argument('--force', action='store_true',
+                        help='With --train, retrain even if a model was already trained from the same inputs')
+    parser.add_argument('--model-params', type=str,
+                        help='Model parameters for --train: a JSON object, a JSON file or a model_search report')
+    parser.add_argument('--update', type=str, metavar='PATH',
+                        help='Grow the saved forest with trees fitted on new labelled records (JSONL)')
+    parser.add_argument('--extra-trees', type=int, default=DEFAULT_EXTRA_TREES,
+                        help='Trees added per incremental update')
+    parser.add_argument('--max-trees', type=int, default=DEFAULT_MAX_TREES,
+                        help='Compact the forest once an update grows it past this many trees')
+    parser.add_argument('--compact', action='store_true',
+                        help='Retrain from scratch on the dataset plus all received observations')
+    parser.add_argument('--per-crop', action='store_true',
+                        help='With --train, also fit a small model per crop and route predictions to it')
+    parser.add_argument('--min-crop-samples', type=int, default=DEFAULT_MIN_CROP_SAMPLES,
+                        help='Crops with fewer training rows are left to the global model')
+    parser.add_argument('--crop-model-params', type=str,
+                        help='Parameters of the per-crop models: a JSON object or file (default: one decision tree)')
+    parser.add_argument('--retrain-crops', type=str, metavar='CROPS',
+                        help='Refit only these comma-separated crops of a --per-crop model')
+    parser.add_argument('--train-workers', type=int,
+                        help='Processes training per-crop models (default: all cores)')
+    parser.add_argument('--compress', action='store_true',
+                        help='Shrink the model (with --train, the new one) within the accuracy budget')
+    parser.add_argument('--max-accuracy-loss', type=float,
+                        help='Held-out accuracy --compress may give up (default: 0.01)')
+    parser.add_argument('--max-depth', type=int, help='With --compress, never keep trees deeper than this')
+    parser.add_argument('--distill', action='store_true',
+                        help='With --compress, replace the forest by per-crop day intervals if within budget')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Report per-module import time of the --predict path')
+    parser.add_argument('--log-level', type=str,
+                        help='Logging level for stderr diagnostics (default: $ML_LOG_LEVEL or WARNING)')
+    parser.add_argument('--metrics', choices=['json', 'prometheus'],
+                        help='Write collected timings and counters to stderr when the command finishes')
+    parser.add_argument('--serve', action='store_true',
+                        help='Load the model once and answer JSON requests from stdin, one per line')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='With --serve, fork this many workers sharing one loaded model')
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    predictor = CropStagePredictor()
+    predictor.table_max_day = args.table_max_day
+    predictor.use_table = args.engine == 'table'
+    registry = ModelRegistry(args.registry) if args.registry else ModelRegistry()
     
+    # Runs that produce a new version hold the model's writer lock until the
+    # process exits, so concurrent runs queue up instead of competing
+    writer_lock = None
+    if args.train or args.update or args.compact or args.compress or args.retrain_crops:
+        writer_lock = registry.lock(MODEL_NAME, blocking=False)
+        if writer_lock is None:
+            logger.info("Waiting for another %s training run to finish", MODEL_NAME)
+            report_progress('waiting_for_lock', 0.0)
+            writer_lock = registry.lock(MODEL_NAME)
+    model_path = resolve_model_path(registry)
+
+    commands = (
+        (args.profile_startup, profile_startup_command),
+        (args.train, train_command),
+        (args.versions, versions_command),
+        (args.rollback is not None, rollback_command),
+        (args.compress, compress_command),
+        (args.retrain_crops, retrain_crops_command),
+        (args.export_compiled, export_compiled_command),
+        (args.update or args.compact, update_command),
+        (args.predict, predict_command),
+        (args.predict_batch, predict_batch_command),
+        (args.serve, serve_command),
+    )
+    for selected, command in commands:
+        if selected:
+            command(args, predictor, registry, model_path)
+            break
     else:
         print(json.dumps({
             "success": False,
             "error": "No action specified"
         }))
+    
+    if args.metrics:
+        print(metrics.dump(args.metrics), file=sys.stderr)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,253 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import uuid
+import numpy as np
+from instrumentation import logger
+from model_registry import write_atomic
+
+# Converted datasets live here, one directory per source file
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.dataset_cache')
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_source(path):
+    """Parse a workbook or CSV file with pandas"""
+    import pandas as pd
+
+    if os.path.splitext(path)[1].lower() in ('.xlsx', '.xls'):
+        return pd.read_excel(path)
+    return pd.read_csv(path)
+
+def cache_path(source_path, cache_dir=None):
+    """Directory holding the cached columns of a source file"""
+    key = hashlib.sha1(os.path.abspath(source_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir or CACHE_DIR, key)
+
+def _column_kind(series):
+    if series.dtype.kind in 'iu':
+        return 'int'
+    if series.dtype.kind == 'f':
+        return 'float'
+    if series.dtype.kind == 'b':
+        return 'bool'
+    return 'category'
+
+def write_cache(df, directory, meta):
+    """Write a DataFrame as one typed .npy file per column plus meta.json"""
+    columns = []
+    for index, name in enumerate(df.columns):
+        series = df[name]
+        kind = _column_kind(series)
+        entry = {"name": str(name), "kind": kind, "file": f"{index}.npy"}
+
+        if kind == 'category':
+            categorical = series.astype('category')
+            categories = np.asarray(categorical.cat.categories.astype(str), dtype=str)
+            entry["categories"] = f"{index}.categories.npy"
+            np.save(os.path.join(directory, entry["categories"]), categories)
+            values = categorical.cat.codes.to_numpy()
+        elif kind == 'int':
+            values = series.to_numpy()
+            if len(values) == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+                values = values.astype(np.int32)
+        else:
+            values = series.to_numpy()
+
+        np.save(os.path.join(directory, entry["file"]), values)
+        columns.append(entry)
+
+    meta = dict(meta, rows=len(df), columns=columns)
+    write_atomic(os.path.join(directory, 'meta.json'), json.dumps(meta, indent=2))
+    return meta
+
+def _read_meta(directory):
+    try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _current_build(directory, source_path, stat):
+    """(build directory, meta) the cache path links to when it matches the source's stamp"""
+    build = os.path.realpath(directory)
+    meta = _read_meta(build)
+    if (meta is not None and meta.get('source') == source_path
+            and meta.get('mtime_ns') == stat.st_mtime_ns and meta.get('size') == stat.st_size):
+        return build, meta
+    return None
+
+def _remove_stale_builds(directory, keep):
+    """Delete builds of this cache that lost a swap or were left by a stopped process"""
+    parent, name = os.path.split(directory)
+    for entry in os.listdir(parent):
+        path = os.path.join(parent, entry)
+        if (entry.startswith(f"{name}.") and path != keep
+                and os.path.isdir(path) and not os.path.islink(path)):
+            shutil.rmtree(path, ignore_errors=True)
+
+def ensure_cache(source_path, cache_dir=None):
+    """Convert a source file into the columnar cache unless it is already current
+
+    The cache is keyed by the source path and validated by its mtime and size;
+    when those change the content hash decides whether a rebuild is needed.
+    Returns ``(directory, meta)`` where directory is the build the cache
+    pointed at, so its columns stay consistent with meta even if another
+    process swaps in a rebuild meanwhile.
+    """
+    source_path = os.path.abspath(source_path)
+    directory = cache_path(source_path, cache_dir)
+    current = _current_build(directory, source_path, os.stat(source_path))
+    if current is not None:
+        return current
+
+    # One process converts a source at a time; the others wait and then
+    # find its build current
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    with open(f"{directory}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        stat = os.stat(source_path)
+        current = _current_build(directory, source_path, stat)
+        if current is not None:
+            return current
+        content_hash = file_hash(source_path)
+        build = os.path.realpath(directory)
+        meta = _read_meta(build)
+        if meta is not None and meta.get('source') == source_path and meta.get('sha256') == content_hash:
+            # Touched but unchanged; refresh the stamp and keep the columns
+            meta.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            write_atomic(os.path.join(build, 'meta.json'), json.dumps(meta, indent=2))
+            return build, meta
+        return _build(source_path, directory, stat, content_hash)
+
+def _build(source_path, directory, stat, content_hash):
+    logger.info("Converting %s into the dataset cache", source_path)
+    df = read_source(source_path)
+
+    # Each build gets its own directory and the cache path is a symlink to
+    # it, swapped in one rename, so readers never see a partial or missing
+    # cache; the previous build is removed only after the swap
+    build = f"{directory}.{uuid.uuid4().hex[:16]}"
+    os.makedirs(build)
+    meta = write_cache(df, build, {
+        "source": source_path,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha256": content_hash
+    })
+    if os.path.isdir(directory) and not os.path.islink(directory):
+        # A cache written before builds were linked; a directory cannot be
+        # renamed over, so move it aside first
+        os.replace(directory, f"{directory}.old-{os.getpid()}")
+    link = f"{directory}.link-{os.getpid()}"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(build), link)
+    os.replace(link, directory)
+    # Includes the build just replaced
+    _remove_stale_builds(directory, build)
+    return build, meta
+
+def load_columns(source_path, columns=None, cache_dir=None, mmap_mode='r'):
+    """Memory-map cached columns as ``{name: (values, categories or None)}``"""
+    try:
+        return _load_columns(*ensure_cache(source_path, cache_dir), columns, mmap_mode)
+    except FileNotFoundError:
+        # A rebuild removed the build between reading its meta and its
+        # columns; the cache now links to the new one
+        return _load_columns(*ensure_cache(source_path, cache_dir), columns, mmap_mode)
+
+def _load_columns(directory, meta, columns, mmap_mode):
+    loaded = {}
+    for entry in meta['columns']:
+        if columns is not None and entry['name'] not in columns:
+            continue
+        values = np.load(os.path.join(directory, entry['file']), mmap_mode=mmap_mode)
+        categories = None
+        if entry['kind'] == 'category':
+            categories = np.load(os.path.join(directory, entry['categories']))
+        loaded[entry['name']] = (values, categories)
+    return loaded
+
+def load_dataset(source_path, columns=None, cache_dir=None):
+    """Load a workbook or CSV as a typed DataFrame through the columnar cache"""
+    import pandas as pd
+
+    data = {}
+    for name, (values, categories) in load_columns(source_path, columns, cache_dir, mmap_mode=None).items():
+        if categories is not None:
+            data[name] = pd.Categorical.from_codes(values, categories=categories)
+        else:
+            data[name] = values
+    return pd.DataFrame(data)
+
+def count_rows(source_path, cache_dir=None):
+    """Number of data rows, counting CSV lines without parsing them"""
+    if os.path.splitext(source_path)[1].lower() != '.csv':
+        return ensure_cache(source_path, cache_dir)[1]['rows']
+    lines = 0
+    last = b'\n'
+    with open(source_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    if last != b'\n':
+        lines += 1
+    # The header line is not a row
+    return max(lines - 1, 0)
+
+def iter_chunks(source_path, chunk_size=100000, columns=None, cache_dir=None, start=0, stop=None):
+    """Yield DataFrames of at most chunk_size rows without holding the whole dataset
+
+    CSV files are streamed straight from disk; other formats are converted
+    into the columnar cache once and sliced from the memory-mapped columns.
+    ``start`` and ``stop`` restrict the rows read, e.g. to one shard of a file.
+    """
+    import pandas as pd
+
+    if os.path.splitext(source_path)[1].lower() == '.csv':
+        yield from pd.read_csv(
+            source_path,
+            usecols=columns,
+            chunksize=chunk_size,
+            skiprows=range(1, start + 1) if start else None,
+            nrows=None if stop is None else max(stop - start, 0)
+        )
+        return
+
+    loaded = load_columns(source_path, columns, cache_dir)
+    rows = len(next(iter(loaded.values()))[0]) if loaded else 0
+    if stop is not None:
+        rows = min(rows, stop)
+    for start in range(start, rows, chunk_size):
+        data = {}
+        for name, (values, categories) in loaded.items():
+            chunk = np.array(values[start:min(start + chunk_size, rows)])
+            data[name] = pd.Categorical.from_codes(chunk, categories=categories) if categories is not None else chunk
+        yield pd.DataFrame(data)
+
+def dataset_hash(source_path, cache_dir=None):
+    """Content hash of a source file, reusing the one recorded in the cache"""
+    return ensure_cache(source_path, cache_dir)[1]['sha256']
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python dataset_cache.py <dataset.xlsx|dataset.csv> [...]")
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        directory, meta = ensure_cache(path)
+        print(json.dumps({
+            "source": meta['source'],
+            "cache": directory,
+            "rows": meta['rows'],
+            "columns": {entry['name']: entry['kind'] for entry in meta['columns']}
+        }))
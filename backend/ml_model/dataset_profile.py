@@ -0,0 +1,288 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 100000
+# Most frequent values reported per categorical column
+TOP_VALUES = 20
+# Label columns looked for, in order, when none is given
+LABEL_COLUMNS = ('label', 'stage')
+
+def _merge_moments(a, b):
+    """Combine (count, mean, M2) summaries of two disjoint samples (Chan et al.)"""
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n_a == 0:
+        return b
+    if n_b == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    if np.ndim(delta):
+        m2 = m2_a + m2_b + np.outer(delta, delta) * (n_a * n_b / n)
+    else:
+        m2 = m2_a + m2_b + delta * delta * (n_a * n_b / n)
+    return n, mean, m2
+
+class DatasetProfile:
+    """Mergeable single-pass summary of a tabular dataset
+
+    ``update`` folds in one DataFrame chunk and ``merge`` folds in the profile
+    of another shard, so a dataset can be profiled chunk by chunk, shard by
+    shard, in any order.  Per-column statistics use each column's non-missing
+    values; the correlation matrix uses the rows where every numeric column is
+    present, which matches pandas' ``corr()`` when nothing is missing.
+    """
+
+    def __init__(self, label=None):
+        self.label = label
+        self.rows = 0
+        self.columns = []
+        self.numeric = {}
+        self.categorical = {}
+        self.missing = {}
+        # Correlation accumulator over complete numeric rows
+        self.correlation_columns = None
+        self.comoments = (0, None, None)
+
+    def _add_column(self, name, series):
+        import pandas as pd
+
+        self.columns.append(name)
+        self.missing[name] = 0
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            self.numeric[name] = {'moments': (0, 0.0, 0.0), 'min': None, 'max': None}
+        else:
+            self.categorical[name] = {}
+
+    def update(self, chunk):
+        """Fold one DataFrame of rows into the profile"""
+        import pandas as pd
+
+        if self.label is None and not self.columns:
+            self.label = next((name for name in LABEL_COLUMNS if name in chunk.columns), None)
+        for name in chunk.columns:
+            if name not in self.missing:
+                self._add_column(name, chunk[name])
+        self.rows += len(chunk)
+
+        numeric_values = {}
+        for name in self.columns:
+            if name not in chunk.columns:
+                self.missing[name] += len(chunk)
+                continue
+            series = chunk[name]
+            if name in self.numeric:
+                values = pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64)
+                numeric_values[name] = values
+                present = values[~np.isnan(values)]
+                self.missing[name] += len(values) - len(present)
+                if len(present) == 0:
+                    continue
+                stats = self.numeric[name]
+                mean = present.mean()
+                stats['moments'] = _merge_moments(
+                    stats['moments'], (len(present), mean, float(((present - mean) ** 2).sum()))
+                )
+                low, high = float(present.min()), float(present.max())
+                stats['min'] = low if stats['min'] is None else min(stats['min'], low)
+                stats['max'] = high if stats['max'] is None else max(stats['max'], high)
+            else:
+                self.missing[name] += int(series.isna().sum())
+                counts = self.categorical[name]
+                for value, count in series.dropna().astype(str).value_counts().items():
+                    counts[value] = counts.get(value, 0) + int(count)
+
+        if self.correlation_columns is None:
+            self.correlation_columns = list(self.numeric)
+        columns = [numeric_values.get(name) for name in self.correlation_columns]
+        if columns and all(values is not None for values in columns):
+            matrix = np.column_stack(columns)
+            matrix = matrix[~np.isnan(matrix).any(axis=1)]
+            if len(matrix):
+                mean = matrix.mean(axis=0)
+                centered = matrix - mean
+                self.comoments = _merge_moments(self.comoments, (len(matrix), mean, centered.T @ centered))
+        return self
+
+    def merge(self, other):
+        """Fold in the profile of another, disjoint, set of rows"""
+        if other.rows == 0:
+            return self
+        if self.rows == 0:
+            self.__dict__.update(other.__dict__)
+            return self
+        self.label = self.label or other.label
+        for name in other.columns:
+            if name not in self.missing:
+                self.columns.append(name)
+                self.missing[name] = self.rows
+                if name in other.numeric:
+                    self.numeric[name] = {'moments': (0, 0.0, 0.0), 'min': None, 'max': None}
+                else:
+                    self.categorical[name] = {}
+        for name in self.columns:
+            if name not in other.missing:
+                self.missing[name] += other.rows
+                continue
+            self.missing[name] += other.missing[name]
+            if name in self.numeric and name in other.numeric:
+                ours, theirs = self.numeric[name], other.numeric[name]
+                ours['moments'] = _merge_moments(ours['moments'], theirs['moments'])
+                for key, pick in (('min', min), ('max', max)):
+                    values = [value for value in (ours[key], theirs[key]) if value is not None]
+                    ours[key] = pick(values) if values else None
+            elif name in self.categorical and name in other.categorical:
+                counts = self.categorical[name]
+                for value, count in other.categorical[name].items():
+                    counts[value] = counts.get(value, 0) + count
+        if self.correlation_columns == other.correlation_columns:
+            self.comoments = _merge_moments(self.comoments, other.comoments)
+        self.rows += other.rows
+        return self
+
+    def to_dict(self):
+        """JSON-serializable report"""
+        columns = {}
+        for name in self.columns:
+            entry = {'missing': self.missing[name], 'count': self.rows - self.missing[name]}
+            if name in self.numeric:
+                stats = self.numeric[name]
+                n, mean, m2 = stats['moments']
+                variance = m2 / (n - 1) if n > 1 else None
+                entry.update(
+                    kind='numeric',
+                    min=stats['min'],
+                    max=stats['max'],
+                    mean=float(mean) if n else None,
+                    variance=variance,
+                    std=float(np.sqrt(variance)) if variance is not None else None
+                )
+            else:
+                counts = self.categorical[name]
+                top = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:TOP_VALUES]
+                entry.update(kind='categorical', distinct=len(counts), top=dict(top))
+            columns[name] = entry
+
+        report = {'rows': self.rows, 'columns': columns, 'label': self.label}
+        if self.label in self.categorical:
+            report['label_distribution'] = dict(
+                sorted(self.categorical[self.label].items(), key=lambda item: (-item[1], item[0]))
+            )
+
+        n, _, comoments = self.comoments
+        if n > 1:
+            scale = np.sqrt(np.diag(comoments))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                correlation = comoments / np.outer(scale, scale)
+            report['correlation'] = {
+                'columns': self.correlation_columns,
+                'rows': int(n),
+                # Constant columns have no correlation; report them as null
+                'matrix': [[None if np.isnan(value) else float(value) for value in row] for row in correlation]
+            }
+        return report
+
+def profile_shard(path, start=0, stop=None, chunk_size=DEFAULT_CHUNK_SIZE, label=None):
+    """Profile rows [start, stop) of one file, one chunk at a time"""
+    from dataset_cache import iter_chunks
+
+    profile = DatasetProfile(label)
+    for chunk in iter_chunks(path, chunk_size, start=start, stop=stop):
+        profile.update(chunk)
+    return profile
+
+def shard_ranges(paths, shards):
+    """Split every file into about ``shards`` row ranges"""
+    from dataset_cache import count_rows
+
+    ranges = []
+    for path in paths:
+        rows = count_rows(path)
+        step = max(1, -(-rows // max(shards, 1)))
+        ranges.extend((path, start, min(start + step, rows)) for start in range(0, rows, step))
+    return ranges
+
+def profile_dataset(paths, chunk_size=DEFAULT_CHUNK_SIZE, workers=1, label=None):
+    """Profile one or more files, in parallel shards when workers > 1"""
+    if isinstance(paths, str):
+        paths = [paths]
+    if workers <= 1:
+        profile = DatasetProfile(label)
+        for path in paths:
+            profile.merge(profile_shard(path, chunk_size=chunk_size, label=label))
+        return profile
+
+    ranges = shard_ranges(paths, workers)
+    profile = DatasetProfile(label)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(profile_shard, path, start, stop, chunk_size, label) for path, start, stop in ranges]
+        # Merge in file order so the result does not depend on scheduling
+        for future in futures:
+            profile.merge(future.result())
+    return profile
+
+def plot_profile(report, output_dir='visualizations'):
+    """Draw the correlation heatmap and label distribution of a profile report"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+    correlation = report.get('correlation')
+    if correlation:
+        matrix = np.array([[np.nan if value is None else value for value in row] for row in correlation['matrix']])
+        plt.figure(figsize=(12, 8))
+        sns.heatmap(matrix, annot=True, cmap='coolwarm', center=0,
+                    xticklabels=correlation['columns'], yticklabels=correlation['columns'])
+        plt.title('Feature Correlation Heatmap')
+        plt.tight_layout()
+        path = os.path.join(output_dir, 'correlation_heatmap.png')
+        plt.savefig(path)
+        plt.close()
+        written.append(path)
+
+    distribution = report.get('label_distribution')
+    if distribution:
+        plt.figure(figsize=(10, 6))
+        plt.bar(list(distribution), list(distribution.values()))
+        plt.title('Distribution of Crop Types' if report.get('label') == 'label' else f"Distribution of {report['label']}")
+        plt.xlabel(report['label'])
+        plt.ylabel('Count')
+        plt.xticks(rotation=45)
+        plt.tight_layout()
+        path = os.path.join(output_dir, 'crop_distribution.png')
+        plt.savefig(path)
+        plt.close()
+        written.append(path)
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description='Streaming dataset profiler')
+    parser.add_argument('paths', nargs='+', help='Workbooks or CSV files; several files are profiled as one dataset')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Rows read per chunk')
+    parser.add_argument('--workers', type=int, default=1, help='Profile shards in this many processes')
+    parser.add_argument('--label', type=str, help="Label column (default: 'label' or 'stage' if present)")
+    parser.add_argument('--output', type=str, help='Write the report to this JSON file instead of stdout')
+    parser.add_argument('--plot', type=str, metavar='DIR', help='Also draw the report into this directory')
+    args = parser.parse_args()
+
+    report = profile_dataset(args.paths, args.chunk_size, args.workers, args.label).to_dict()
+    report['sources'] = [os.path.abspath(path) for path in args.paths]
+    if args.plot:
+        report['plots'] = plot_profile(report, args.plot)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Profile written to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
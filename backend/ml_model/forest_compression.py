@@ -0,0 +1,259 @@
+import io
+import time
+import numpy as np
+from forest_runtime import CompiledForest, flatten_trees, tree_depths
+
+# Accuracy (as a fraction of held-out rows) compression may give up in total
+DEFAULT_MAX_ACCURACY_LOSS = 0.01
+
+# Rows the selected trees are fitted to; larger fit sets are sampled down
+MAX_FIT_ROWS = 4096
+
+# Share of the held-out rows compression selects on; the rest are only
+# used to report accuracy
+SELECTION_FRACTION = 0.5
+
+LATENCY_REPEATS = 50
+THROUGHPUT_ROWS = 10000
+
+def _reindex(arrays, keep, roots):
+    """Packed arrays holding only the nodes in ``keep``, in that order"""
+    new_index = np.full(len(arrays['feature']), -1, dtype=np.int64)
+    new_index[keep] = np.arange(len(keep))
+    left = np.asarray(arrays['left'])[keep]
+    right = np.asarray(arrays['right'])[keep]
+    leaf = left == -1
+    return {
+        'feature': np.asarray(arrays['feature'])[keep].astype(np.int32),
+        'threshold': np.asarray(arrays['threshold'])[keep].astype(np.float64),
+        'left': np.where(leaf, -1, new_index[left]).astype(np.int32),
+        'right': np.where(leaf, -1, new_index[right]).astype(np.int32),
+        'value': np.asarray(arrays['value'])[keep].astype(np.float64),
+        'roots': new_index[np.asarray(roots)].astype(np.int64),
+        'classes': np.asarray(arrays['classes']),
+    }
+
+def compact(arrays):
+    """Drop the nodes no root can reach any more"""
+    reachable = np.zeros(len(arrays['feature']), dtype=bool)
+    frontier = np.asarray(arrays['roots'])
+    while len(frontier):
+        reachable[frontier] = True
+        internal = frontier[arrays['left'][frontier] != -1]
+        frontier = np.concatenate([arrays['left'][internal], arrays['right'][internal]])
+    # Nodes keep their relative order, so every tree stays contiguous
+    return _reindex(arrays, np.flatnonzero(reachable), arrays['roots'])
+
+def subset_trees(arrays, trees):
+    """Packed arrays of the given trees only, in the given order"""
+    roots = np.asarray(arrays['roots'])
+    ends = np.append(roots[1:], len(arrays['feature']))
+    keep = np.concatenate([np.arange(roots[tree], ends[tree]) for tree in trees])
+    return _reindex(arrays, keep, roots[list(trees)])
+
+def cap_depth(arrays, max_depth):
+    """Turn every node at max_depth into a leaf predicting its training distribution"""
+    depth = tree_depths(arrays)
+    left, right, feature = (np.array(arrays[name]) for name in ('left', 'right', 'feature'))
+    cut = (depth >= max_depth) & (left != -1)
+    left[cut] = right[cut] = -1
+    feature[cut] = 0
+    return compact(dict(arrays, left=left, right=right, feature=feature))
+
+def merge_leaves(arrays):
+    """Collapse splits whose two leaves predict identical distributions
+
+    Works bottom-up, so a subtree whose leaves all agree becomes one leaf.
+    Predictions are unchanged.
+    """
+    depth = tree_depths(arrays)
+    left, right, feature, value = (np.array(arrays[name]) for name in ('left', 'right', 'feature', 'value'))
+    for level in range(int(depth.max()) - 1, -1, -1):
+        nodes = np.flatnonzero((depth == level) & (left != -1))
+        lefts, rights = left[nodes], right[nodes]
+        same = (left[lefts] == -1) & (left[rights] == -1) & (value[lefts] == value[rights]).all(axis=1)
+        nodes = nodes[same]
+        value[nodes] = value[left[nodes]]
+        left[nodes] = right[nodes] = -1
+        feature[nodes] = 0
+    return compact(dict(arrays, left=left, right=right, feature=feature, value=value))
+
+def tree_probabilities(arrays, X):
+    """Class probabilities of every tree separately, shaped (n_trees, n_rows, n_classes)"""
+    forest = CompiledForest(arrays, {'n_features': np.asarray(X).shape[1]})
+    return np.asarray(arrays['value'])[forest.apply(X)]
+
+def class_codes(classes, y):
+    """Column of each label in classes, -1 for labels the model does not know"""
+    index = {label: code for code, label in enumerate(np.asarray(classes).tolist())}
+    return np.array([index.get(label, -1) for label in np.asarray(y).tolist()], dtype=np.int64)
+
+def split_holdout(X, y, fraction=SELECTION_FRACTION, random_state=42):
+    """Split held-out rows into (X_select, y_select, X_report, y_report)
+
+    Compression checks its budget on the selection slice, so accuracy
+    measured there would flatter the result; the report slice is never
+    seen by selection.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y)
+    if len(X) < 2:
+        raise ValueError("Compression needs at least two held-out rows")
+    rows = np.random.default_rng(random_state).permutation(len(X))
+    size = min(max(int(len(X) * fraction), 1), len(X) - 1)
+    select, report = np.sort(rows[:size]), np.sort(rows[size:])
+    return X[select], y[select], X[report], y[report]
+
+def select_trees(fit_probabilities, val_probabilities, val_codes, min_accuracy):
+    """Greedy forward ensemble selection
+
+    Repeatedly adds the tree that brings the subset's averaged probabilities
+    closest (in squared error on the fit rows) to the full forest's, and
+    stops at the first subset whose held-out accuracy reaches min_accuracy.
+    """
+    target = fit_probabilities.mean(axis=0)
+    remaining = list(range(len(fit_probabilities)))
+    chosen = []
+    fit_total = np.zeros_like(target)
+    val_total = np.zeros(val_probabilities.shape[1:])
+    while remaining:
+        size = len(chosen) + 1
+        errors = (((fit_total + fit_probabilities[remaining]) / size - target) ** 2).sum(axis=(1, 2))
+        tree = remaining.pop(int(errors.argmin()))
+        chosen.append(tree)
+        fit_total += fit_probabilities[tree]
+        val_total += val_probabilities[tree]
+        if (val_total.argmax(axis=1) == val_codes).mean() >= min_accuracy:
+            break
+    return chosen
+
+def accuracy(model, X, y):
+    return float((model.predict(X) == np.asarray(y)).mean()) if len(X) else None
+
+def model_summary(model, X, y):
+    """Size, shape, held-out accuracy and prediction latency of a tree model"""
+    import joblib
+
+    arrays = flatten_trees(model)
+    buffer = io.BytesIO()
+    joblib.dump(model, buffer)
+
+    row = np.asarray(X)[:1]
+    model.predict_proba(row)
+    latencies = []
+    for _ in range(LATENCY_REPEATS):
+        start = time.perf_counter()
+        model.predict_proba(row)
+        latencies.append(time.perf_counter() - start)
+
+    batch = np.asarray(X)[np.arange(THROUGHPUT_ROWS) % len(X)]
+    start = time.perf_counter()
+    model.predict_proba(batch)
+    batch_time = time.perf_counter() - start
+
+    return {
+        "trees": int(len(arrays['roots'])),
+        "nodes": int(len(arrays['feature'])),
+        "max_depth": int(tree_depths(arrays).max()),
+        "size_bytes": buffer.getbuffer().nbytes,
+        "compiled_bytes": int(sum(np.asarray(values).nbytes for values in arrays.values())),
+        "accuracy": accuracy(model, X, y),
+        "latency_ms": float(np.median(latencies) * 1000),
+        "throughput_rows_per_s": THROUGHPUT_ROWS / batch_time
+    }
+
+def compress_forest(model, X_fit, X_val, y_val, max_accuracy_loss=DEFAULT_MAX_ACCURACY_LOSS,
+                    max_depth=None, random_state=42):
+    """Shrink a fitted tree ensemble while keeping held-out accuracy within budget
+
+    Trees are chosen by greedy ensemble selection, then depth is lowered as
+    far as the budget allows (never above max_depth when given), then
+    redundant splits are merged.  The budget is measured against the
+    original model's accuracy on (X_val, y_val), so report accuracy on
+    other rows (see split_holdout).  Returns a CompiledForest.
+    """
+    arrays = flatten_trees(model)
+    n_features = int(model.n_features_in_)
+    X_fit = np.asarray(X_fit, dtype=np.float64)
+    X_val = np.asarray(X_val, dtype=np.float64)
+    if len(X_fit) > MAX_FIT_ROWS:
+        rows = np.random.default_rng(random_state).choice(len(X_fit), MAX_FIT_ROWS, replace=False)
+        X_fit = X_fit[np.sort(rows)]
+
+    def build(candidate):
+        return CompiledForest(candidate, {'n_features': n_features})
+
+    min_accuracy = accuracy(build(arrays), X_val, y_val) - max_accuracy_loss
+    val_codes = class_codes(arrays['classes'], y_val)
+
+    trees = select_trees(tree_probabilities(arrays, X_fit), tree_probabilities(arrays, X_val),
+                         val_codes, min_accuracy)
+    arrays = subset_trees(arrays, trees)
+
+    depth = int(tree_depths(arrays).max())
+    if max_depth is not None and max_depth < depth:
+        arrays = cap_depth(arrays, max_depth)
+        depth = max_depth
+    for candidate_depth in range(depth - 1, 0, -1):
+        candidate = cap_depth(arrays, candidate_depth)
+        if accuracy(build(candidate), X_val, y_val) < min_accuracy:
+            break
+        arrays = candidate
+
+    arrays = merge_leaves(arrays)
+    return build(arrays)
+
+def interval_tree(probabilities, classes):
+    """One tree answering (crop code, day) from per-crop runs of the same best class
+
+    ``probabilities`` is shaped (n_crops, n_days, n_classes), as the stage
+    lookup table.  Each run of days with the same most probable class
+    becomes one leaf predicting the run's mean probabilities; the first and
+    last run of a crop extend to days before 0 and after the last day.
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    features, thresholds, lefts, rights, values = [], [], [], [], []
+
+    def add(feature, threshold, value):
+        features.append(feature)
+        thresholds.append(threshold)
+        lefts.append(-1)
+        rights.append(-1)
+        values.append(value)
+        return len(features) - 1
+
+    def split(feature, threshold, build_left, build_right):
+        node = add(feature, threshold, None)
+        lefts[node], left_value = build_left()
+        rights[node], right_value = build_right()
+        values[node] = (left_value + right_value) / 2
+        return node, values[node]
+
+    def build_days(intervals):
+        if len(intervals) == 1:
+            value = intervals[0][1]
+            return add(0, -2.0, value), value
+        middle = len(intervals) // 2
+        return split(1, intervals[middle][0] - 0.5,
+                     lambda: build_days(intervals[:middle]), lambda: build_days(intervals[middle:]))
+
+    def build_crops(low, high):
+        if high - low == 1:
+            best = probabilities[low].argmax(axis=1)
+            starts = np.flatnonzero(np.r_[True, best[1:] != best[:-1]])
+            ends = np.append(starts[1:], len(best))
+            return build_days([(start, probabilities[low, start:end].mean(axis=0))
+                               for start, end in zip(starts, ends)])
+        middle = (low + high) // 2
+        return split(0, middle - 0.5, lambda: build_crops(low, middle), lambda: build_crops(middle, high))
+
+    build_crops(0, len(probabilities))
+    return {
+        'feature': np.array(features, dtype=np.int32),
+        'threshold': np.array(thresholds, dtype=np.float64),
+        'left': np.array(lefts, dtype=np.int32),
+        'right': np.array(rights, dtype=np.int32),
+        'value': np.vstack(values),
+        'roots': np.array([0], dtype=np.int64),
+        'classes': np.asarray(classes),
+    }
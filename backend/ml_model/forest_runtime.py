@@ -0,0 +1,308 @@
+import json
+import os
+import shutil
+import numpy as np
+
+# Only numpy is needed to load and evaluate an exported model; sklearn is
+# imported by nothing in this module.
+FORMAT_VERSION = 1
+ARRAY_NAMES = ['feature', 'threshold', 'left', 'right', 'value', 'roots', 'classes']
+# Routed models add the roots of every per-crop model, grouped by crop code:
+# crop c owns specialist_roots[specialist_offsets[c]:specialist_offsets[c + 1]]
+ROUTER_ARRAY_NAMES = ['specialist_roots', 'specialist_offsets']
+
+# Rows evaluated together; bounds the (trees x rows) node-index matrix
+BLOCK_ROWS = 8192
+
+def _save_array(directory, name, values):
+    values = np.asarray(values)
+    if values.dtype == object:
+        # Keep the format pickle-free so it can be memory-mapped
+        values = values.astype(str)
+    np.save(os.path.join(directory, f'{name}.npy'), values)
+
+def flatten_trees(model):
+    """Pack every tree of a fitted sklearn tree or forest into shared node arrays
+
+    Trees are laid out one after another; child indices are global and -1
+    marks a leaf.  ``value`` holds each node's class distribution normalized
+    the same way sklearn's predict_proba normalizes leaves.  A CompiledForest
+    is returned as it is already packed.  A CropRouter is packed as its
+    global model's trees followed by every crop model's trees.
+    """
+    if isinstance(model, CropRouter):
+        return _flatten_router(model)
+    if isinstance(model, CompiledForest):
+        return {name: np.asarray(model.arrays[name]) for name in ARRAY_NAMES}
+    estimators = model.estimators_ if hasattr(model, 'estimators_') else [model]
+    n_classes = len(model.classes_)
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    offset = 0
+    for estimator in estimators:
+        tree = estimator.tree_
+        leaf = tree.children_left == -1
+        # Leaves never test a feature; point them at column 0 so indexing stays valid
+        features.append(np.where(leaf, 0, tree.feature).astype(np.int32))
+        thresholds.append(tree.threshold.astype(np.float64))
+        lefts.append(np.where(leaf, -1, tree.children_left + offset).astype(np.int32))
+        rights.append(np.where(leaf, -1, tree.children_right + offset).astype(np.int32))
+
+        proba = tree.value[:, 0, :n_classes].astype(np.float64)
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        values.append(proba / normalizer)
+
+        roots.append(offset)
+        offset += tree.node_count
+
+    return {
+        'feature': np.concatenate(features),
+        'threshold': np.concatenate(thresholds),
+        'left': np.concatenate(lefts),
+        'right': np.concatenate(rights),
+        'value': np.concatenate(values),
+        'roots': np.array(roots, dtype=np.int64),
+        'classes': np.asarray(model.classes_),
+    }
+
+def _flatten_router(router):
+    if router.arrays is not None:
+        # Loaded from an export; already packed
+        return {name: np.asarray(router.arrays[name]) for name in ARRAY_NAMES + ROUTER_ARRAY_NAMES}
+
+    arrays = flatten_trees(router.global_model)
+    parts = {name: [arrays[name]] for name in ('feature', 'threshold', 'left', 'right', 'value')}
+    specialist_roots = []
+    counts = np.zeros(max(router.specialists, default=-1) + 1, dtype=np.int64)
+    offset = len(arrays['feature'])
+    for code in sorted(router.specialists):
+        specialist = flatten_trees(router.specialists[code])
+        if not np.array_equal(specialist['classes'], arrays['classes']):
+            raise ValueError(f"Crop model {code} does not share the global model's classes")
+        for name in ('feature', 'threshold', 'value'):
+            parts[name].append(specialist[name])
+        for name in ('left', 'right'):
+            parts[name].append(np.where(specialist[name] == -1, -1, specialist[name] + offset).astype(np.int32))
+        specialist_roots.append(specialist['roots'] + offset)
+        counts[code] = len(specialist['roots'])
+        offset += len(specialist['feature'])
+
+    packed = {name: np.concatenate(values) for name, values in parts.items()}
+    packed.update(
+        roots=arrays['roots'],
+        classes=arrays['classes'],
+        specialist_roots=np.concatenate(specialist_roots) if specialist_roots else np.zeros(0, dtype=np.int64),
+        specialist_offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    )
+    return packed
+
+def tree_count(model):
+    """Number of trees in an sklearn tree model, a CompiledForest or a CropRouter"""
+    if isinstance(model, CropRouter):
+        return tree_count(model.global_model) + sum(tree_count(m) for m in model.specialists.values())
+    if isinstance(model, CompiledForest):
+        return len(model.roots)
+    return len(getattr(model, 'estimators_', [model]))
+
+def tree_depths(arrays):
+    """Depth of every node, computed from the packed child arrays"""
+    depth = np.zeros(len(arrays['feature']), dtype=np.int32)
+    frontier = np.asarray(arrays['roots'])
+    level = 0
+    while len(frontier):
+        depth[frontier] = level
+        internal = frontier[arrays['left'][frontier] != -1]
+        frontier = np.concatenate([arrays['left'][internal], arrays['right'][internal]])
+        level += 1
+    return depth
+
+def export_compiled(model, directory, extra_arrays=None, meta=None):
+    """Write a fitted tree model, plus any extra arrays, as a compiled model directory
+
+    The directory is built next to its final location and renamed into
+    place, so a reader never sees a half-written export.
+    """
+    arrays = flatten_trees(model)
+    staging = f"{directory}.tmp-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    for name, values in dict(arrays, **(extra_arrays or {})).items():
+        _save_array(staging, name, values)
+
+    meta = dict(meta or {})
+    meta.update(
+        format=FORMAT_VERSION,
+        n_trees=int(len(arrays['roots'])),
+        n_nodes=int(len(arrays['feature'])),
+        n_features=int(model.n_features_in_),
+        max_depth=int(tree_depths(arrays).max()),
+        arrays=sorted(dict(arrays, **(extra_arrays or {})))
+    )
+    with open(os.path.join(staging, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(staging, directory)
+    return meta
+
+def load_compiled(directory, mmap_mode='r'):
+    """Load (arrays, meta) from a compiled model directory, memory-mapping the arrays"""
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported compiled model format: {meta.get('format')}")
+    arrays = {
+        name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+        for name in meta['arrays']
+    }
+    return arrays, meta
+
+class CompiledForest:
+    """Pure-NumPy evaluator for an exported tree ensemble
+
+    Matches sklearn's predict_proba: inputs are compared in float32 like
+    sklearn's trees, and per-tree probabilities are summed in tree order and
+    divided by the number of trees.
+    """
+
+    def __init__(self, arrays, meta=None):
+        # Extra arrays exported with the forest stay reachable here
+        self.arrays = arrays
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.left = arrays['left']
+        self.right = arrays['right']
+        self.value = arrays['value']
+        self.roots = np.asarray(arrays['roots'])
+        self.classes_ = np.asarray(arrays['classes'])
+        self.meta = meta or {}
+        self.n_features_in_ = self.meta.get('n_features', int(self.feature.max()) + 1)
+        self.max_depth = self.meta.get('max_depth')
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Load an export; exports of a CropRouter load as a CropRouter"""
+        arrays, meta = load_compiled(directory, mmap_mode)
+        if 'specialist_offsets' in arrays:
+            return CropRouter.from_arrays(arrays, meta)
+        return cls(arrays, meta)
+
+    def apply(self, X):
+        """Leaf index reached in every tree, shaped (n_trees, n_rows)"""
+        X = np.asarray(X, dtype=np.float32)
+        n_rows = len(X)
+        nodes = np.repeat(self.roots.astype(np.int32), n_rows)
+        rows = np.tile(np.arange(n_rows), len(self.roots))
+
+        # Walk every (tree, row) pair down one level at a time, dropping the
+        # pairs that have reached a leaf
+        active = np.arange(len(nodes))
+        while len(active):
+            current = nodes[active]
+            left = self.left[current]
+            internal = left != -1
+            active, current, left = active[internal], current[internal], left[internal]
+            go_left = X[rows[active], self.feature[current]] <= self.threshold[current]
+            nodes[active] = np.where(go_left, left, self.right[current])
+        return nodes.reshape(len(self.roots), n_rows)
+
+    def predict_proba(self, X):
+        X = np.asarray(X)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has shape {X.shape}, but the model expects {self.n_features_in_} features")
+
+        probabilities = np.zeros((len(X), len(self.classes_)), dtype=np.float64)
+        for start in range(0, len(X), BLOCK_ROWS):
+            leaves = self.apply(X[start:start + BLOCK_ROWS])
+            block = probabilities[start:start + BLOCK_ROWS]
+            for tree_leaves in leaves:
+                block += self.value[tree_leaves]
+        probabilities /= len(self.roots)
+        return probabilities
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+class CropRouter:
+    """Dispatch (crop code, day) rows to a per-crop model, or the global model
+
+    ``specialists`` maps crop codes to models fitted on that crop's rows
+    only; every model must share the global model's ``classes_``.  Rows for
+    other crops go to the global model in one call.  Works with sklearn
+    models and CompiledForests alike.
+    """
+
+    def __init__(self, global_model, specialists, arrays=None, meta=None):
+        self.global_model = global_model
+        self.specialists = dict(specialists)
+        self.classes_ = np.asarray(global_model.classes_)
+        self.n_features_in_ = global_model.n_features_in_
+        # Set when loaded from an export, like CompiledForest
+        self.arrays = arrays
+        self.meta = meta if meta is not None else getattr(global_model, 'meta', {})
+
+    @classmethod
+    def from_arrays(cls, arrays, meta=None):
+        """Router over CompiledForests that share one set of packed node arrays"""
+        global_model = CompiledForest(arrays, meta)
+        offsets = np.asarray(arrays['specialist_offsets'])
+        roots = np.asarray(arrays['specialist_roots'])
+        specialists = {
+            code: CompiledForest(dict(arrays, roots=roots[offsets[code]:offsets[code + 1]]), meta)
+            for code in np.flatnonzero(np.diff(offsets)).tolist()
+        }
+        return cls(global_model, specialists, arrays, meta)
+
+    def predict_proba(self, X):
+        X = np.asarray(X)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has shape {X.shape}, but the model expects {self.n_features_in_} features")
+
+        codes = X[:, 0].astype(np.int64)
+        probabilities = np.empty((len(X), len(self.classes_)), dtype=np.float64)
+        routed = np.zeros(len(X), dtype=bool)
+        for code in np.unique(codes).tolist():
+            specialist = self.specialists.get(code)
+            if specialist is not None:
+                rows = codes == code
+                probabilities[rows] = specialist.predict_proba(X[rows])
+                routed |= rows
+        if not routed.all():
+            probabilities[~routed] = self.global_model.predict_proba(X[~routed])
+        return probabilities
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+class FittedLabels:
+    """Stand-in for a fitted LabelEncoder that only needs its classes"""
+
+    def __init__(self, classes):
+        self.classes_ = np.asarray(classes, dtype=object)
+
+    def transform(self, values):
+        index = {label: code for code, label in enumerate(self.classes_.tolist())}
+        try:
+            return np.array([index[value] for value in values], dtype=np.int64)
+        except KeyError as e:
+            raise ValueError(f"y contains previously unseen labels: {e}")
+
+    def inverse_transform(self, codes):
+        return self.classes_[np.asarray(codes)]
+
+class FittedScaler:
+    """Stand-in for a fitted StandardScaler's transform"""
+
+    def __init__(self, mean, scale):
+        self.mean_ = None if mean is None else np.asarray(mean, dtype=np.float64)
+        self.scale_ = None if scale is None else np.asarray(scale, dtype=np.float64)
+
+    def transform(self, X):
+        X = np.array(X, dtype=np.float64)
+        if self.mean_ is not None:
+            X -= self.mean_
+        if self.scale_ is not None:
+            X /= self.scale_
+        return X
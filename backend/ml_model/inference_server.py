@@ -0,0 +1,367 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import configure_logging, logger, metrics
+
+# Longest a request waits for others to share its batch
+DEFAULT_WINDOW_MS = 2.0
+DEFAULT_MAX_BATCH = 256
+# Requests queued per model before new ones are turned away
+DEFAULT_MAX_QUEUE = 4096
+DEFAULT_TIMEOUT = 5.0
+# Requests a single connection may have in flight before reading pauses
+MAX_IN_FLIGHT = 512
+# Longest request line accepted; asyncio's default of 64 KiB is a few
+# hundred predict_batch records
+MAX_LINE_BYTES = 64 << 20
+DEFAULT_SOCKET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inference.sock')
+
+# Batches averaging fewer rows than this are dispatched without waiting;
+# under light load the window would only add latency
+ADAPTIVE_MIN_BATCH = 2.0
+BATCH_SIZE_SMOOTHING = 0.2
+
+class Overloaded(Exception):
+    pass
+
+class MicroBatcher:
+    """Group concurrent requests into one model call
+
+    ``predict_many(model, items)`` scores a list of items and returns one
+    result per item.  A request is a list of items queued as one unit.
+    Requests queued while the previous batch was running are taken together
+    until they hold ``max_batch`` items; while traffic is heavy enough to
+    produce real batches the batcher also waits up to ``window`` seconds for
+    more.  At most ``max_queue`` items wait at once, but a request is always
+    accepted by an empty queue, however large.  Model calls run one at a
+    time on a dedicated thread so the event loop keeps accepting requests.
+    """
+
+    def __init__(self, name, predict_many, get_model, max_batch=DEFAULT_MAX_BATCH,
+                 window=DEFAULT_WINDOW_MS / 1000, max_queue=DEFAULT_MAX_QUEUE):
+        self.name = name
+        self.predict_many = predict_many
+        self.get_model = get_model
+        self.max_batch = max_batch
+        self.window = window
+        self.max_queue = max_queue
+        self.queue = asyncio.Queue()
+        self.queued_items = 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{name}-batch')
+        self.mean_batch = 1.0
+
+    async def submit_many(self, items, timeout=DEFAULT_TIMEOUT):
+        """Score a list of items as one request; raises Overloaded or asyncio.TimeoutError"""
+        if self.queued_items and self.queued_items + len(items) > self.max_queue:
+            metrics.incr(f'server_{self.name}_rejected_total')
+            raise Overloaded(f"{self.name} queue is full")
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((items, future))
+        self.queued_items += len(items)
+        return await asyncio.wait_for(future, timeout)
+
+    async def submit(self, item, timeout=DEFAULT_TIMEOUT):
+        """Score one item as part of a batch; raises Overloaded or asyncio.TimeoutError"""
+        return (await self.submit_many([item], timeout))[0]
+
+    def take(self, request, batch):
+        self.queued_items -= len(request[0])
+        batch.append(request)
+        return sum(len(items) for items, _ in batch)
+
+    async def next_batch(self):
+        batch = []
+        size = self.take(await self.queue.get(), batch)
+        while size < self.max_batch and not self.queue.empty():
+            size = self.take(self.queue.get_nowait(), batch)
+
+        if self.window > 0 and self.mean_batch >= ADAPTIVE_MIN_BATCH:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.window
+            while size < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    size = self.take(await asyncio.wait_for(self.queue.get(), remaining), batch)
+                except asyncio.TimeoutError:
+                    break
+
+        # Requests that already timed out are not worth scoring
+        return [(items, future) for items, future in batch if not future.done()]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            if not batch:
+                continue
+            items = [item for request_items, _ in batch for item in request_items]
+            self.mean_batch += BATCH_SIZE_SMOOTHING * (len(items) - self.mean_batch)
+            metrics.incr(f'server_{self.name}_batches_total')
+            metrics.incr(f'server_{self.name}_rows_total', len(items))
+
+            try:
+                with metrics.span(f'server_{self.name}_batch'):
+                    results = await loop.run_in_executor(self.executor, self.predict_many, self.get_model(), items)
+            except Exception as e:
+                logger.error("Error scoring a %s batch: %s", self.name, e)
+                results = [{"error": str(e)}] * len(items)
+
+            start = 0
+            for request_items, future in batch:
+                if not future.done():
+                    future.set_result(results[start:start + len(request_items)])
+                start += len(request_items)
+
+def predict_stages(predictor, records):
+    if predictor is None or predictor.model is None:
+        return [{"error": "Failed to load model"} for _ in records]
+    return predictor.predict_batch(records)
+
+def predict_recommendations(recommender, rows):
+    from predict import predict_results
+
+    if recommender is None:
+        return [{"error": "Failed to load the model"} for _ in rows]
+    return predict_results(rows, recommender)
+
+class InferenceServer:
+    """Newline-delimited JSON front end over one MicroBatcher per model
+
+    Each request is ``{"id", "model": "stage" | "recommender", "type",
+    "features"}`` with ``type`` ``predict`` (the default), ``predict_batch``
+    (with ``records`` instead of ``features``), ``ping`` or ``metrics``.
+    Responses carry the request's ``id`` and may arrive out of order.
+    """
+
+    def __init__(self, batchers, watchers=None, timeout=DEFAULT_TIMEOUT):
+        self.batchers = batchers
+        self.watchers = watchers or {}
+        self.timeout = timeout
+
+    async def predict(self, batcher, items):
+        """One response entry per item, scored as a single queued request"""
+        try:
+            results = await batcher.submit_many(items, self.timeout)
+        except Overloaded as e:
+            return [{"success": False, "error": f"Server overloaded: {str(e)}"}] * len(items)
+        except asyncio.TimeoutError:
+            metrics.incr(f'server_{batcher.name}_timeouts_total')
+            return [{"success": False, "error": "Prediction timed out"}] * len(items)
+        return [{"success": False, "error": result['error']} if 'error' in result
+                else {"success": True, "prediction": result} for result in results]
+
+    async def handle(self, message):
+        if not isinstance(message, dict):
+            return {"id": None, "success": False, "error": "Request must be a JSON object"}
+        request_id = message.get('id')
+        request_type = message.get('type', 'predict')
+        model_name = message.get('model', 'stage')
+        metrics.incr(f'server_{request_type}_requests_total')
+
+        if request_type == 'ping':
+            return {
+                "id": request_id,
+                "success": True,
+                "type": "pong",
+                "models": {
+                    name: {"loaded": batcher.get_model() is not None, "version": getattr(self.watchers.get(name), 'version', None)}
+                    for name, batcher in self.batchers.items()
+                }
+            }
+        if request_type == 'metrics':
+            if message.get('format') == 'prometheus':
+                return {"id": request_id, "success": True, "metrics": metrics.prometheus()}
+            return {"id": request_id, "success": True, "metrics": metrics.snapshot()}
+
+        batcher = self.batchers.get(model_name)
+        if batcher is None:
+            return {"id": request_id, "success": False, "error": f"Unknown model: {model_name}"}
+        if request_type == 'predict':
+            return dict((await self.predict(batcher, [message.get('features')]))[0], id=request_id)
+        if request_type == 'predict_batch':
+            records = message.get('records')
+            if not isinstance(records, list):
+                return {"id": request_id, "success": False, "error": "predict_batch requires a list of records"}
+            entries = await self.predict(batcher, records) if records else []
+            return {
+                "id": request_id,
+                "success": True,
+                "predictions": [dict(entry, index=index) for index, entry in enumerate(entries)]
+            }
+        return {"id": request_id, "success": False, "error": f"Unknown request type: {request_type}"}
+
+    async def connection(self, reader, writer):
+        in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        write_lock = asyncio.Lock()
+        tasks = set()
+
+        async def respond(message):
+            try:
+                response = await self.handle(message)
+                async with write_lock:
+                    writer.write((json.dumps(response) + "\n").encode('utf-8'))
+                    await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                in_flight.release()
+
+        try:
+            while True:
+                line = await read_line(reader)
+                if line is None:
+                    error = {"id": None, "success": False,
+                             "error": f"Request line longer than {MAX_LINE_BYTES} bytes"}
+                    async with write_lock:
+                        writer.write((json.dumps(error) + "\n").encode('utf-8'))
+                    continue
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    message = json.loads(line)
+                except ValueError as e:
+                    error = {"id": None, "success": False, "error": f"Invalid JSON: {str(e)}"}
+                    async with write_lock:
+                        writer.write((json.dumps(error) + "\n").encode('utf-8'))
+                    continue
+                # Stop reading from a client that has too much outstanding;
+                # the socket buffers then push back on it
+                await in_flight.acquire()
+                task = asyncio.create_task(respond(message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def watch(self, interval):
+        """Pick up newly published model versions without blocking requests"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            for watcher in self.watchers.values():
+                try:
+                    await loop.run_in_executor(None, watcher.poll)
+                except Exception as e:
+                    logger.error("Error checking for a new %s version: %s", watcher.name, e)
+
+async def read_line(reader):
+    """Next line, b'' at end of stream, or None for a line over the reader's limit
+
+    An overlong line is read through to its newline and dropped, so the
+    requests after it on the connection are still answered.
+    """
+    overrun = False
+    while True:
+        try:
+            line = await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            return None if overrun else e.partial
+        except asyncio.LimitOverrunError as e:
+            overrun = True
+            await reader.readexactly(e.consumed)
+            continue
+        return None if overrun else line
+
+def current_model(watcher, fallback):
+    """Newest version the watcher loaded, else the model loaded at startup"""
+    return lambda: watcher.model or fallback
+
+def build_server(models, runtime='compiled', window_ms=DEFAULT_WINDOW_MS, max_batch=DEFAULT_MAX_BATCH,
+                 max_queue=DEFAULT_MAX_QUEUE, timeout=DEFAULT_TIMEOUT):
+    """Load the requested models ('stage', 'recommender') and wrap them in a server"""
+    from model_registry import ModelRegistry, ModelWatcher
+
+    registry = ModelRegistry()
+    batchers, watchers = {}, {}
+    if 'stage' in models:
+        import crop_stage_predictor
+
+        watcher = ModelWatcher(registry, crop_stage_predictor.MODEL_NAME,
+                               lambda directory: crop_stage_predictor.load_version(directory, runtime))
+        watcher.poll()
+        fallback = None
+        if watcher.model is None:
+            fallback = crop_stage_predictor.CropStagePredictor()
+            if not fallback.load_model(crop_stage_predictor.LEGACY_MODEL_FILE, runtime):
+                fallback = None
+        watchers['stage'] = watcher
+        batchers['stage'] = MicroBatcher('stage', predict_stages, current_model(watcher, fallback),
+                                         max_batch, window_ms / 1000, max_queue)
+    if 'recommender' in models:
+        import predict
+
+        watcher = ModelWatcher(registry, predict.MODEL_NAME, predict.load_version)
+        watcher.poll()
+        fallback = None if watcher.model is not None else predict.get_recommender()
+        watchers['recommender'] = watcher
+        batchers['recommender'] = MicroBatcher('recommender', predict_recommendations,
+                                               current_model(watcher, fallback),
+                                               max_batch, window_ms / 1000, max_queue)
+    return InferenceServer(batchers, watchers, timeout)
+
+async def run_server(server, socket_path=None, host=None, port=None, poll_interval=2.0):
+    if host is not None:
+        listener = await asyncio.start_server(server.connection, host, port, limit=MAX_LINE_BYTES)
+        address = f"{host}:{port}"
+    else:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        listener = await asyncio.start_unix_server(server.connection, socket_path, limit=MAX_LINE_BYTES)
+        address = socket_path
+    # Tells a parent process that requests can be sent
+    print(json.dumps({"success": True, "listening": address}), flush=True)
+
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, lambda: stopped.done() or stopped.set_result(None))
+
+    background = [asyncio.create_task(batcher.run()) for batcher in server.batchers.values()]
+    background.append(asyncio.create_task(server.watch(poll_interval)))
+    async with listener:
+        await stopped
+    for task in background:
+        task.cancel()
+    if socket_path and host is None and os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-batching inference server for the crop models')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET, help='Unix socket to listen on')
+    parser.add_argument('--host', type=str, help='Listen on this TCP host instead of the Unix socket')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port used with --host')
+    parser.add_argument('--models', type=str, default='stage,recommender',
+                        help="Comma-separated models to serve: 'stage', 'recommender'")
+    parser.add_argument('--runtime', choices=['sklearn', 'compiled'], default='compiled',
+                        help='Stage model runtime; the recommender always prefers its compiled export')
+    parser.add_argument('--window-ms', type=float, default=DEFAULT_WINDOW_MS,
+                        help='Longest a request waits for others to join its batch')
+    parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH, help='Most requests per model call')
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE,
+                        help='Queued requests per model before new ones are rejected')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='Seconds before a request fails')
+    parser.add_argument('--log-level', type=str,
+                        help='Logging level for stderr diagnostics (default: $ML_LOG_LEVEL or WARNING)')
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    server = build_server(args.models.split(','), args.runtime, args.window_ms, args.max_batch,
+                          args.max_queue, args.timeout)
+    try:
+        asyncio.run(run_server(server, args.socket, args.host, args.port))
+    except Exception as e:
+        print(json.dumps({"success": False, "error": str(e)}), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
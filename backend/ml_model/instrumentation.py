@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# File a training run reports its progress to, set by training_jobs
+PROGRESS_ENV = 'ML_PROGRESS_FILE'
+
+# Log level for the prediction scripts when no --log-level is given
+LOG_LEVEL_ENV = 'ML_LOG_LEVEL'
+DEFAULT_LOG_LEVEL = 'WARNING'
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+logger = logging.getLogger('ml_model')
+
+def configure_logging(level=None):
+    """Send ml_model logs to stderr at the given level, or ML_LOG_LEVEL"""
+    level = (level or os.environ.get(LOG_LEVEL_ENV) or DEFAULT_LOG_LEVEL).upper()
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level)
+
+def report_progress(stage, fraction=None):
+    """Record how far a training run has got, for training_jobs to report"""
+    logger.info("Training progress: %s", stage)
+    path = os.environ.get(PROGRESS_ENV)
+    if not path:
+        return
+    staging = f"{path}.tmp"
+    with open(staging, 'w') as f:
+        json.dump({"stage": stage, "fraction": fraction, "updated_at": time.time()}, f)
+    os.replace(staging, path)
+
+class Metrics:
+    """Thread-safe counters and latency histograms for named spans"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = {'count': 0, 'sum': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+                self.histograms[name] = histogram
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block into the histogram called name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(name, elapsed)
+            logger.debug("%s took %.3f ms", name, elapsed * 1000)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """JSON-serializable view of every counter and histogram"""
+        with self._lock:
+            spans = {}
+            for name, histogram in self.histograms.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                    cumulative += count
+                    buckets['+Inf' if bound == float('inf') else repr(bound)] = cumulative
+                spans[name] = {
+                    'count': histogram['count'],
+                    'sum_seconds': histogram['sum'],
+                    'mean_seconds': histogram['sum'] / histogram['count'],
+                    'buckets': buckets
+                }
+            return {'counters': dict(self.counters), 'spans': spans}
+
+    def prometheus(self, prefix='ml_model'):
+        """The snapshot in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            lines.append(f"{prefix}_{name} {value}")
+        if snapshot['spans']:
+            metric = f"{prefix}_span_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for name, span in sorted(snapshot['spans'].items()):
+                for bound, count in span['buckets'].items():
+                    lines.append(f'{metric}_bucket{{span="{name}",le="{bound}"}} {count}')
+                lines.append(f'{metric}_sum{{span="{name}"}} {span["sum_seconds"]}')
+                lines.append(f'{metric}_count{{span="{name}"}} {span["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, output_format='json'):
+        if output_format == 'prometheus':
+            return self.prometheus()
+        return json.dumps(self.snapshot())
+
+# Process-wide registry shared by both predictors
+metrics = Metrics()
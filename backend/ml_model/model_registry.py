@@ -0,0 +1,295 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from instrumentation import logger, metrics
+
+# Every published model lives in <root>/<name>/versions/<version>/ and is
+# never modified afterwards; <root>/<name>/CURRENT names the version to serve
+REGISTRY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_registry')
+CURRENT_FILE = 'CURRENT'
+HISTORY_FILE = 'history.jsonl'
+METADATA_FILE = 'metadata.json'
+# Held by whichever process is training a new version of the model
+LOCK_FILE = 'writer.lock'
+
+# Published versions kept per model; older ones are pruned, never the current one
+DEFAULT_KEEP_VERSIONS = 5
+
+# Seconds between checks of the CURRENT pointer in long-lived processes
+DEFAULT_POLL_INTERVAL = 2.0
+
+def directory_hash(directory):
+    """SHA-256 over the relative paths and contents of every file in a directory"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, directory).replace(os.sep, '/').encode('utf-8') + b'\0')
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+def directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(directory)
+        for name in files
+    )
+
+def library_versions():
+    """Versions of the interpreter and libraries a trained artifact depends on"""
+    import platform
+    from importlib import metadata
+
+    # Read from package metadata so that nothing heavy is imported
+    versions = {'python': platform.python_version()}
+    for distribution in ('numpy', 'scikit-learn', 'joblib'):
+        try:
+            versions[distribution] = metadata.version(distribution)
+        except metadata.PackageNotFoundError:
+            versions[distribution] = None
+    return versions
+
+def training_fingerprint(dataset_hash, params, features, **settings):
+    """Hash of everything a training run's output depends on
+
+    Two runs with the same data, parameters, features, settings and library
+    versions produce the same model, so the second one can be skipped.
+    """
+    payload = {
+        'dataset': dataset_hash,
+        'params': params,
+        'features': list(features),
+        'settings': settings,
+        'libraries': library_versions()
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def write_atomic(path, text):
+    """Replace a small file so readers see either the old or the new contents"""
+    staging = f"{path}.tmp-{os.getpid()}"
+    with open(staging, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(staging, path)
+
+class ModelRegistry:
+    """Content-addressed model versions with an atomically switched CURRENT pointer
+
+    A training run builds its artifact in a directory from ``stage()`` and
+    hands it to ``publish()``, which names the version after the hash of its
+    files, moves it into place and, by default, activates it.  Readers only
+    ever open complete versions, so a retrain can never expose a half-written
+    model.
+    """
+
+    def __init__(self, root=REGISTRY_DIR):
+        self.root = root
+
+    def model_dir(self, name):
+        return os.path.join(self.root, name)
+
+    def version_dir(self, name, version):
+        return os.path.join(self.model_dir(name), 'versions', version)
+
+    def lock(self, name, blocking=True):
+        """Take the model's exclusive writer lock
+
+        Returns the open lock file, which holds the lock until it is closed
+        or the process exits, or None when another process holds it and
+        blocking is False.
+        """
+        os.makedirs(self.model_dir(name), exist_ok=True)
+        lock_file = open(os.path.join(self.model_dir(name), LOCK_FILE), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def discard_staging(self, name, pid):
+        """Delete the staging directories a (stopped) process left behind"""
+        pattern = os.path.join(self.model_dir(name), 'versions', f".staging-{pid}-*")
+        for staging in glob.glob(pattern):
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def stage(self, name):
+        """Empty directory to build a new artifact in"""
+        staging = os.path.join(self.model_dir(name), 'versions', f".staging-{os.getpid()}-{time.time_ns()}")
+        os.makedirs(staging)
+        return staging
+
+    def publish(self, name, staging, metadata=None, activate=True):
+        """Turn a staged artifact into an immutable version and return its id"""
+        version = directory_hash(staging)[:16]
+        metadata = dict(metadata or {})
+        metadata.update(
+            version=version,
+            created_at=time.time(),
+            size_bytes=directory_size(staging),
+            parent=self.current(name)
+        )
+        with open(os.path.join(staging, METADATA_FILE), 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+        target = self.version_dir(name, version)
+        if os.path.exists(target):
+            # Identical artifact already published; keep the original
+            shutil.rmtree(staging)
+        else:
+            os.replace(staging, target)
+
+        if activate:
+            self.activate(name, version)
+        return version
+
+    def activate(self, name, version):
+        """Point CURRENT at a published version"""
+        if not os.path.exists(os.path.join(self.version_dir(name, version), METADATA_FILE)):
+            raise ValueError(f"Unknown {name} version: {version}")
+        write_atomic(os.path.join(self.model_dir(name), CURRENT_FILE), version + "\n")
+        with open(os.path.join(self.model_dir(name), HISTORY_FILE), 'a') as f:
+            f.write(json.dumps({"version": version, "activated_at": time.time()}) + "\n")
+        logger.info("Activated %s version %s", name, version)
+
+    def current(self, name):
+        """Id of the active version, or None when nothing has been published"""
+        try:
+            with open(os.path.join(self.model_dir(name), CURRENT_FILE)) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def current_dir(self, name):
+        version = self.current(name)
+        return None if version is None else self.version_dir(name, version)
+
+    def metadata(self, name, version):
+        with open(os.path.join(self.version_dir(name, version), METADATA_FILE)) as f:
+            return json.load(f)
+
+    def versions(self, name):
+        """Metadata of every published version, oldest first"""
+        versions_dir = os.path.join(self.model_dir(name), 'versions')
+        if not os.path.isdir(versions_dir):
+            return []
+        entries = []
+        for version in os.listdir(versions_dir):
+            if version.startswith('.'):
+                continue
+            try:
+                entries.append(self.metadata(name, version))
+            except (OSError, ValueError):
+                continue
+        return sorted(entries, key=lambda entry: entry.get('created_at', 0))
+
+    def find_fingerprint(self, name, fingerprint):
+        """Published version trained from the given fingerprint, preferring the current one"""
+        current = self.current(name)
+        matches = [entry['version'] for entry in self.versions(name) if entry.get('fingerprint') == fingerprint]
+        if current in matches:
+            return current
+        return matches[-1] if matches else None
+
+    def history(self, name):
+        try:
+            with open(os.path.join(self.model_dir(name), HISTORY_FILE)) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except OSError:
+            return []
+
+    def rollback(self, name, version=None):
+        """Activate the given version, or the one active before the current one"""
+        current = self.current(name)
+        if version is None:
+            available = {entry['version'] for entry in self.versions(name)}
+            previous = [
+                entry['version'] for entry in self.history(name)
+                if entry['version'] != current and entry['version'] in available
+            ]
+            if not previous:
+                raise ValueError(f"No earlier {name} version to roll back to")
+            version = previous[-1]
+        self.activate(name, version)
+        return version
+
+    def prune(self, name, keep=DEFAULT_KEEP_VERSIONS):
+        """Delete all but the newest ``keep`` versions, never the active one"""
+        current = self.current(name)
+        removed = []
+        for entry in self.versions(name)[:-keep or None]:
+            if entry['version'] != current:
+                shutil.rmtree(self.version_dir(name, entry['version']), ignore_errors=True)
+                removed.append(entry['version'])
+        return removed
+
+class ModelWatcher:
+    """Keep the registry's current version of a model loaded, swapping in new ones
+
+    ``loader(directory)`` builds a ready-to-use model object from a version
+    directory, or returns None on failure.  New versions are loaded off the
+    request path by a background thread and swapped in with a single
+    assignment, so requests keep being answered by the old model until the
+    new one is ready; a version that fails to load is skipped.
+    """
+
+    def __init__(self, registry, name, loader, interval=DEFAULT_POLL_INTERVAL):
+        self.registry = registry
+        self.name = name
+        self.loader = loader
+        self.interval = interval
+        # (version, model), replaced as a whole so readers never see a mix
+        self.loaded = (None, None)
+        self._failed = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def model(self):
+        return self.loaded[1]
+
+    @property
+    def version(self):
+        return self.loaded[0]
+
+    def poll(self):
+        """Load the current version if it changed; returns True after a swap"""
+        version = self.registry.current(self.name)
+        if version is None or version == self.version or version == self._failed:
+            return False
+        with metrics.span(f'{self.name}_reload'):
+            model = self.loader(self.registry.version_dir(self.name, version))
+        if model is None:
+            logger.error("Failed to load %s version %s; keeping %s", self.name, version, self.version)
+            self._failed = version
+            return False
+        previous = self.version
+        self.loaded = (version, model)
+        metrics.incr(f'{self.name}_reloads_total')
+        logger.info("Swapped %s version %s for %s", self.name, previous, version)
+        return True
+
+    def start(self):
+        """Poll in a daemon thread until stop()"""
+        def run():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.poll()
+                except Exception as e:
+                    logger.error("Error checking for a new %s version: %s", self.name, e)
+
+        self._thread = threading.Thread(target=run, name=f'{self.name}-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,218 @@
+import argparse
+import io
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from instrumentation import configure_logging, logger, report_progress
+
+# Estimator classes a candidate's 'family' parameter can name
+MODEL_FAMILIES = {
+    'random_forest': ('sklearn.ensemble', 'RandomForestClassifier'),
+    'extra_trees': ('sklearn.ensemble', 'ExtraTreesClassifier'),
+    'decision_tree': ('sklearn.tree', 'DecisionTreeClassifier'),
+}
+
+DEFAULT_GRID = {
+    'family': ['random_forest', 'extra_trees', 'decision_tree'],
+    'n_estimators': [10, 25, 50, 100, 200],
+    'max_depth': [None, 8, 16],
+    'min_samples_leaf': [1, 2, 4],
+}
+
+LATENCY_REPEATS = 50
+THROUGHPUT_ROWS = 10000
+
+def build_model(params):
+    """Construct an estimator from a parameter dict with an optional 'family' key"""
+    import importlib
+
+    params = dict(params)
+    family = params.pop('family', 'random_forest')
+    if family not in MODEL_FAMILIES:
+        raise ValueError(f"Unknown model family: {family}")
+    if family == 'decision_tree':
+        # Single trees have no ensemble size or parallelism
+        params.pop('n_estimators', None)
+        params.pop('n_jobs', None)
+    module_name, class_name = MODEL_FAMILIES[family]
+    return getattr(importlib.import_module(module_name), class_name)(**params)
+
+def load_params(value):
+    """Read model parameters from a JSON string, a JSON file or a search report"""
+    if os.path.exists(value):
+        with open(value) as f:
+            params = json.load(f)
+    else:
+        params = json.loads(value)
+    if 'selected' in params:
+        params = params['selected']['params']
+    return params
+
+def candidate_grid(grid):
+    """Expand a parameter grid, collapsing combinations a family ignores"""
+    seen = set()
+    keys = list(grid)
+    for values in itertools.product(*(grid[key] for key in keys)):
+        params = dict(zip(keys, values))
+        if params.get('family') == 'decision_tree':
+            params.pop('n_estimators', None)
+        key = json.dumps(params, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            yield params
+
+_X = None
+_y = None
+
+def _init_worker(X, y):
+    global _X, _y
+    _X, _y = X, y
+
+def evaluate_candidate(params, cv=5, random_state=42):
+    """Cross-validate one candidate and measure its speed and serialized size"""
+    import joblib
+    from sklearn.model_selection import KFold, cross_val_score
+
+    model_params = dict(params, random_state=random_state)
+    folds = KFold(n_splits=cv, shuffle=True, random_state=random_state)
+    scores = cross_val_score(build_model(model_params), _X, _y, cv=folds, n_jobs=1)
+
+    model = build_model(model_params)
+    start = time.perf_counter()
+    model.fit(_X, _y)
+    fit_time = time.perf_counter() - start
+
+    row = _X[:1]
+    model.predict_proba(row)
+    latencies = []
+    for _ in range(LATENCY_REPEATS):
+        start = time.perf_counter()
+        model.predict_proba(row)
+        latencies.append(time.perf_counter() - start)
+
+    batch = _X[np.arange(THROUGHPUT_ROWS) % len(_X)]
+    start = time.perf_counter()
+    model.predict_proba(batch)
+    batch_time = time.perf_counter() - start
+
+    buffer = io.BytesIO()
+    joblib.dump(model, buffer)
+
+    return {
+        "params": params,
+        "accuracy": float(scores.mean()),
+        "accuracy_std": float(scores.std()),
+        "fit_time": fit_time,
+        "latency_ms": float(np.median(latencies) * 1000),
+        "throughput_rows_per_s": THROUGHPUT_ROWS / batch_time,
+        "size_bytes": buffer.getbuffer().nbytes
+    }
+
+def search(X, y, grid=None, cv=5, tolerance=0.01, workers=None):
+    """Evaluate every candidate across a process pool and pick the smallest good one
+
+    The selected candidate is the one with the smallest serialized size among
+    those whose accuracy is within ``tolerance`` of the best.
+    """
+    candidates = list(candidate_grid(grid or DEFAULT_GRID))
+    workers = workers or os.cpu_count() or 1
+    logger.info("Evaluating %d candidates on %d workers", len(candidates), workers)
+    report_progress('searching', 0.0)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(X, y)) as pool:
+        futures = [pool.submit(evaluate_candidate, params, cv) for params in candidates]
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.warning("Candidate failed: %s", e)
+            logger.info("Evaluated %d/%d", done, len(candidates))
+            report_progress('searching', done / len(candidates))
+
+    if not results:
+        raise ValueError(f"All {len(candidates)} candidates failed to evaluate")
+    results.sort(key=lambda result: (-result['accuracy'], result['size_bytes']))
+    best = results[0]
+    eligible = [result for result in results if result['accuracy'] >= best['accuracy'] - tolerance]
+    selected = min(eligible, key=lambda result: (result['size_bytes'], result['latency_ms']))
+    return {
+        "samples": int(len(y)),
+        "cv_folds": cv,
+        "tolerance": tolerance,
+        "best": best,
+        "selected": selected,
+        "candidates": results
+    }
+
+def load_stage_data(data_path):
+    from crop_stage_predictor import CropStagePredictor
+
+    predictor = CropStagePredictor()
+    if not predictor.load_data(data_path):
+        raise ValueError(f"Failed to load {data_path}")
+    return predictor.features.to_numpy(), np.asarray(predictor.target)
+
+def load_recommender_data(data_path):
+    from dataset_cache import load_dataset
+
+    df = load_dataset(data_path)
+    feature_names = [col for col in df.columns if col != 'label']
+    return df[feature_names].to_numpy(dtype=np.float64), df['label'].astype(str).to_numpy()
+
+def _int_or_none(value):
+    return None if value.lower() == 'none' else int(value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Hyperparameter and model-size search')
+    parser.add_argument('--target', choices=['stage', 'recommender'], default='stage',
+                        help='Model to search for')
+    parser.add_argument('--data', type=str, help='Dataset to search on')
+    parser.add_argument('--cv', type=int, default=5, help='Cross-validation folds')
+    parser.add_argument('--tolerance', type=float, default=0.01,
+                        help='Accuracy the selected model may give up against the best one')
+    parser.add_argument('--workers', type=int, help='Worker processes (default: all cores)')
+    parser.add_argument('--families', type=str, help='Comma-separated model families')
+    parser.add_argument('--n-estimators', type=str, help='Comma-separated tree counts')
+    parser.add_argument('--max-depth', type=str, help="Comma-separated depths ('none' for unlimited)")
+    parser.add_argument('--min-samples-leaf', type=str, help='Comma-separated leaf sizes')
+    parser.add_argument('--output', type=str, help='Write the full report to this JSON file')
+    parser.add_argument('--log-level', type=str, help='Logging level for stderr diagnostics')
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    grid = dict(DEFAULT_GRID)
+    if args.families:
+        grid['family'] = args.families.split(',')
+    if args.n_estimators:
+        grid['n_estimators'] = [int(value) for value in args.n_estimators.split(',')]
+    if args.max_depth:
+        grid['max_depth'] = [_int_or_none(value) for value in args.max_depth.split(',')]
+    if args.min_samples_leaf:
+        grid['min_samples_leaf'] = [int(value) for value in args.min_samples_leaf.split(',')]
+
+    try:
+        if args.target == 'stage':
+            X, y = load_stage_data(args.data or 'farmer_guide_crop_dataset.xlsx')
+        else:
+            X, y = load_recommender_data(args.data or 'sample_data.csv')
+        report = search(X, y, grid, args.cv, args.tolerance, args.workers)
+        report['target'] = args.target
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+
+        print(json.dumps({
+            "status": "success",
+            "best": report['best'],
+            "selected": report['selected']
+        }))
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": str(e)}))
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,138 @@
+import os
 import sys
 import json
 import numpy as np
-from crop_recommender import CropRecommender
+from crop_recommender import ARTIFACT_FILE, MODEL_NAME, CropRecommender
+from instrumentation import configure_logging, logger
+from model_registry import ModelRegistry
 
-def predict(features):
+# Reused across calls when this module is imported by a long-lived process,
+# so its prediction cache can answer repeated soil profiles
+_recommender = None
+_version = None
+_registry = ModelRegistry()
+
+def current_model_path(version):
+    """Model file of a registry version, or the unversioned file when there is none"""
+    if version is None:
+        return 'crop_model.joblib'
+    return os.path.join(_registry.version_dir(MODEL_NAME, version), ARTIFACT_FILE)
+
+def get_recommender():
+    """Load the recommender once per process, reloading when a new version is published"""
+    global _recommender, _version
+    version = _registry.current(MODEL_NAME)
+    if _recommender is None or version != _version:
+        model_path = current_model_path(version)
+        # The compiled export skips sklearn; load_model falls back to the
+        # joblib pickle when the model has not been exported
+        recommender = CropRecommender(runtime='compiled')
+        if not recommender.load_model(model_path):
+            if _recommender is not None:
+                logger.error("Failed to load %s version %s; keeping %s", MODEL_NAME, version, _version)
+            return _recommender
+        _recommender, _version = recommender, version
+    return _recommender
+
+def predict_results(rows, recommender=None):
+    """Prediction and class probabilities for many feature rows with one model evaluation"""
+    # Rows that cannot be scored get their own error instead of failing the batch
+    results = [None] * len(rows)
     try:
-        # Initialize the recommender
-        recommender = CropRecommender()
-        
         # Load the trained model
-        if not recommender.load_model():
-            return json.dumps({
-                'error': 'Failed to load the model'
-            })
-        
-        # Convert features to numpy array
-        features_array = np.array([features])
+        recommender = recommender or get_recommender()
+        if recommender is None:
+            return [{'error': 'Failed to load the model'} for _ in rows]
         
-        # Make prediction
-        prediction = recommender.predict(features_array)
-        probabilities = recommender.predict_proba(features_array)
+        if recommender.feature_names is not None:
+            n_features = len(recommender.feature_names)
+        else:
+            n_features = recommender.model.n_features_in_
         
-        # Get class probabilities
-        class_probs = {}
-        for label, prob in zip(recommender.model.classes_, probabilities[0]):
-            class_probs[label] = float(prob)
+        valid, values = [], []
+        for i, features in enumerate(rows):
+            try:
+                features = np.asarray(features, dtype=np.float64)
+            except (TypeError, ValueError) as e:
+                results[i] = {'error': f"Invalid features: {str(e)}"}
+                continue
+            if features.shape != (n_features,):
+                results[i] = {'error': f"Expected {n_features} features, got shape {features.shape}"}
+                continue
+            valid.append(i)
+            values.append(features)
         
-        return json.dumps({
-            'prediction': prediction[0],
-            'probabilities': class_probs
-        })
+        if valid:
+            probabilities = recommender.predict_proba(np.vstack(values))
+            if probabilities is None:
+                raise ValueError("Failed to make predictions")
+            labels = [str(label) for label in recommender.model.classes_]
+            for i, best, row in zip(valid, probabilities.argmax(axis=1).tolist(), probabilities.tolist()):
+                results[i] = {
+                    'prediction': labels[best],
+                    'probabilities': dict(zip(labels, row))
+                }
+        return results
         
     except Exception as e:
-        return json.dumps({
-            'error': str(e)
-        })
+        return [result or {'error': str(e)} for result in results]
+
+def predict_result(features, recommender=None):
+    """Prediction and class probabilities for one feature row, as a dict"""
+    return predict_results([features], recommender)[0]
+
+def predict(features):
+    return json.dumps(predict_result(features))
+
+def load_version(directory):
+    """A recommender for one registry version directory, or None if it fails to load"""
+    recommender = CropRecommender(runtime='compiled')
+    if not recommender.load_model(os.path.join(directory, ARTIFACT_FILE)):
+        return None
+    return recommender
+
+def serve(recommender, input_stream, output_stream):
+    """Answer newline-delimited {"id", "features"} requests with a pinned recommender"""
+    for line in iter(input_stream.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            message = json.loads(line)
+        except ValueError as e:
+            output_stream.write(json.dumps({'id': None, 'success': False, 'error': f"Invalid JSON: {str(e)}"}) + "\n")
+            output_stream.flush()
+            continue
+        if message.get('type') == 'shutdown':
+            break
+        result = predict_result(message.get('features'), recommender)
+        output_stream.write(json.dumps(dict(result, id=message.get('id'), success='error' not in result)) + "\n")
+        output_stream.flush()
 
 if __name__ == "__main__":
+    configure_logging()
+    
     # Get features from command line argument
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 1 and sys.argv[1] == '--profile-startup':
+        from startup_profile import profile_command
+        features = sys.argv[2] if len(sys.argv) > 2 else json.dumps([90, 42, 43, 20.87, 82.0, 6.5, 202.93])
+        print(json.dumps(profile_command([__file__, features])))
+    elif len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        # --serve [N]: answer JSON lines on stdin with N forked workers
+        from model_registry import ModelWatcher
+        from worker_pool import PreforkPool
+        
+        workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        watcher = ModelWatcher(_registry, MODEL_NAME, load_version)
+        watcher.poll()
+        recommender = watcher.model or get_recommender()
+        if recommender is None:
+            print(json.dumps({'error': 'Failed to load the model'}))
+            sys.exit(1)
+        try:
+            PreforkPool(serve, recommender, workers, watcher).run()
+        except KeyboardInterrupt:
+            pass
+    elif len(sys.argv) > 1:
         features = json.loads(sys.argv[1])
         result = predict(features)
         print(result)
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+class PredictionCache:
+    """LRU cache of prediction rows keyed by quantized feature vectors
+
+    ``quantization`` maps feature names to step sizes; readings that round to
+    the same multiple of every step share one entry.  Features without a step
+    are matched exactly.  Entries expire ``ttl`` seconds after they are stored.
+    Rows are copied on the way in and out, so callers may modify what they
+    get, and one cache can be shared between threads.
+    """
+
+    def __init__(self, max_size=1024, ttl=600.0, quantization=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.quantization = dict(quantization or {})
+        self.clock = clock
+        self.steps = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, feature_names):
+        """Line the quantization steps up with the model's feature columns"""
+        if feature_names is None or not self.quantization:
+            self.steps = None
+        else:
+            self.steps = np.array([float(self.quantization.get(name, 0)) for name in feature_names])
+
+    def keys(self, features):
+        """One hashable key per feature row"""
+        features = np.asarray(features, dtype=np.float64)
+        if self.steps is not None:
+            quantized = np.round(features / np.where(self.steps > 0, self.steps, 1.0))
+            features = np.where(self.steps > 0, quantized, features)
+        return [tuple(row) for row in features.tolist()]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, stored_at = entry
+            if self.ttl is not None and self.clock() - stored_at > self.ttl:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return np.array(value)
+
+    def put(self, key, value):
+        value = np.array(value)
+        with self._lock:
+            self._entries[key] = (value, self.clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry, e.g. because a different model was loaded"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
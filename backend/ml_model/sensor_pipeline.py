@@ -0,0 +1,385 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+from crop_stage_model import FEATURES, MODEL_FILE, CropStagePredictor
+from instrumentation import configure_logging, logger, metrics
+
+# Columns of a reading; a reading may leave any sensor column out or empty
+TIMESTAMP_COLUMN = 'timestamp'
+FIELD_COLUMN = 'field_id'
+# Optional observed growth stage, used as the training label
+LABEL_COLUMN = 'stage'
+CHANNELS = ('temperature', 'humidity', 'soil_moisture', 'light_intensity')
+
+# Readings per field the rolling means cover (a day at one reading every 15 minutes)
+DEFAULT_WINDOW = 96
+# Base temperature (degrees C) of the growing degree days
+DEFAULT_BASE_TEMPERATURE = 10.0
+# Soil moisture (%) below which the moisture deficit accumulates
+DEFAULT_MOISTURE_TARGET = 30.0
+# A longer gap between two readings of a field counts as this long, so an
+# offline sensor does not add days of degree days or deficit at once
+MAX_GAP_SECONDS = 6 * 3600
+DEFAULT_CHUNK_SIZE = 200000
+# Decimals written to output files; formatting full float precision
+# dominates the run time of the features command
+OUTPUT_DECIMALS = 4
+
+SECONDS_PER_DAY = 86400.0
+
+STATE_ARRAYS = ('buffer', 'head', 'filled', 'last_time', 'last_values', 'planted_at',
+                'degree_days', 'deficit', 'latest')
+
+def to_seconds(values):
+    """Epoch seconds from numeric epoch seconds or date strings; NaN where unparseable"""
+    import pandas as pd
+
+    series = pd.Series(values)
+    if series.dtype.kind in 'iuf':
+        return series.to_numpy(dtype=np.float64)
+    stamps = pd.to_datetime(series, utc=True, errors='coerce')
+    return ((stamps - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(seconds=1)).to_numpy(dtype=np.float64)
+
+def read_readings(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield a CSV or JSONL file of readings as DataFrames of at most chunk_size rows"""
+    import pandas as pd
+
+    if os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson', '.json'):
+        chunks = pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False, convert_dates=False)
+    else:
+        chunks = pd.read_csv(path, chunksize=chunk_size, dtype={FIELD_COLUMN: str, LABEL_COLUMN: str})
+    with chunks as reader:
+        yield from reader
+
+def chunk_arrays(chunk):
+    """(timestamps, field ids, sensor values) of a chunk, without rows lacking a time or field"""
+    times = to_seconds(chunk[TIMESTAMP_COLUMN])
+    fields = chunk[FIELD_COLUMN].astype(str).to_numpy()
+    values = np.column_stack([
+        np.asarray(chunk[name], dtype=np.float64) if name in chunk else np.full(len(chunk), np.nan)
+        for name in CHANNELS
+    ]).reshape(len(chunk), len(CHANNELS))
+    keep = ~np.isnan(times) & chunk[FIELD_COLUMN].notna().to_numpy()
+    return times[keep], fields[keep], values[keep], keep
+
+def _interval_mean(previous, current):
+    """Mean of each reading and the one before it, or whichever of them is known"""
+    return np.where(np.isnan(previous), current,
+                    np.where(np.isnan(current), previous, (previous + current) / 2))
+
+class SensorPipeline:
+    """Per-field stage model features computed from a stream of sensor readings
+
+    Readings are fed in chunks.  Each field keeps a ring buffer of its last
+    ``window`` readings, so the rolling means of a chunk's first readings
+    include the previous chunk's, plus running totals of growing degree
+    days and moisture deficit (both in units of days).  A chunk is processed
+    with array operations over all its fields at once; readings of a field
+    that are not newer than the last one it has seen are dropped.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, base_temperature=DEFAULT_BASE_TEMPERATURE,
+                 moisture_target=DEFAULT_MOISTURE_TARGET, planted=None):
+        self.window = max(1, int(window))
+        self.base_temperature = float(base_temperature)
+        self.moisture_target = float(moisture_target)
+        # Field id -> planting date; fields not listed count from their first reading
+        self.planted = dict(planted or {})
+        self.field_ids = []
+        self.index = {}
+        self.buffer = np.empty((0, self.window, len(CHANNELS)))
+        # Slot of each field's oldest reading, and how many slots hold readings
+        self.head = np.zeros(0, dtype=np.int64)
+        self.filled = np.zeros(0, dtype=np.int64)
+        self.last_time = np.empty(0)
+        self.last_values = np.empty((0, len(CHANNELS)))
+        self.planted_at = np.empty(0)
+        self.degree_days = np.empty(0)
+        self.deficit = np.empty(0)
+        # Features as of each field's latest reading
+        self.latest = np.empty((0, len(FEATURES)))
+
+    def _codes(self, fields):
+        """Row index of each field id, adding fields seen for the first time"""
+        import pandas as pd
+
+        codes, uniques = pd.factorize(fields)
+        new = [field for field in uniques if field not in self.index]
+        if new:
+            for field in new:
+                self.index[field] = len(self.field_ids)
+                self.field_ids.append(field)
+            count = len(new)
+            planted = np.array([self.planted.get(field, np.nan) for field in new], dtype=object)
+            dated = np.array([value == value for value in planted], dtype=bool)
+            planted_at = np.full(count, np.nan)
+            if dated.any():
+                planted_at[dated] = to_seconds(planted[dated].tolist())
+            self.buffer = np.concatenate([self.buffer, np.full((count, self.window, len(CHANNELS)), np.nan)])
+            self.head = np.concatenate([self.head, np.zeros(count, dtype=np.int64)])
+            self.filled = np.concatenate([self.filled, np.zeros(count, dtype=np.int64)])
+            self.last_time = np.concatenate([self.last_time, np.full(count, np.nan)])
+            self.last_values = np.concatenate([self.last_values, np.full((count, len(CHANNELS)), np.nan)])
+            self.planted_at = np.concatenate([self.planted_at, planted_at])
+            self.degree_days = np.concatenate([self.degree_days, np.zeros(count)])
+            self.deficit = np.concatenate([self.deficit, np.zeros(count)])
+            self.latest = np.concatenate([self.latest, np.full((count, len(FEATURES)), np.nan)])
+        mapping = np.array([self.index[field] for field in uniques], dtype=np.int64)
+        return mapping[codes]
+
+    def process(self, times, fields, values):
+        """Features of a chunk of readings
+
+        Returns (order, features): the positions of the readings that were
+        kept, sorted by field and time, and their FEATURES rows.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64).reshape(len(times), len(CHANNELS))
+        codes = self._codes(np.asarray(fields))
+        order = np.lexsort((times, codes))
+        codes, times, values = codes[order], times[order], values[order]
+
+        # NaN compares False, so a field's first readings are always kept
+        fresh = ~(times <= self.last_time[codes])
+        fresh[1:] &= (codes[1:] != codes[:-1]) | (times[1:] > times[:-1])
+        if not fresh.all():
+            metrics.incr('sensor_readings_dropped_total', int((~fresh).sum()))
+            order, codes, times, values = order[fresh], codes[fresh], times[fresh], values[fresh]
+        count = len(times)
+        if count == 0:
+            return order, np.empty((0, len(FEATURES)))
+
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        ends = np.append(starts[1:], count) - 1
+        segment_fields = codes[starts]
+        segment = np.repeat(np.arange(len(starts)), ends - starts + 1)
+
+        # Lay each field's buffered readings, oldest first, before its new
+        # ones, so one cumulative sum gives every rolling window
+        window = self.window
+        history = window - 1
+        slots = (self.head[segment_fields, None] + np.arange(window)) % window
+        buffered = self.buffer[segment_fields[:, None], slots][:, 1:]
+        extended = np.empty((len(starts) * history + count, len(CHANNELS)))
+        positions = np.arange(count) + (segment + 1) * history
+        history_positions = (starts + np.arange(len(starts)) * history)[:, None] + np.arange(history)
+        extended[positions] = values
+        extended[history_positions.reshape(-1)] = buffered.reshape(-1, len(CHANNELS))
+
+        known = ~np.isnan(extended)
+        zero = np.zeros((1, len(CHANNELS)))
+        sums = np.concatenate([zero, np.cumsum(np.where(known, extended, 0.0), axis=0)])
+        counts = np.concatenate([zero, np.cumsum(known, axis=0)])
+        window_sums = sums[positions + 1] - sums[positions + 1 - window]
+        window_counts = counts[positions + 1] - counts[positions + 1 - window]
+        means = np.divide(window_sums, window_counts, out=np.full_like(window_sums, np.nan),
+                          where=window_counts > 0)
+
+        # The last `window` readings of each field become its buffer
+        last_positions = positions[ends][:, None] - window + 1 + np.arange(window)
+        self.buffer[segment_fields] = extended[last_positions]
+        self.head[segment_fields] = 0
+        self.filled[segment_fields] = np.minimum(self.filled[segment_fields] + ends - starts + 1, window)
+
+        previous_times = np.r_[np.nan, times[:-1]]
+        previous_times[starts] = self.last_time[segment_fields]
+        days = np.nan_to_num(np.clip(times - previous_times, 0, MAX_GAP_SECONDS)) / SECONDS_PER_DAY
+        previous_values = np.concatenate([np.full((1, len(CHANNELS)), np.nan), values[:-1]])
+        previous_values[starts] = self.last_values[segment_fields]
+        interval = _interval_mean(previous_values, values)
+
+        temperature = interval[:, CHANNELS.index('temperature')]
+        moisture = interval[:, CHANNELS.index('soil_moisture')]
+        degree_days = self._accumulate(
+            np.nan_to_num(np.maximum(temperature - self.base_temperature, 0)) * days,
+            self.degree_days, starts, segment, segment_fields)
+        deficit = self._accumulate(
+            np.nan_to_num(np.maximum(self.moisture_target - moisture, 0)) * days,
+            self.deficit, starts, segment, segment_fields)
+
+        unplanted = np.isnan(self.planted_at[segment_fields])
+        self.planted_at[segment_fields[unplanted]] = times[starts[unplanted]]
+        days_planted = (times - self.planted_at[codes]) / SECONDS_PER_DAY
+
+        columns = {name: means[:, index] for index, name in enumerate(CHANNELS)}
+        columns.update(days_planted=days_planted, growing_degree_days=degree_days, moisture_deficit=deficit)
+        features = np.column_stack([columns[name] for name in FEATURES])
+
+        self.last_time[segment_fields] = times[ends]
+        self.last_values[segment_fields] = values[ends]
+        self.degree_days[segment_fields] = degree_days[ends]
+        self.deficit[segment_fields] = deficit[ends]
+        self.latest[segment_fields] = features[ends]
+        metrics.incr('sensor_readings_total', count)
+        return order, features
+
+    @staticmethod
+    def _accumulate(increments, carried, starts, segment, segment_fields):
+        """Running total per field, continuing from the total carried over"""
+        totals = np.cumsum(increments)
+        before = totals[starts] - increments[starts]
+        return carried[segment_fields][segment] + totals - before[segment]
+
+    def process_chunk(self, chunk):
+        """Features of a DataFrame chunk; returns (rows of the chunk, features)"""
+        times, fields, values, keep = chunk_arrays(chunk)
+        order, features = self.process(times, fields, values)
+        return np.flatnonzero(keep)[order], features
+
+    def snapshot(self):
+        """(field ids, FEATURES rows) as of every field's latest reading"""
+        return list(self.field_ids), self.latest.copy()
+
+    def save_state(self, path):
+        """Write the buffers and running totals so a later run can continue the stream"""
+        staging = f"{path}.tmp-{os.getpid()}.npz"
+        np.savez(staging, field_ids=np.array(self.field_ids, dtype=str), settings=json.dumps({
+            'window': self.window,
+            'base_temperature': self.base_temperature,
+            'moisture_target': self.moisture_target,
+            'planted': self.planted
+        }), **{name: getattr(self, name) for name in STATE_ARRAYS})
+        os.replace(staging, path)
+
+    @classmethod
+    def load_state(cls, path):
+        with np.load(path) as state:
+            pipeline = cls(**json.loads(str(state['settings'])))
+            pipeline.field_ids = state['field_ids'].tolist()
+            pipeline.index = {field: code for code, field in enumerate(pipeline.field_ids)}
+            for name in STATE_ARRAYS:
+                setattr(pipeline, name, state[name].copy())
+        return pipeline
+
+def stream_features(pipeline, paths, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield (chunk, rows of the chunk, features) over every chunk of every file"""
+    total = 0
+    start = time.perf_counter()
+    for path in paths:
+        for chunk in read_readings(path, chunk_size):
+            with metrics.span('sensor_chunk'):
+                rows, features = pipeline.process_chunk(chunk)
+            total += len(chunk)
+            yield chunk, rows, features
+    elapsed = time.perf_counter() - start
+    logger.info("Processed %d readings in %.2fs (%.0f readings/s)", total, elapsed, total / max(elapsed, 1e-9))
+
+def features_frame(chunk, rows, features):
+    import pandas as pd
+
+    frame = pd.DataFrame(features, columns=FEATURES)
+    frame.insert(0, TIMESTAMP_COLUMN, chunk[TIMESTAMP_COLUMN].to_numpy()[rows])
+    frame.insert(0, FIELD_COLUMN, chunk[FIELD_COLUMN].astype(str).to_numpy()[rows])
+    return frame
+
+def write_frames(frames, output_path):
+    """Write DataFrames one after another into a single CSV file"""
+    first = True
+    for frame in frames:
+        frame.round(OUTPUT_DECIMALS).to_csv(output_path, mode='w' if first else 'a', header=first, index=False)
+        first = False
+
+def training_rows(pipeline, paths, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Features and stage labels of the readings that carry a stage"""
+    X, y = [], []
+    for chunk, rows, features in stream_features(pipeline, paths, chunk_size):
+        if LABEL_COLUMN not in chunk:
+            continue
+        labels = chunk[LABEL_COLUMN].fillna('').astype(str).to_numpy()[rows]
+        labeled = labels != ''
+        X.append(features[labeled])
+        y.append(labels[labeled])
+    if not X:
+        return np.empty((0, len(FEATURES))), np.empty(0, dtype=object)
+    return np.concatenate(X), np.concatenate(y)
+
+def load_planted(value):
+    """Field id -> planting date mapping from a JSON string or file"""
+    if not value:
+        return None
+    if os.path.exists(value):
+        with open(value) as f:
+            return json.load(f)
+    return json.loads(value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute sensor features and train or run the sensor stage model')
+    parser.add_argument('command', choices=['features', 'train', 'predict'])
+    parser.add_argument('inputs', nargs='+', help='CSV or JSONL files of timestamped readings, in time order')
+    parser.add_argument('--output', type=str, help='CSV file of per-reading features or predictions')
+    parser.add_argument('--model', type=str, default=MODEL_FILE, help='Sensor stage model file')
+    parser.add_argument('--state', type=str, help='Pipeline state file to continue from and update')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Readings processed at a time')
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help='Readings per rolling mean')
+    parser.add_argument('--base-temperature', type=float, default=DEFAULT_BASE_TEMPERATURE,
+                        help='Base temperature of the growing degree days')
+    parser.add_argument('--moisture-target', type=float, default=DEFAULT_MOISTURE_TARGET,
+                        help='Soil moisture below which the deficit accumulates')
+    parser.add_argument('--planted', type=str, help='JSON (or JSON file) mapping field ids to planting dates')
+    parser.add_argument('--log-level', type=str, help='Logging level for stderr diagnostics')
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    try:
+        if args.state and os.path.exists(args.state):
+            pipeline = SensorPipeline.load_state(args.state)
+            pipeline.planted.update(load_planted(args.planted) or {})
+        else:
+            pipeline = SensorPipeline(args.window, args.base_temperature, args.moisture_target,
+                                      load_planted(args.planted))
+
+        if args.command == 'features':
+            if not args.output:
+                parser.error('features needs --output')
+            write_frames((features_frame(chunk, rows, features)
+                          for chunk, rows, features in stream_features(pipeline, args.inputs, args.chunk_size)),
+                         args.output)
+            result = {"status": "success", "fields": len(pipeline.field_ids)}
+
+        elif args.command == 'train':
+            X, y = training_rows(pipeline, args.inputs, args.chunk_size)
+            if len(X) == 0:
+                print(json.dumps({"status": "error", "message": f"No readings with a '{LABEL_COLUMN}' label"}))
+                return
+            predictor = CropStagePredictor()
+            predictor.train(X, y)
+            if not predictor.save_model(args.model):
+                print(json.dumps({"status": "error", "message": "Failed to save model"}))
+                return
+            result = {"status": "success", "message": "Model trained successfully",
+                      "rows": int(len(X)), "fields": len(pipeline.field_ids)}
+
+        else:
+            predictor = CropStagePredictor()
+            if not predictor.load_model(args.model):
+                print(json.dumps({"status": "error", "message": "Failed to load model"}))
+                return
+            if args.output:
+                def predictions():
+                    for chunk, rows, features in stream_features(pipeline, args.inputs, args.chunk_size):
+                        frame = features_frame(chunk, rows, features)
+                        stages, probabilities = predictor.predict_batch(features)
+                        frame['predicted_stage'] = stages
+                        frame['confidence'] = probabilities.max(axis=1, initial=0.0)
+                        yield frame
+                write_frames(predictions(), args.output)
+            else:
+                for _ in stream_features(pipeline, args.inputs, args.chunk_size):
+                    pass
+            field_ids, latest = pipeline.snapshot()
+            stages, probabilities = predictor.predict_batch(latest)
+            result = {"status": "success", "predictions": {
+                field: {"stage": stage, "confidence": float(row.max())}
+                for field, stage, row in zip(field_ids, stages, probabilities)
+            }}
+
+        if args.state:
+            pipeline.save_state(args.state)
+        print(json.dumps(result))
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": str(e)}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import json
+import subprocess
+import sys
+import time
+
+# Modules the prediction path should never need; they belong to training,
+# dataset analysis and plotting
+HEAVY_MODULES = [
+    'pandas',
+    'matplotlib',
+    'seaborn',
+    'openpyxl',
+    'sklearn.model_selection',
+    'sklearn.metrics',
+]
+
+def parse_importtime(stderr):
+    """Collect (module, depth, cumulative seconds) from `python -X importtime` output"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        try:
+            cumulative = int(fields[1]) / 1e6
+        except ValueError:
+            # Column header line
+            continue
+        name = fields[2][1:]
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+        entries.append((name.strip(), depth, cumulative))
+    return entries
+
+def profile_command(args, top=15):
+    """Run a Python command under -X importtime and report where its startup goes
+
+    Prints one line per top-level import in the style of test_imports.py to
+    stderr and returns a JSON-serializable summary.
+    """
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', *args],
+        capture_output=True,
+        text=True
+    )
+    wall_time = time.perf_counter() - start
+
+    entries = parse_importtime(completed.stderr)
+
+    # importtime lists children before their parent, so walk backwards to
+    # find which top-level import pulled each module in
+    imported_via = {}
+    top_level_name = None
+    for name, depth, _ in reversed(entries):
+        if depth == 0:
+            top_level_name = name
+        imported_via.setdefault(name, top_level_name)
+
+    top_level = sorted(
+        ((name, cumulative) for name, depth, cumulative in entries if depth == 0),
+        key=lambda item: item[1],
+        reverse=True
+    )
+
+    for name, cumulative in top_level[:top]:
+        print(f"{name} imported in {cumulative * 1000:.1f} ms", file=sys.stderr)
+    heavy = {name: imported_via[name] for name in HEAVY_MODULES if name in imported_via}
+    if heavy:
+        print("\nHeavy modules imported:", file=sys.stderr)
+        for name, via in heavy.items():
+            print(f"- {name} (via {via})", file=sys.stderr)
+    else:
+        print("\nNo training or plotting modules imported", file=sys.stderr)
+
+    try:
+        output = json.loads(completed.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        output = completed.stdout.strip()
+
+    return {
+        "command": args,
+        "exit_code": completed.returncode,
+        "wall_time": round(wall_time, 4),
+        "import_time": round(sum(cumulative for _, cumulative in top_level), 4),
+        "modules": [
+            {"module": name, "cumulative_time": round(cumulative, 4)}
+            for name, cumulative in top_level[:top]
+        ],
+        "heavy_modules": heavy,
+        "output": output
+    }
@@ -0,0 +1,105 @@
+import os
+import numpy as np
+import pytest
+import dataset_cache
+from dataset_cache import cache_path, ensure_cache, load_columns, load_dataset
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'data.csv'
+    path.write_text('crop,day\npaddy,10\nmaize,20\n')
+    return str(path)
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / 'cache')
+
+def builds(directory):
+    """Build directories of a cache, excluding its link and lock file"""
+    parent, name = os.path.split(directory)
+    return sorted(
+        entry for entry in os.listdir(parent)
+        if entry.startswith(f"{name}.") and os.path.isdir(os.path.join(parent, entry))
+    )
+
+def rewrite(path, text):
+    # Bump the mtime explicitly so the change is seen on coarse-grained clocks
+    stat = os.stat(path)
+    with open(path, 'w') as f:
+        f.write(text)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+def test_cache_path_links_to_a_build(source, cache_dir):
+    build, meta = ensure_cache(source, cache_dir)
+    directory = cache_path(source, cache_dir)
+    assert os.path.islink(directory)
+    assert os.path.realpath(directory) == build
+    assert meta['rows'] == 2
+    assert builds(directory) == [os.path.basename(build)]
+
+    columns = load_columns(source, cache_dir=cache_dir)
+    values, categories = columns['crop']
+    assert list(categories[values]) == ['paddy', 'maize']
+    assert list(columns['day'][0]) == [10, 20]
+    assert ensure_cache(source, cache_dir) == (build, meta)
+
+def test_changed_source_swaps_in_a_new_build(source, cache_dir):
+    old_build, _ = ensure_cache(source, cache_dir)
+    rewrite(source, 'crop,day\npaddy,10\nmaize,20\ncotton,30\n')
+
+    build, meta = ensure_cache(source, cache_dir)
+    assert build != old_build
+    assert meta['rows'] == 3
+    # The replaced build is removed once the link points at the new one
+    assert not os.path.exists(old_build)
+    assert builds(cache_path(source, cache_dir)) == [os.path.basename(build)]
+    assert list(load_dataset(source, cache_dir=cache_dir)['crop']) == ['paddy', 'maize', 'cotton']
+
+def test_touched_source_keeps_its_build(source, cache_dir):
+    build, meta = ensure_cache(source, cache_dir)
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    touched_build, touched_meta = ensure_cache(source, cache_dir)
+    assert touched_build == build
+    assert touched_meta['sha256'] == meta['sha256']
+    assert touched_meta['mtime_ns'] == os.stat(source).st_mtime_ns
+
+def test_legacy_directory_is_replaced(source, cache_dir):
+    # Caches used to be written straight into the cache path
+    directory = cache_path(source, cache_dir)
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        f.write('{}')
+
+    build, meta = ensure_cache(source, cache_dir)
+    assert os.path.islink(directory)
+    assert builds(directory) == [os.path.basename(build)]
+    assert meta['rows'] == 2
+
+def test_stale_builds_are_removed(source, cache_dir):
+    ensure_cache(source, cache_dir)
+    # Left behind by a process stopped mid-build
+    stale = f"{cache_path(source, cache_dir)}.0123456789abcdef"
+    os.makedirs(stale)
+    rewrite(source, 'crop,day\npaddy,11\n')
+
+    build, _ = ensure_cache(source, cache_dir)
+    assert not os.path.exists(stale)
+    assert builds(cache_path(source, cache_dir)) == [os.path.basename(build)]
+
+def test_load_columns_retries_after_a_concurrent_rebuild(source, cache_dir, monkeypatch):
+    ensure_cache(source, cache_dir)
+    load = dataset_cache._load_columns
+    calls = []
+
+    def vanishing_build(directory, meta, columns, mmap_mode):
+        calls.append(directory)
+        if len(calls) == 1:
+            raise FileNotFoundError(directory)
+        return load(directory, meta, columns, mmap_mode)
+
+    monkeypatch.setattr(dataset_cache, '_load_columns', vanishing_build)
+    columns = load_columns(source, ['day'], cache_dir)
+    assert len(calls) == 2
+    assert np.array_equal(columns['day'][0], [10, 20])
@@ -0,0 +1,88 @@
+import json
+import sys
+import numpy as np
+import pytest
+import crop_stage_predictor
+from crop_stage_predictor import CropStagePredictor, MODEL_NAME, clean_observations, read_observations
+from model_registry import ModelRegistry
+
+DATASET = 'farmer_guide_crop_dataset.xlsx'
+PARAMS = {'family': 'random_forest', 'n_estimators': 30, 'random_state': 42}
+
+@pytest.fixture
+def predictor():
+    predictor = CropStagePredictor()
+    predictor.use_table = False
+    assert predictor.load_data(DATASET)
+    assert predictor.train_model(PARAMS)
+    return predictor
+
+def stage_at(predictor, crop, day):
+    return predictor.predict_stage({'crop': crop, 'days_since_planting': day})['stage']
+
+def run_update(monkeypatch, capsys, registry, records_path):
+    monkeypatch.setattr(sys, 'argv', ['crop_stage_predictor.py', '--registry', registry.root,
+                                      '--update', str(records_path)])
+    crop_stage_predictor.main()
+    return json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+
+def test_known_classes_grow_the_forest(predictor):
+    records = clean_observations([{'crop': 'maize', 'days_since_planting': 20, 'stage': 'Seedling'}])
+    assert predictor.unseen_classes(records) == ([], [])
+    assert predictor.update_model(records, extra_trees=5) == 1
+    assert len(predictor.model.estimators_) == 35
+
+def test_unseen_crop_needs_a_refit(predictor):
+    records = clean_observations([{'crop': 'Wheat', 'days_since_planting': 40, 'stage': 'Tillering'}])
+    assert predictor.unseen_classes(records) == (['wheat'], ['Tillering'])
+    with pytest.raises(ValueError, match='full retrain'):
+        predictor.update_model(records)
+
+    # The refit --update falls back to; one observation decides the new crop
+    assert predictor.load_data(DATASET, records)
+    assert predictor.train_model(PARAMS)
+    assert stage_at(predictor, 'wheat', 40) == 'Tillering'
+
+def test_stage_new_to_a_crop_needs_a_refit(predictor):
+    records = clean_observations([{'crop': 'paddy', 'days_since_planting': 33, 'stage': 'Boll Formation'}])
+    assert predictor.unseen_classes(records) == ([], ['Boll Formation'])
+
+    assert predictor.load_data(DATASET, records)
+    assert predictor.train_model(PARAMS)
+    assert stage_at(predictor, 'paddy', 33) == 'Boll Formation'
+    assert predictor.sample_weight[-1] > predictor.sample_weight[0]
+
+def test_update_command_publishes_and_logs_records(predictor, tmp_path, monkeypatch, capsys):
+    registry = ModelRegistry(str(tmp_path / 'registry'))
+    base = predictor.publish(registry, source='train')
+    observations = tmp_path / 'observations.jsonl'
+    monkeypatch.setattr(crop_stage_predictor, 'OBSERVATIONS_FILE', str(observations))
+
+    known = tmp_path / 'known.jsonl'
+    known.write_text(json.dumps({'crop': 'maize', 'days_since_planting': 20, 'stage': 'Seedling'}) + '\n')
+    result = run_update(monkeypatch, capsys, registry, known)
+    assert result['message'] == 'Model updated'
+    assert result['trees'] == 40
+    assert registry.current(MODEL_NAME) == result['version']
+    assert registry.metadata(MODEL_NAME, result['version'])['parent'] == base
+    assert len(read_observations(str(observations))) == 1
+
+    # An unseen crop is retrained into the model with the logged records
+    unseen = tmp_path / 'unseen.jsonl'
+    unseen.write_text(json.dumps({'crop': 'Wheat', 'days_since_planting': 40, 'stage': 'Tillering'}) + '\n')
+    result = run_update(monkeypatch, capsys, registry, unseen)
+    assert result['message'] == 'Model compacted'
+    assert [record['crop'] for record in read_observations(str(observations))] == ['maize', 'wheat']
+
+    empty = tmp_path / 'empty.jsonl'
+    empty.write_text('')
+    assert run_update(monkeypatch, capsys, registry, empty) == {
+        'status': 'error', 'message': 'No valid records to train on'}
+    assert len(read_observations(str(observations))) == 2
+
+def test_compressed_models_cannot_be_updated(predictor):
+    predictor.compress(max_accuracy_loss=0.05)
+    assert not predictor.supports_update()
+    records = clean_observations([{'crop': 'maize', 'days_since_planting': 20, 'stage': 'Seedling'}])
+    with pytest.raises(ValueError, match='cannot be updated incrementally'):
+        predictor.update_model(records)
@@ -0,0 +1,89 @@
+import os
+import pytest
+from model_registry import ModelRegistry
+
+NAME = 'crop_stage'
+
+@pytest.fixture
+def registry(tmp_path):
+    return ModelRegistry(str(tmp_path))
+
+def publish(registry, contents, **kwargs):
+    staging = registry.stage(NAME)
+    with open(os.path.join(staging, 'model.txt'), 'w') as f:
+        f.write(contents)
+    return registry.publish(NAME, staging, **kwargs)
+
+def test_publish_activates_an_immutable_version(registry):
+    assert registry.current(NAME) is None
+    first = publish(registry, 'one', metadata={'source': 'train'})
+    assert registry.current(NAME) == first
+    assert registry.metadata(NAME, first)['source'] == 'train'
+    assert registry.metadata(NAME, first)['parent'] is None
+
+    second = publish(registry, 'two')
+    assert registry.current(NAME) == second
+    assert registry.metadata(NAME, second)['parent'] == first
+    with open(os.path.join(registry.version_dir(NAME, first), 'model.txt')) as f:
+        assert f.read() == 'one'
+
+def test_identical_artifacts_share_a_version(registry):
+    first = publish(registry, 'one')
+    assert publish(registry, 'one') == first
+    assert [entry['version'] for entry in registry.versions(NAME)] == [first]
+    # Nothing is left staged
+    assert os.listdir(os.path.join(registry.model_dir(NAME), 'versions')) == [first]
+
+def test_publish_without_activating(registry):
+    first = publish(registry, 'one')
+    second = publish(registry, 'two', activate=False)
+    assert registry.current(NAME) == first
+    registry.activate(NAME, second)
+    assert registry.current(NAME) == second
+
+def test_rollback_returns_to_the_previous_version(registry):
+    first = publish(registry, 'one')
+    second = publish(registry, 'two')
+    assert registry.rollback(NAME) == first
+    assert registry.current(NAME) == first
+    # Rolling back again undoes the rollback
+    assert registry.rollback(NAME) == second
+    assert registry.rollback(NAME, first) == first
+    assert [entry['version'] for entry in registry.history(NAME)] == [first, second, first, second, first]
+
+def test_rollback_skips_pruned_versions(registry):
+    first = publish(registry, 'one')
+    second = publish(registry, 'two')
+    third = publish(registry, 'three')
+    assert registry.prune(NAME, keep=2) == [first]
+    assert registry.rollback(NAME) == second
+    assert registry.rollback(NAME) == third
+    assert registry.rollback(NAME) == second
+
+def test_rollback_errors(registry):
+    with pytest.raises(ValueError, match='No earlier'):
+        registry.rollback(NAME)
+    publish(registry, 'one')
+    with pytest.raises(ValueError, match='No earlier'):
+        registry.rollback(NAME)
+    with pytest.raises(ValueError, match='Unknown crop_stage version'):
+        registry.rollback(NAME, 'missing')
+
+def test_prune_never_removes_the_current_version(registry):
+    first = publish(registry, 'one')
+    second = publish(registry, 'two')
+    third = publish(registry, 'three')
+    registry.rollback(NAME, first)
+    assert registry.prune(NAME, keep=1) == [second]
+    assert registry.current(NAME) == first
+    assert [entry['version'] for entry in registry.versions(NAME)] == [first, third]
+
+def test_writer_lock_is_exclusive(registry):
+    held = registry.lock(NAME)
+    try:
+        assert registry.lock(NAME, blocking=False) is None
+    finally:
+        held.close()
+    again = registry.lock(NAME, blocking=False)
+    assert again is not None
+    again.close()
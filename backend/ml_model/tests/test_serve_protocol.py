@@ -0,0 +1,60 @@
+import asyncio
+import io
+import json
+from crop_stage_predictor import CropStagePredictor, handle_request, serve
+from inference_server import read_line
+
+def run_serve(predictor, *lines):
+    output = io.StringIO()
+    serve(predictor, io.StringIO(''.join(line + '\n' for line in lines)), output)
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+def test_requests_must_be_objects():
+    response = handle_request(CropStagePredictor(), [1, 2])
+    assert response == {"id": None, "success": False, "error": "Request must be a JSON object"}
+
+def test_unknown_request_type():
+    response = handle_request(CropStagePredictor(), {"id": 3, "type": "train"})
+    assert response == {"id": 3, "success": False, "error": "Unknown request type: train"}
+
+def test_predictions_without_a_model():
+    predictor = CropStagePredictor()
+    assert handle_request(predictor, {"id": 1, "features": {"crop": "paddy"}}) == {
+        "id": 1, "success": False, "error": "Failed to load model"}
+    assert handle_request(predictor, {"id": 2, "type": "predict_batch", "records": []})['success'] is False
+    ping = handle_request(predictor, {"id": 3, "type": "ping"})
+    assert ping['success'] and not ping['model_loaded']
+
+def test_predict_batch_requires_a_list():
+    predictor = CropStagePredictor()
+    predictor.model = object()
+    response = handle_request(predictor, {"id": 4, "type": "predict_batch", "records": {"crop": "paddy"}})
+    assert response == {"id": 4, "success": False, "error": "predict_batch requires a list of records"}
+
+def test_serve_answers_every_line_until_shutdown():
+    responses = run_serve(
+        CropStagePredictor(),
+        '{"id": 1, "type": "ping"}',
+        'not json',
+        '',
+        '"a string"',
+        '{"id": 2, "type": "shutdown"}',
+        '{"id": 3, "type": "ping"}'
+    )
+    assert [response['id'] for response in responses] == [1, None, None, 2]
+    assert responses[1]['error'].startswith('Invalid JSON')
+    assert responses[2]['error'] == 'Request must be a JSON object'
+    assert responses[3] == {"id": 2, "success": True, "type": "shutdown"}
+
+def test_serve_stops_at_end_of_input():
+    assert run_serve(CropStagePredictor(), '{"id": 1, "type": "ping"}')[0]['type'] == 'pong'
+
+def test_overlong_lines_are_dropped():
+    async def read_all():
+        reader = asyncio.StreamReader(limit=16)
+        reader.feed_data(b'{"id": 1}\n' + b'x' * 100 + b'\n{"id": 2}\n')
+        reader.feed_eof()
+        return [await read_line(reader) for _ in range(4)]
+
+    # The line after an overlong one is still read
+    assert asyncio.run(read_all()) == [b'{"id": 1}\n', None, b'{"id": 2}\n', b'']
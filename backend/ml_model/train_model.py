@@ -1,25 +1,126 @@
-from crop_recommender import CropRecommender
+from crop_recommender import MODEL_NAME, CropRecommender
+from instrumentation import report_progress
+from model_registry import ModelRegistry, training_fingerprint
+import argparse
+import json
+import sys
 import numpy as np
 import pandas as pd
 from sklearn.metrics import accuracy_score, classification_report
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+def report_result(result):
+    """Print the run's JSON status line, which training_jobs records; failures exit nonzero"""
+    print(json.dumps(result))
+    if result['status'] == 'error':
+        sys.exit(1)
+
+def fingerprint(args, bins, params=None):
+    """Fingerprint of the training run the arguments describe"""
+    from dataset_cache import ensure_cache
+    
+    _, meta = ensure_cache(args.data)
+    features = [column['name'] for column in meta['columns'] if column['name'] != 'label']
+    settings = {'bins': bins}
+    if args.streaming:
+        settings['streaming'] = {'chunk_size': args.chunk_size}
+    if args.compress and not args.streaming:
+        settings['compress'] = {'max_accuracy_loss': args.max_accuracy_loss, 'max_depth': args.max_depth}
+    return training_fingerprint(meta['sha256'], CropRecommender(params).params, features, **settings)
+
+def train_streaming(data_path, chunk_size, bins=None, fingerprint=None, params=None):
+    """Train chunk by chunk for datasets that do not fit in memory; returns the status dict"""
+    recommender = CropRecommender(params)
+    
+    print(f"Streaming training on {data_path} in chunks of {chunk_size} rows...")
+    report_progress('training', 0.1)
+    accuracy = recommender.train_streaming(data_path, chunk_size=chunk_size, bins=bins)
+    if recommender.feature_names is None or accuracy is None:
+        return {"status": "error", "message": "Failed to train the model"}
+    
+    print(f"\nModel Accuracy: {accuracy:.2f}")
+    print(f"Trees: {len(recommender.model.estimators_)}")
+    
+    print("\nPublishing the model...")
+    recommender.fingerprint = fingerprint
+    return publish(recommender, accuracy, source='train_streaming')
+
+def publish(recommender, accuracy, **metadata):
+    """Publish a trained recommender as the registry's current version; returns the status dict"""
+    registry = ModelRegistry()
+    version = recommender.publish(registry, accuracy=accuracy, **metadata)
+    if not version:
+        return {"status": "error", "message": "Failed to save the model"}
+    registry.prune(MODEL_NAME)
+    print(f"Model published as version {version}")
+    return {"status": "success", "message": "Model trained successfully", "version": version, "accuracy": accuracy}
+
 def main():
+    parser = argparse.ArgumentParser(description='Train the crop recommender')
+    parser.add_argument('--data', type=str, default='farmer_guide_crop_dataset.xlsx', help='Training dataset')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Train out of core, one chunk at a time, for datasets larger than memory')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='Rows per chunk when streaming')
+    parser.add_argument('--bins', type=str,
+                        help='JSON object of feature step sizes training readings are snapped to, '
+                             'e.g. \'{"rainfall": 5, "ph": 0.1}\'')
+    parser.add_argument('--force', action='store_true',
+                        help='Retrain even if a model was already trained from the same inputs')
+    parser.add_argument('--compress', action='store_true',
+                        help='Shrink the trained forest within the accuracy budget before publishing')
+    parser.add_argument('--max-accuracy-loss', type=float,
+                        help='Test accuracy --compress may give up (default: 0.01)')
+    parser.add_argument('--max-depth', type=int, help='With --compress, never keep trees deeper than this')
+    parser.add_argument('--model-params', type=str,
+                        help='Model parameters as JSON, or a model_search.py --target recommender report '
+                             'to use its selected candidate')
+    args = parser.parse_args()
+    bins = json.loads(args.bins) if args.bins else None
+    params = None
+    if args.model_params:
+        from model_search import load_params
+        params = load_params(args.model_params)
+    
+    # Hold the writer lock until exit so concurrent runs queue up
+    registry = ModelRegistry()
+    writer_lock = registry.lock(MODEL_NAME, blocking=False)
+    if writer_lock is None:
+        print("Waiting for another training run to finish...")
+        report_progress('waiting_for_lock', 0.0)
+        writer_lock = registry.lock(MODEL_NAME)
+    
+    # Skip the run when a published model was trained from the same inputs
+    run_fingerprint = fingerprint(args, bins, params)
+    if not args.force:
+        existing = registry.find_fingerprint(MODEL_NAME, run_fingerprint)
+        if existing:
+            if existing != registry.current(MODEL_NAME):
+                registry.activate(MODEL_NAME, existing)
+            report_result({"status": "success", "message": "Model is up to date; use --force to retrain",
+                           "version": existing, "skipped": True})
+            return
+    
+    if args.streaming:
+        report_result(train_streaming(args.data, args.chunk_size, bins, run_fingerprint, params))
+        return
+    
     # Initialize the recommender
-    recommender = CropRecommender()
+    recommender = CropRecommender(params)
     
     # Prepare the data
     print("Loading and preparing data...")
-    X_train, X_test, y_train, y_test = recommender.prepare_data('farmer_guide_crop_dataset.xlsx')
+    report_progress('loading_data', 0.1)
+    X_train, X_test, y_train, y_test = recommender.prepare_data(args.data)
     
     if X_train is None:
-        print("Failed to prepare data")
+        report_result({"status": "error", "message": "Failed to prepare data"})
         return
     
     # Train the model
     print("\nTraining the model...")
-    if recommender.train(X_train, y_train):
+    report_progress('training', 0.2)
+    if recommender.train(X_train, y_train, bins):
         print("Model trained successfully!")
         
         # Evaluate the model
@@ -37,10 +138,28 @@ def main():
             for feature, imp in sorted(importance.items(), key=lambda x: x[1], reverse=True):
                 print(f"{feature}: {imp:.4f}")
         
-        # Save the model
-        print("\nSaving the model...")
-        if recommender.save_model():
-            print("Model saved successfully!")
+        if args.compress:
+            print("\nCompressing the model...")
+            report_progress('compressing', 0.7)
+            report = recommender.compress(X_train, X_test, y_test, args.max_accuracy_loss, args.max_depth)
+            if report:
+                for stage in ('before', 'after'):
+                    summary = report[stage]
+                    print(f"{stage.capitalize()}: {summary['trees']} trees, {summary['nodes']} nodes, "
+                          f"{summary['size_bytes']} bytes, accuracy {summary['accuracy']:.4f}, "
+                          f"latency {summary['latency_ms']:.3f} ms")
+                accuracy = report['after']['accuracy']
+            else:
+                print("Failed to compress the model; publishing it as trained")
+                # Not what the fingerprint describes
+                run_fingerprint = None
+        
+        # Publish the model
+        print("\nPublishing the model...")
+        recommender.fingerprint = run_fingerprint
+        result = publish(recommender, accuracy, source='train')
+        if result['status'] == 'error':
+            report_result(result)
         
         # Example predictions
         print("\nMaking example predictions...")
@@ -60,9 +179,11 @@ def main():
             print("Class Probabilities:")
             for label, prob in zip(recommender.model.classes_, probs):
                 print(f"  {label}: {prob:.4f}")
+        
+        report_result(result)
     
     else:
-        print("Failed to train the model")
+        report_result({"status": "error", "message": "Failed to train the model"})
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,366 @@
+import argparse
+import fcntl
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from instrumentation import PROGRESS_ENV, configure_logging, logger
+from model_registry import REGISTRY_DIR, ModelRegistry, write_atomic
+
+ML_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Training script of every model the runner can train; the job's arguments
+# are appended to it.  Each script ends with a JSON status line, so a run
+# that exits without one is recorded as failed
+TRAINING_SCRIPTS = {
+    'crop_stage': 'crop_stage_predictor.py',
+    'crop_recommender': 'train_model.py',
+}
+
+JOBS_DIR = os.path.join(REGISTRY_DIR, '.jobs')
+QUEUE_LOCK = 'queue.lock'
+RUNNER_LOCK = 'runner.lock'
+
+# Training jobs run at once (never two for the same model) and the niceness
+# they run at, so that a burst of retrains leaves CPU for live predictions
+DEFAULT_MAX_JOBS = 1
+DEFAULT_NICE = 10
+POLL_INTERVAL = 0.5
+# Seconds a cancelled job gets to exit after SIGTERM before it is killed
+CANCEL_GRACE = 10.0
+# Finished jobs whose records are kept
+KEEP_FINISHED = 100
+
+FINISHED = ('succeeded', 'failed', 'cancelled')
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _last_json_line(path):
+    """The last line of a log that parses as a JSON object, or None"""
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    for line in reversed(lines):
+        try:
+            value = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            return value
+    return None
+
+class TrainingJobs:
+    """File-backed queue of training runs, executed by a single runner process
+
+    ``submit`` records a job and makes sure a runner is going.  A job with
+    the same model and arguments as one still queued is merged into it
+    rather than queued again.  The runner starts queued jobs oldest first,
+    at most ``max_jobs`` at a time and never two for the same model, each
+    at ``nice`` niceness in its own process group.  The training scripts
+    also hold the model's writer lock (ModelRegistry.lock) while they run,
+    so runs started outside the queue cannot overlap with queued ones.
+    """
+
+    def __init__(self, root=JOBS_DIR, registry=None, max_jobs=DEFAULT_MAX_JOBS, nice=DEFAULT_NICE):
+        self.root = root
+        self.registry = registry or ModelRegistry()
+        self.max_jobs = max(1, max_jobs)
+        self.nice = nice
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, job_id, suffix='.json'):
+        return os.path.join(self.root, job_id + suffix)
+
+    @contextmanager
+    def queue_lock(self):
+        with open(os.path.join(self.root, QUEUE_LOCK), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def save(self, job):
+        write_atomic(self.path(job['id']), json.dumps(job, indent=2))
+
+    def load(self, job_id):
+        if not str(job_id).isalnum():
+            return None
+        try:
+            with open(self.path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def jobs(self):
+        """Every job record, oldest first"""
+        jobs = []
+        for name in os.listdir(self.root):
+            if name.endswith('.json') and not name.endswith('.progress.json'):
+                job = self.load(name[:-len('.json')])
+                if job is not None:
+                    jobs.append(job)
+        return sorted(jobs, key=lambda job: job['submitted_at'])
+
+    def status(self, job_id):
+        """A job's record with its latest reported progress, or None"""
+        job = self.load(job_id)
+        if job is not None and job['status'] == 'running':
+            try:
+                with open(self.path(job_id, '.progress.json')) as f:
+                    job['progress'] = json.load(f)
+            except (OSError, ValueError):
+                pass
+        return job
+
+    def submit(self, model, args=()):
+        """Queue a training run, or join an identical queued one; returns the job"""
+        if model not in TRAINING_SCRIPTS:
+            raise ValueError(f"Unknown model: {model}")
+        args = list(args)
+        with self.queue_lock():
+            job = next((job for job in self.jobs()
+                        if job['status'] == 'queued' and job['model'] == model and job['args'] == args), None)
+            if job is not None:
+                job['requests'] += 1
+                logger.info("Merged a %s training request into queued job %s", model, job['id'])
+            else:
+                job = {
+                    "id": uuid.uuid4().hex[:12],
+                    "model": model,
+                    "args": args,
+                    "status": "queued",
+                    "requests": 1,
+                    "submitted_at": time.time(),
+                    "started_at": None,
+                    "finished_at": None,
+                    "pid": None,
+                    "progress": None,
+                    "returncode": None,
+                    "result": None,
+                    "error": None
+                }
+                self.prune()
+            self.save(job)
+        self.ensure_runner()
+        return job
+
+    def cancel(self, job_id):
+        """Cancel a queued job, or stop a running one; returns the job or None"""
+        with self.queue_lock():
+            job = self.load(job_id)
+            if job is None or job['status'] in FINISHED:
+                return job
+            if job['status'] == 'queued':
+                job.update(status='cancelled', finished_at=time.time())
+            else:
+                job['cancel_requested'] = time.time()
+                try:
+                    os.killpg(job['pid'], signal.SIGTERM)
+                except (ProcessLookupError, PermissionError, TypeError):
+                    pass
+            self.save(job)
+            return job
+
+    def prune(self):
+        """Delete the records and logs of all but the newest KEEP_FINISHED finished jobs"""
+        finished = [job for job in self.jobs() if job['status'] in FINISHED]
+        for job in finished[:-KEEP_FINISHED or None]:
+            for suffix in ('.json', '.progress.json', '.out', '.err'):
+                try:
+                    os.remove(self.path(job['id'], suffix))
+                except OSError:
+                    pass
+
+    def ensure_runner(self):
+        """Start a detached runner unless one is already going"""
+        with open(os.path.join(self.root, RUNNER_LOCK), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--jobs-dir', self.root, 'run',
+             '--max-jobs', str(self.max_jobs), '--nice', str(self.nice)],
+            cwd=ML_DIR, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+        return True
+
+    def start(self, job):
+        """Launch a queued job's training script"""
+        progress_path = self.path(job['id'], '.progress.json')
+        command = [sys.executable, os.path.join(ML_DIR, TRAINING_SCRIPTS[job['model']])] + job['args']
+        with open(self.path(job['id'], '.out'), 'w') as out, open(self.path(job['id'], '.err'), 'w') as err:
+            process = subprocess.Popen(
+                command, cwd=ML_DIR, stdin=subprocess.DEVNULL, stdout=out, stderr=err,
+                env=dict(os.environ, **{PROGRESS_ENV: progress_path}),
+                preexec_fn=lambda: os.nice(self.nice),
+                start_new_session=True
+            )
+        job.update(status='running', started_at=time.time(), pid=process.pid)
+        self.save(job)
+        logger.info("Started %s training job %s as process %d", job['model'], job['id'], process.pid)
+        return process
+
+    def finish(self, job, returncode):
+        """Record how a job ended; returncode is None for a job another runner started"""
+        result = _last_json_line(self.path(job['id'], '.out'))
+        try:
+            with open(self.path(job['id'], '.progress.json')) as f:
+                job['progress'] = json.load(f)
+        except (OSError, ValueError):
+            pass
+        failed = (returncode not in (0, None) or result is None or result.get('status') == 'error'
+                  or result.get('success') is False)
+        if job.get('cancel_requested'):
+            status = 'cancelled'
+        else:
+            status = 'failed' if failed else 'succeeded'
+        job.update(status=status, finished_at=time.time(), returncode=returncode, result=result)
+        if status == 'failed':
+            with open(self.path(job['id'], '.err'), errors='replace') as f:
+                job['error'] = f.read()[-2000:] or (result or {}).get('message') or "Training failed"
+        if status != 'succeeded':
+            # A stopped run may leave a half-built version behind
+            self.registry.discard_staging(job['model'], job['pid'])
+        self.save(job)
+        logger.info("Training job %s %s", job['id'], status)
+
+    def run(self):
+        """Execute queued jobs until the queue is empty; returns False if a runner is already going"""
+        runner_lock = open(os.path.join(self.root, RUNNER_LOCK), 'a')
+        try:
+            fcntl.flock(runner_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            runner_lock.close()
+            return False
+
+        # job id -> Popen of the jobs this runner started
+        processes = {}
+        try:
+            while True:
+                with self.queue_lock():
+                    jobs = self.jobs()
+                    running = [job for job in jobs if job['status'] == 'running']
+                    for job in running:
+                        process = processes.get(job['id'])
+                        if process is not None:
+                            returncode = process.poll()
+                            if returncode is not None:
+                                del processes[job['id']]
+                                self.finish(job, returncode)
+                            elif job.get('cancel_requested') and time.time() - job['cancel_requested'] > CANCEL_GRACE:
+                                os.killpg(process.pid, signal.SIGKILL)
+                        elif not _pid_alive(job['pid']):
+                            # Started by a runner that has since exited
+                            self.finish(job, None)
+
+                    running = [job for job in self.jobs() if job['status'] == 'running']
+                    busy = {job['model'] for job in running}
+                    queued = [job for job in jobs if job['status'] == 'queued']
+                    for job in queued:
+                        if len(busy) >= self.max_jobs:
+                            break
+                        if job['model'] in busy:
+                            continue
+                        processes[job['id']] = self.start(job)
+                        busy.add(job['model'])
+
+                    if not processes and not busy and not queued:
+                        # Release the runner lock while holding the queue
+                        # lock, so a submit that follows starts a new runner
+                        runner_lock.close()
+                        return True
+                time.sleep(POLL_INTERVAL)
+        finally:
+            if not runner_lock.closed:
+                runner_lock.close()
+
+    def wait(self, job_id, timeout=None):
+        """Block until a job finishes; returns its final record"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.status(job_id)
+            if job is None or job['status'] in FINISHED:
+                return job
+            if deadline is not None and time.monotonic() >= deadline:
+                return job
+            time.sleep(POLL_INTERVAL)
+
+def main():
+    parser = argparse.ArgumentParser(description='Queue, run and inspect model training jobs')
+    parser.add_argument('--jobs-dir', type=str, default=JOBS_DIR, help='Directory of the job records')
+    parser.add_argument('--max-jobs', type=int, default=DEFAULT_MAX_JOBS, help='Training jobs run at once')
+    parser.add_argument('--nice', type=int, default=DEFAULT_NICE, help='Niceness training jobs run at')
+    parser.add_argument('--log-level', type=str, help='Logging level for stderr diagnostics')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    submit = commands.add_parser('submit', help='Queue a training run and print its job',
+                                 usage="%(prog)s [--wait] [--timeout SECONDS] MODEL -- [SCRIPT ARGS ...]")
+    submit.add_argument('model', choices=sorted(TRAINING_SCRIPTS), help='Model to train')
+    submit.add_argument('--wait', action='store_true', help='Print the job once it has finished')
+    submit.add_argument('--timeout', type=float, help='Stop waiting after this many seconds')
+
+    status = commands.add_parser('status', help='Print a job, or every job')
+    status.add_argument('job', nargs='?', help='Job id')
+
+    cancel = commands.add_parser('cancel', help='Cancel a queued or running job')
+    cancel.add_argument('job', help='Job id')
+
+    run = commands.add_parser('run', help='Run queued jobs until the queue is empty')
+    run.add_argument('--max-jobs', type=int, dest='run_max_jobs', help=argparse.SUPPRESS)
+    run.add_argument('--nice', type=int, dest='run_nice', help=argparse.SUPPRESS)
+
+    # Everything after '--' is passed on to the training script untouched
+    argv = sys.argv[1:]
+    script_args = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, script_args = argv[:split], argv[split + 1:]
+    args = parser.parse_args(argv)
+    configure_logging(args.log_level)
+    if args.command == 'run':
+        args.max_jobs = args.run_max_jobs or args.max_jobs
+        args.nice = args.nice if args.run_nice is None else args.run_nice
+    manager = TrainingJobs(args.jobs_dir, max_jobs=args.max_jobs, nice=args.nice)
+
+    try:
+        if args.command == 'submit':
+            job = manager.submit(args.model, script_args)
+            if args.wait:
+                job = manager.wait(job['id'], args.timeout)
+            print(json.dumps({"success": True, "job": job}))
+        elif args.command == 'status':
+            if args.job:
+                job = manager.status(args.job)
+                if job is None:
+                    print(json.dumps({"success": False, "error": f"Unknown job: {args.job}"}))
+                else:
+                    print(json.dumps({"success": True, "job": job}))
+            else:
+                print(json.dumps({"success": True, "jobs": [manager.status(job['id']) for job in manager.jobs()]}))
+        elif args.command == 'cancel':
+            job = manager.cancel(args.job)
+            if job is None:
+                print(json.dumps({"success": False, "error": f"Unknown job: {args.job}"}))
+            else:
+                print(json.dumps({"success": True, "job": job}))
+        else:
+            manager.run()
+    except Exception as e:
+        print(json.dumps({"success": False, "error": str(e)}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import numpy as np
+from instrumentation import logger, metrics
+
+# Tree models without bootstrap and with the default row-count limits are
+# fitted on (unique row, count) pairs instead of repeated rows; the trees
+# match the ones grown on the repeated rows, up to rounding when two splits
+# are equally good.  Bootstrap resamples rows, and min_samples_leaf and
+# min_samples_split count rows rather than weight, so other models are
+# fitted on the repeated rows to stay equivalent.
+
+def collapse_duplicates(X, y, sample_weight=None):
+    """Merge identical (feature row, label) pairs into one row weighted by their count
+
+    Returns (X, y, sample_weight) with rows sorted by label, then features.
+    Existing weights are summed, so the result can be collapsed again.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    labels, y_codes = np.unique(np.asarray(y), return_inverse=True)
+    keys = np.column_stack([y_codes.reshape(-1), X])
+    # Sorting with lexsort and marking where a row differs from the previous
+    # one is several times faster than np.unique(axis=0)
+    order = np.lexsort(keys.T[::-1])
+    ordered = keys[order]
+    first = np.r_[True, (ordered[1:] != ordered[:-1]).any(axis=1)]
+    unique = ordered[first]
+    inverse = np.empty(len(keys), dtype=np.int64)
+    inverse[order] = np.cumsum(first) - 1
+    weights = np.bincount(inverse, weights=sample_weight, minlength=len(unique))
+
+    metrics.incr('training_rows_total', len(X))
+    metrics.incr('training_unique_rows_total', len(unique))
+    logger.info("Collapsed %d training rows into %d weighted samples", len(X), len(unique))
+    return unique[:, 1:], labels[unique[:, 0].astype(np.int64)], weights
+
+def repeat_counts(X, y, sample_weight=None):
+    """Expand whole-number weights into repeated rows, the inverse of collapse_duplicates
+
+    Zero-weight rows are kept once with weight 0, so their labels stay in
+    the fit's classes.  Returns (X, y, sample_weight), with sample_weight
+    None when every row counts once, as sklearn's forests resample
+    differently when given weights; fractional weights are returned as
+    they are.
+    """
+    if sample_weight is None:
+        return X, y, None
+    sample_weight = np.asarray(sample_weight, dtype=np.float64)
+    if not np.array_equal(sample_weight, np.round(sample_weight)):
+        return X, y, sample_weight
+    counts = sample_weight.astype(np.int64)
+    repeats = np.maximum(counts, 1)
+    metrics.incr('training_rows_total', int(counts.sum()))
+    weights = None if (counts > 0).all() else np.repeat((counts > 0).astype(np.float64), repeats)
+    return np.repeat(np.asarray(X), repeats, axis=0), np.repeat(np.asarray(y), repeats), weights
+
+def collapses_exactly(model):
+    """Whether fitting the collapsed rows grows the same trees as the repeated rows"""
+    params = model.get_params()
+    return (not params.get('bootstrap', False) and params.get('min_samples_leaf', 1) == 1
+            and params.get('min_samples_split', 2) == 2)
+
+def balanced_weights(y, sample_weight):
+    """Per-row weights equal to class_weight='balanced' computed on the weighted rows
+
+    sklearn computes 'balanced' from unweighted label counts, which a
+    collapsed training set would distort.
+    """
+    labels, codes = np.unique(np.asarray(y), return_inverse=True)
+    totals = np.bincount(codes.reshape(-1), weights=sample_weight, minlength=len(labels))
+    class_weight = np.divide(totals.sum(), len(labels) * totals, out=np.zeros(len(labels)), where=totals > 0)
+    return class_weight[codes.reshape(-1)]
+
+def bin_steps(bins, feature_names):
+    """Step per feature column from a {feature name: step} mapping; 0 leaves a column as it is"""
+    return np.array([float((bins or {}).get(name, 0)) for name in feature_names])
+
+def bin_features(X, steps):
+    """Snap each column to the nearest multiple of its step, as PredictionCache keys do"""
+    X = np.asarray(X, dtype=np.float64)
+    steps = np.asarray(steps, dtype=np.float64)
+    binned = np.round(X / np.where(steps > 0, steps, 1.0)) * steps
+    return np.where(steps > 0, binned, X)
+
+def fit_weighted(model, X, y, sample_weight=None):
+    """Fit a tree model on (X, y) as if each row were repeated sample_weight times
+
+    Rows are collapsed where collapses_exactly allows and repeated
+    otherwise.  A 'balanced' class_weight is applied to the weights
+    directly, so the fit sees the same class balance as on the repeated rows.
+    """
+    if collapses_exactly(model):
+        X, y, sample_weight = collapse_duplicates(X, y, sample_weight)
+    else:
+        X, y, sample_weight = repeat_counts(X, y, sample_weight)
+        if sample_weight is None:
+            return model.fit(X, y)
+    params = model.get_params()
+    if params.get('class_weight') == 'balanced':
+        model.set_params(class_weight=None)
+        try:
+            model.fit(X, y, sample_weight=sample_weight * balanced_weights(y, sample_weight))
+        finally:
+            model.set_params(class_weight='balanced')
+    else:
+        model.fit(X, y, sample_weight=sample_weight)
+    return model
@@ -0,0 +1,343 @@
+import gc
+import json
+import os
+import select
+import sys
+import threading
+import time
+from instrumentation import logger, metrics
+
+# Delay before replacing a crashed worker; doubled for each worker that dies
+# soon after starting, up to MAX_RESTART_DELAY
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30.0
+# A worker that lived this long before dying resets the restart delay
+HEALTHY_UPTIME = 10.0
+
+READ_SIZE = 1 << 16
+
+class Worker:
+    """Supervisor-side state of one forked worker"""
+
+    def __init__(self, pid, request_fd, response_fd):
+        self.pid = pid
+        self.request_fd = request_fd
+        self.response_fd = response_fd
+        self.started_at = time.monotonic()
+        self.outgoing = bytearray()
+        self.incoming = b''
+        # Internal ids of the requests sent to this worker and not yet answered
+        self.pending = set()
+        # Draining workers finish what they were sent and then exit
+        self.draining = False
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+def split_lines(buffer, data):
+    """Append data to a byte buffer and return (complete lines, remainder)"""
+    buffer += data
+    *lines, remainder = buffer.split(b'\n')
+    return lines, remainder
+
+class PreforkPool:
+    """Supervisor that loads a model once and forks workers to answer requests
+
+    Requests are newline-delimited JSON objects read from the input fd, as in
+    crop_stage_predictor.serve.  Each one is sent to the worker with the fewest
+    outstanding requests and answered on the output fd as soon as that worker
+    replies, so responses may come back out of order; the ``id`` of each
+    request is echoed back.  ``worker_main(model, input_stream, output_stream)``
+    runs in every worker and answers requests until its input ends.
+
+    The model is loaded before forking, so its arrays are shared copy-on-write
+    by every worker (memory-mapped arrays are shared through the page cache).
+    A worker that crashes fails only its in-flight requests and is replaced.
+    With a ``watcher`` (a model_registry.ModelWatcher), a newly published
+    version is loaded by a background thread of the supervisor while requests
+    keep being dispatched; once it is loaded a fresh set of workers is forked
+    from it and the old workers are drained, so no request is dropped.  No
+    worker is forked while a load is running, since forking copies only the
+    forking thread.
+    """
+
+    def __init__(self, worker_main, model, n_workers, watcher=None):
+        self.worker_main = worker_main
+        self.model = model
+        self.n_workers = max(1, n_workers)
+        self.watcher = watcher
+        self.workers = []
+        # Requests waiting for a worker, as (internal id, encoded line)
+        self.backlog = []
+        # internal id -> id given by the client
+        self.request_ids = {}
+        self.next_id = 0
+        self.restart_delay = RESTART_DELAY
+        self.next_restart = 0.0
+        self.shutdown_requested = False
+        self.shutdown_id = None
+        self.shutting_down = False
+        # Background version load, and the pipe it signals completion on
+        self.loader = None
+        self.wake_read = self.wake_write = None
+
+    def spawn(self):
+        request_read, request_write = os.pipe()
+        response_read, response_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                os.close(request_write)
+                os.close(response_read)
+                for worker in self.workers:
+                    if worker.request_fd is not None:
+                        os.close(worker.request_fd)
+                    os.close(worker.response_fd)
+                if self.wake_read is not None:
+                    os.close(self.wake_read)
+                    os.close(self.wake_write)
+                with os.fdopen(request_read) as input_stream, os.fdopen(response_write, 'w') as output_stream:
+                    self.worker_main(self.model, input_stream, output_stream)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 0
+            except BaseException:
+                logger.exception("Prediction worker %d failed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+
+        os.close(request_read)
+        os.close(response_write)
+        os.set_blocking(request_write, False)
+        worker = Worker(pid, request_write, response_read)
+        self.workers.append(worker)
+        metrics.incr('pool_workers_started_total')
+        logger.info("Started prediction worker %d", pid)
+        return worker
+
+    def active_workers(self):
+        return [worker for worker in self.workers if not worker.draining]
+
+    def respond(self, response):
+        write_all(self.output_fd, (json.dumps(response) + "\n").encode('utf-8'))
+
+    def submit(self, line):
+        """Queue one request line from the client"""
+        try:
+            message = json.loads(line)
+        except ValueError as e:
+            self.respond({"id": None, "success": False, "error": f"Invalid JSON: {str(e)}"})
+            return
+        if not isinstance(message, dict):
+            self.respond({"id": None, "success": False, "error": "Request must be a JSON object"})
+            return
+        if message.get('type') == 'shutdown':
+            self.shutting_down = True
+            self.shutdown_requested = True
+            self.shutdown_id = message.get('id')
+            return
+
+        internal_id = self.next_id
+        self.next_id += 1
+        self.request_ids[internal_id] = message.get('id')
+        self.backlog.append((internal_id, (json.dumps(dict(message, id=internal_id)) + "\n").encode('utf-8')))
+
+    def dispatch(self):
+        active = self.active_workers()
+        if not active:
+            if self.shutting_down:
+                # No worker will be started to answer these
+                for internal_id, _ in self.backlog:
+                    self.respond({
+                        "id": self.request_ids.pop(internal_id, None),
+                        "success": False,
+                        "error": "Prediction pool is shutting down"
+                    })
+                self.backlog = []
+            return
+        for internal_id, line in self.backlog:
+            worker = min(active, key=lambda candidate: len(candidate.pending))
+            worker.pending.add(internal_id)
+            worker.outgoing += line
+        self.backlog = []
+
+    def flush(self, worker):
+        try:
+            written = os.write(worker.request_fd, worker.outgoing)
+            del worker.outgoing[:written]
+        except BlockingIOError:
+            pass
+        except BrokenPipeError:
+            # The worker died; its response pipe reports it
+            worker.outgoing.clear()
+
+    def read_responses(self, worker):
+        data = os.read(worker.response_fd, READ_SIZE)
+        if not data:
+            self.remove(worker)
+            return
+        lines, worker.incoming = split_lines(worker.incoming, data)
+        for line in lines:
+            if not line.strip():
+                continue
+            response = json.loads(line)
+            internal_id = response.get('id')
+            worker.pending.discard(internal_id)
+            response['id'] = self.request_ids.pop(internal_id, None)
+            self.respond(response)
+
+    def remove(self, worker):
+        """Reap an exited worker, failing whatever it still owed"""
+        self.workers.remove(worker)
+        if worker.request_fd is not None:
+            os.close(worker.request_fd)
+        os.close(worker.response_fd)
+        _, status = os.waitpid(worker.pid, 0)
+
+        for internal_id in sorted(worker.pending):
+            self.respond({
+                "id": self.request_ids.pop(internal_id, None),
+                "success": False,
+                "error": "Prediction worker crashed"
+            })
+        if worker.draining or self.shutting_down:
+            return
+
+        metrics.incr('pool_worker_crashes_total')
+        logger.error("Prediction worker %d exited with status %d", worker.pid, status)
+        if time.monotonic() - worker.started_at < HEALTHY_UPTIME:
+            self.restart_delay = min(self.restart_delay * 2, MAX_RESTART_DELAY)
+        else:
+            self.restart_delay = RESTART_DELAY
+        self.next_restart = time.monotonic() + self.restart_delay
+
+    def reload(self):
+        """Check for a newly published version in a background thread"""
+        if self.watcher is None or self.loader is not None:
+            return
+
+        def load():
+            try:
+                self.loader.swapped = self.watcher.poll()
+            except Exception as e:
+                logger.error("Error checking for a new %s version: %s", self.watcher.name, e)
+            finally:
+                os.write(self.wake_write, b'\0')
+
+        self.loader = threading.Thread(target=load, name='pool-reload', daemon=True)
+        self.loader.swapped = False
+        self.loader.start()
+
+    def finish_reload(self):
+        """Fork workers from the version just loaded and drain the old ones"""
+        os.read(self.wake_read, READ_SIZE)
+        self.loader.join()
+        swapped, self.loader = self.loader.swapped, None
+        if not swapped or self.shutting_down:
+            return
+        self.model = self.watcher.model
+        old_workers = list(self.workers)
+        for worker in old_workers:
+            worker.draining = True
+        gc.freeze()
+        for _ in range(self.n_workers):
+            self.spawn()
+        logger.info("Rolled %d workers over to version %s", self.n_workers, self.watcher.version)
+
+    def retire_drained(self):
+        for worker in self.workers:
+            if worker.draining and not worker.pending and worker.request_fd is not None:
+                # End of input makes the worker's serve loop return
+                os.close(worker.request_fd)
+                worker.request_fd = None
+
+    def run(self, input_fd=None, output_fd=None):
+        """Serve until shutdown or end of input, then stop every worker"""
+        input_fd = sys.stdin.fileno() if input_fd is None else input_fd
+        self.output_fd = sys.stdout.fileno() if output_fd is None else output_fd
+        incoming = b''
+        input_open = True
+        next_poll = time.monotonic() + (self.watcher.interval if self.watcher else 0)
+        self.wake_read, self.wake_write = os.pipe()
+
+        # Keep the loaded model out of the collector's reach so that workers
+        # do not dirty its pages by touching object headers
+        gc.freeze()
+        for _ in range(self.n_workers):
+            self.spawn()
+
+        try:
+            while True:
+                now = time.monotonic()
+                if (not self.shutting_down and self.loader is None
+                        and len(self.active_workers()) < self.n_workers and now >= self.next_restart):
+                    self.spawn()
+                if self.watcher is not None and now >= next_poll and not self.shutting_down:
+                    self.reload()
+                    next_poll = now + self.watcher.interval
+                self.dispatch()
+                self.retire_drained()
+
+                owed = self.backlog or self.request_ids
+                if self.shutting_down and not owed:
+                    if self.shutdown_requested:
+                        self.respond({"id": self.shutdown_id, "success": True, "type": "shutdown"})
+                    break
+
+                readers = [worker.response_fd for worker in self.workers] + [self.wake_read]
+                if input_open and not self.shutting_down:
+                    readers.append(input_fd)
+                writers = [worker.request_fd for worker in self.workers
+                           if worker.request_fd is not None and worker.outgoing]
+                timeout = 1.0
+                if self.watcher is not None:
+                    timeout = min(timeout, max(0.0, next_poll - now))
+                if len(self.active_workers()) < self.n_workers and self.loader is None:
+                    timeout = min(timeout, max(0.0, self.next_restart - now))
+
+                readable, writable, _ = select.select(readers, writers, [], timeout)
+
+                if self.wake_read in readable:
+                    self.finish_reload()
+
+                for worker in list(self.workers):
+                    if worker.request_fd is not None and worker.request_fd in writable:
+                        self.flush(worker)
+                    if worker.response_fd in readable:
+                        self.read_responses(worker)
+
+                if input_fd in readable:
+                    data = os.read(input_fd, READ_SIZE)
+                    if not data:
+                        input_open = False
+                        self.shutting_down = True
+                        if incoming.strip():
+                            self.submit(incoming)
+                        incoming = b''
+                        continue
+                    lines, incoming = split_lines(incoming, data)
+                    for line in lines:
+                        if line.strip():
+                            self.submit(line)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Close every worker's input and wait for it to exit"""
+        if self.loader is not None:
+            self.loader.join()
+            self.loader = None
+        if self.wake_read is not None:
+            os.close(self.wake_read)
+            os.close(self.wake_write)
+            self.wake_read = self.wake_write = None
+        for worker in self.workers:
+            if worker.request_fd is not None:
+                os.close(worker.request_fd)
+                worker.request_fd = None
+        for worker in self.workers:
+            os.close(worker.response_fd)
+            os.waitpid(worker.pid, 0)
+        self.workers = []
@@ -2,6 +2,7 @@ const express = require('express');
 const router = express.Router();
 const { spawn } = require('child_process');
 const path = require('path');
+const stageWorker = require('../utils/stageWorker');
 
 // Get the absolute path to the ml_model directory in the backend folder
 const mlModelPath = path.resolve(__dirname, '../ml_model');
@@ -29,60 +30,20 @@ router.post('/predict-crop-stage', async (req, res) => {
         // Use the features directly as they are already in the correct format
         console.log('Sending features to Python:', features);
 
-        // Spawn Python process with full path to Python script
-        const pythonProcess = spawn('python', [scriptPath, '--predict', JSON.stringify(features)]);
+        // The long-lived worker keeps the model loaded between requests
+        const result = await stageWorker.predictStage(features);
+        console.log('Parsed prediction result:', result); // Debug log
 
-        let prediction = '';
-        let error = '';
-
-        pythonProcess.stdout.on('data', (data) => {
-            const output = data.toString();
-            prediction += output;
-            console.log('Python stdout:', output); // Debug log
-        });
+        if (result.success === false) {
+            return res.status(500).json({
+                success: false,
+                error: result.error || 'Failed to make prediction'
+            });
+        }
 
-        pythonProcess.stderr.on('data', (data) => {
-            const errorOutput = data.toString();
-            error += errorOutput;
-            console.log('Python stderr:', errorOutput); // Debug log
-        });
-
-        pythonProcess.on('close', (code) => {
-            console.log('Python process exited with code:', code); // Debug log
-            console.log('Final prediction output:', prediction); // Debug log
-            console.log('Final error output:', error); // Debug log
-
-            if (code !== 0) {
-                return res.status(500).json({
-                    success: false,
-                    error: `Python process exited with code ${code}: ${error}`
-                });
-            }
-
-            try {
-                // Try to parse the prediction output
-                const result = JSON.parse(prediction.trim());
-                console.log('Parsed prediction result:', result); // Debug log
-
-                if (result.success === false) {
-                    return res.status(500).json({
-                        success: false,
-                        error: result.error || 'Failed to make prediction'
-                    });
-                }
-
-                res.json({
-                    success: true,
-                    prediction: result.prediction
-                });
-            } catch (e) {
-                console.error('Failed to parse prediction:', e); // Debug log
-                console.error('Raw prediction output:', prediction); // Debug log
-                res.status(500).json({
-                    success: false,
-                    error: 'Failed to parse prediction result: ' + e.message
-                });
-            }
+        res.json({
+            success: true,
+            prediction: result.prediction
         });
     } catch (error) {
         console.error('Server error:', error); // Debug log
@@ -93,22 +54,17 @@ router.post('/predict-crop-stage', async (req, res) => {
     }
 });
 
-// Route to retrain the model
-router.post('/retrain-model', async (req, res) => {
-    try {
-        // Path to the Python script using absolute path
-        const scriptPath = path.join(mlModelPath, 'crop_stage_predictor.py');
-        console.log('Script path:', scriptPath); // Debug log
-
-        // Spawn Python process with full path to Python script
-        const pythonProcess = spawn('python', [scriptPath, '--train']);
+// Run a training_jobs.py command and resolve with its JSON output
+function runTrainingJobs(args) {
+    return new Promise((resolve, reject) => {
+        const scriptPath = path.join(mlModelPath, 'training_jobs.py');
+        const pythonProcess = spawn('python', [scriptPath, ...args]);
 
         let output = '';
         let error = '';
 
         pythonProcess.stdout.on('data', (data) => {
             output += data.toString();
-            console.log('Python output:', data.toString()); // Debug log
         });
 
         pythonProcess.stderr.on('data', (data) => {
@@ -117,19 +73,61 @@ router.post('/retrain-model', async (req, res) => {
         });
 
         pythonProcess.on('close', (code) => {
-            console.log('Python process exited with code:', code); // Debug log
             if (code !== 0) {
-                return res.status(500).json({
-                    success: false,
-                    error: `Python process exited with code ${code}: ${error}`
-                });
+                return reject(new Error(`Python process exited with code ${code}: ${error}`));
             }
+            try {
+                resolve(JSON.parse(output.trim().split('\n').pop()));
+            } catch (parseError) {
+                reject(new Error(`Invalid output from training jobs: ${output}`));
+            }
+        });
+    });
+}
 
-            res.json({
-                success: true,
-                message: 'Model retrained successfully',
-                output: output
+// Route to retrain the model
+router.post('/retrain-model', async (req, res) => {
+    try {
+        // Retrains go through the training job queue, which runs one at a
+        // time and merges a request into an identical one still waiting.
+        // Training is skipped when the published model was already trained
+        // from the same data and settings, unless the caller forces it
+        const args = ['submit', 'crop_stage'];
+        const wait = !(req.body && req.body.wait === false);
+        if (wait) {
+            args.push('--wait');
+        }
+        args.push('--', '--train');
+        if (req.body && req.body.force) {
+            args.push('--force');
+        }
+
+        const result = await runTrainingJobs(args);
+        if (!result.success) {
+            return res.status(500).json({ success: false, error: result.error });
+        }
+
+        const job = result.job;
+        if (!wait) {
+            // The caller polls /training-jobs/:id for progress
+            return res.status(202).json({ success: true, job: job });
+        }
+        if (job.status !== 'succeeded') {
+            return res.status(500).json({
+                success: false,
+                error: job.error || `Training job ${job.status}`,
+                job: job
             });
+        }
+
+        // The worker watches the model registry and swaps the new
+        // version in by itself, so in-flight predictions are not dropped
+        const skipped = Boolean(job.result && job.result.skipped);
+        res.json({
+            success: true,
+            message: skipped ? 'Model is already up to date' : 'Model retrained successfully',
+            skipped: skipped,
+            job: job
         });
     } catch (error) {
         console.error('Server error:', error); // Debug log
@@ -140,4 +138,50 @@ router.post('/retrain-model', async (req, res) => {
     }
 });
 
+// Route to list training jobs
+router.get('/training-jobs', async (req, res) => {
+    try {
+        res.json(await runTrainingJobs(['status']));
+    } catch (error) {
+        res.status(500).json({ success: false, error: error.message });
+    }
+});
+
+// Route to check a training job's status and progress
+router.get('/training-jobs/:id', async (req, res) => {
+    try {
+        const result = await runTrainingJobs(['status', req.params.id]);
+        res.status(result.success ? 200 : 404).json(result);
+    } catch (error) {
+        res.status(500).json({ success: false, error: error.message });
+    }
+});
+
+// Route to cancel a queued or running training job
+router.post('/training-jobs/:id/cancel', async (req, res) => {
+    try {
+        const result = await runTrainingJobs(['cancel', req.params.id]);
+        res.status(result.success ? 200 : 404).json(result);
+    } catch (error) {
+        res.status(500).json({ success: false, error: error.message });
+    }
+});
+
+// Route to check that the prediction worker is up and has a model loaded
+router.get('/health', async (req, res) => {
+    try {
+        const result = await stageWorker.ping();
+        res.json({
+            success: true,
+            modelLoaded: result.model_loaded,
+            modelVersion: result.model_version
+        });
+    } catch (error) {
+        res.status(503).json({
+            success: false,
+            error: error.message
+        });
+    }
+});
+
 module.exports = router; 
\ No newline at end of file
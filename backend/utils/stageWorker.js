@@ -0,0 +1,134 @@
+// File: backend/utils/stageWorker.js
+// Keeps one long-lived `crop_stage_predictor.py --serve` process and routes
+// prediction requests to it over newline-delimited JSON on stdin/stdout.
+const { spawn } = require("child_process");
+const path = require("path");
+
+const scriptPath = path.resolve(__dirname, "../ml_model/crop_stage_predictor.py");
+const REQUEST_TIMEOUT_MS = 30000;
+// Forked prediction processes behind the one worker; set STAGE_WORKERS to use more cores
+const WORKERS = process.env.STAGE_WORKERS || "1";
+
+let worker = null;
+let nextId = 1;
+
+// Each process has its own requests in flight, so one that is shutting
+// down can finish answering them while a new one takes the next requests
+function failPending(proc, message) {
+    for (const { reject, timer } of proc.pending.values()) {
+        clearTimeout(timer);
+        reject(new Error(message));
+    }
+    proc.pending.clear();
+}
+
+// Ask a process that has been replaced to exit once it has nothing in flight
+function shutdownIfDrained(proc) {
+    if (proc.draining && proc.pending.size === 0 && !proc.stdin.writableEnded) {
+        proc.stdin.end(JSON.stringify({ type: "shutdown" }) + "\n");
+    }
+}
+
+function handleLine(proc, line) {
+    if (!line.trim()) return;
+
+    let response;
+    try {
+        response = JSON.parse(line);
+    } catch (e) {
+        console.error("Unparseable worker output:", line);
+        return;
+    }
+
+    const entry = proc.pending.get(response.id);
+    if (!entry) return;
+    proc.pending.delete(response.id);
+    clearTimeout(entry.timer);
+    entry.resolve(response);
+    shutdownIfDrained(proc);
+}
+
+function stopUsing(proc, message) {
+    if (worker === proc) {
+        worker = null;
+    }
+    failPending(proc, message);
+}
+
+function startWorker() {
+    const proc = spawn("python", [scriptPath, "--serve", "--workers", WORKERS]);
+    proc.pending = new Map();
+    proc.draining = false;
+    let buffer = "";
+
+    proc.stdout.on("data", (data) => {
+        buffer += data.toString();
+        let newline;
+        while ((newline = buffer.indexOf("\n")) !== -1) {
+            handleLine(proc, buffer.slice(0, newline));
+            buffer = buffer.slice(newline + 1);
+        }
+    });
+
+    proc.stderr.on("data", (data) => {
+        console.log("Stage worker stderr:", data.toString());
+    });
+
+    proc.on("error", (err) => {
+        console.error("Stage worker failed to start:", err);
+        stopUsing(proc, `Prediction worker failed to start: ${err.message}`);
+    });
+
+    // Writing to a worker that has died raises EPIPE here instead of crashing the server
+    proc.stdin.on("error", (err) => {
+        console.error("Stage worker stdin error:", err);
+        stopUsing(proc, `Prediction worker is unavailable: ${err.message}`);
+    });
+
+    proc.on("close", (code) => {
+        console.log("Stage worker exited with code:", code);
+        stopUsing(proc, `Prediction worker exited with code ${code}`);
+    });
+
+    return proc;
+}
+
+function send(message) {
+    if (!worker) {
+        worker = startWorker();
+    }
+
+    const proc = worker;
+    const id = nextId++;
+    return new Promise((resolve, reject) => {
+        const timer = setTimeout(() => {
+            proc.pending.delete(id);
+            reject(new Error("Prediction worker timed out"));
+            shutdownIfDrained(proc);
+        }, REQUEST_TIMEOUT_MS);
+
+        proc.pending.set(id, { resolve, reject, timer });
+        proc.stdin.write(JSON.stringify({ ...message, id }) + "\n");
+    });
+}
+
+function predictStage(features) {
+    return send({ type: "predict", features });
+}
+
+function ping() {
+    return send({ type: "ping" });
+}
+
+// Send new requests to a fresh worker and let the current one exit once it
+// has answered the requests it already has. New model versions are picked
+// up without this, so it is only needed after code changes
+function restart() {
+    if (!worker) return;
+    const proc = worker;
+    worker = null;
+    proc.draining = true;
+    shutdownIfDrained(proc);
+}
+
+module.exports = { predictStage, ping, restart };
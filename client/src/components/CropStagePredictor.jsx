@@ -162,6 +162,17 @@ const CropStagePredictor = () => {
                                 </div>
                             </div>
 
+                            {prediction.suggested_tasks?.length > 0 && (
+                                <div className="prediction-card">
+                                    <h4 className="prediction-header">Suggested Tasks</h4>
+                                    {prediction.suggested_tasks.map(({ task }) => (
+                                        <div className="prediction-row" key={task}>
+                                            <span className="prediction-value">{task}</span>
+                                        </div>
+                                    ))}
+                                </div>
+                            )}
+
                             <div className="prediction-card">
                                 <h4 className="prediction-header">Stage Probabilities</h4>
                                 <div className="space-y-4">